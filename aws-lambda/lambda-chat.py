@@ -5,23 +5,22 @@ import traceback
 import datetime
 import time
 import re
+import zlib
+import threading
+import concurrent.futures
+import collections
+import hashlib
+import unicodedata
+import random
+import functools
 
 from urllib import parse
-import urllib.request
+import urllib3
 
+# cold start: 모든 요청에 필요한 module만 import하고, chain/memory/retriever/embedding/FAISS/numpy/local index는 처음 사용할 때 import
 from langchain.llms import Bedrock
-from langchain.docstore.document import Document
-from langchain.callbacks.streaming_stdout import StreamingStdOutCallbackHandler
-from langchain.chains import ConversationChain
-from langchain.memory import ConversationBufferMemory
-from langchain.memory import ConversationBufferWindowMemory
-from langchain.retrievers import AmazonKendraRetriever
+from langchain.callbacks.base import BaseCallbackHandler
 from langchain.prompts import PromptTemplate
-from langchain.chains import RetrievalQA
-from langchain.chains import LLMChain
-
-from langchain.embeddings import BedrockEmbeddings
-from langchain.vectorstores.faiss import FAISS
 
 from botocore.config import Config
 from botocore.exceptions import ClientError
@@ -31,174 +30,1211 @@ bedrock_region = os.environ.get('bedrock_region')
 callLogTableName = os.environ.get('callLogTableName')
 kendra_region = os.environ.get('kendra_region')
 kendraIndex = os.environ.get('kendraIndex')
+kendra_endpoint_url = os.environ.get('kendra_endpoint_url')
 numberOfRelevantDocs = os.environ.get('numberOfRelevantDocs')
 
 enableReference = 'true'
 top_k = int(numberOfRelevantDocs)
 MSG_LENGTH = 500
 
-rag_method = 'RetrievalPrompt'
+rag_method = os.environ.get('rag_method', 'RetrievalPrompt')  # RetrievalPrompt, RetrievalQA, ConversationalRetrievalChain
+
+# kendra: Retrieve/FAQ Query(및 fallback Query)를 동시에 요청하고 KENDRA_TIMEOUT(초) 안에 도착한 결과만 사용
+KENDRA_TIMEOUT = float(os.environ.get('kendra_timeout', '3'))
+KENDRA_SPECULATIVE_QUERY = os.environ.get('kendra_speculative_query', 'true')
+
+# hedged retrieval: Kendra가 HEDGE_DELAY(초)를 넘기거나 corpus 밖의 질문이면 naver 검색을 동시에 시작
+HEDGE_DELAY = float(os.environ.get('hedge_delay', '0.3'))
+NAVER_TIMEOUT = float(os.environ.get('naver_timeout', '2'))
+NAVER_API_URL = os.environ.get('naver_api_url', 'https://openapi.naver.com/v1/search/blog.json')
+OUT_OF_CORPUS_KEYWORDS = os.environ.get('out_of_corpus_keywords', '뉴스,날씨,오늘,최신,news,weather,today,latest').split(',')
+
+# FAQ fast path: 첫번째 Kendra FAQ(QUESTION_ANSWER) 결과의 confidence가 FAQ_MIN_CONFIDENCE이면 LLM 없이 FAQ 답변을 전송
+FAQ_FAST_PATH = os.environ.get('faq_fast_path', 'answer')  # answer, polish(fast model로 FAQ 답변을 짧게 다듬음), false
+FAQ_MIN_CONFIDENCE = os.environ.get('faq_min_confidence', 'VERY_HIGH').split(',')
+FAQ_SIMILARITY = os.environ.get('faq_similarity', 'none')  # none, lexical, embedding: FAQ 질문과 사용자 질문의 유사도를 추가로 확인
+FAQ_SIMILARITY_THRESHOLD = float(os.environ.get('faq_similarity_threshold', '0.5' if FAQ_SIMILARITY == 'lexical' else '0.8'))
+
+# answer cache: 정규화된 질문(exact)과 embedding 유사도(semantic)로 답변을 재사용
+ANSWER_CACHE_BACKEND = os.environ.get('answer_cache_backend', 'memory')  # memory, dynamodb, none
+ANSWER_CACHE_SIZE = int(os.environ.get('answer_cache_size', '1000'))
+ANSWER_CACHE_TTL = int(os.environ.get('answer_cache_ttl', '86400'))
+answerCacheTableName = os.environ.get('answerCacheTableName')
+SEMANTIC_CACHE = os.environ.get('semantic_cache', 'true')
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('semantic_cache_threshold', '0.95'))
+embedding_model_id = os.environ.get('embedding_model_id', 'amazon.titan-embed-text-v1')
+
+# retrieval cache: (index, 정규화된 질문, top_k, language filter)별 검색 결과. 결과 없음도 cache
+RETRIEVAL_CACHE_SIZE = int(os.environ.get('retrieval_cache_size', '2000'))
+RETRIEVAL_CACHE_BYTES = int(os.environ.get('retrieval_cache_bytes', str(32*1024*1024)))
+RETRIEVAL_CACHE_TTL = int(os.environ.get('retrieval_cache_ttl', '600'))
+RETRIEVAL_NEGATIVE_TTL = int(os.environ.get('retrieval_negative_ttl', '120'))
+retrievalCacheTableName = os.environ.get('retrievalCacheTableName')
+
+# single flight: 같은 (질문, 문서, convType, model)의 RAG 답변을 동시에 생성하지 않고 leader의 frame을 follower에게도 전송
+# inflightTableName(partition key: flight_key, TTL: expire_at)이 있을 때 container 간에 사용하며, request_id 중복도 확인
+inflightTableName = os.environ.get('inflightTableName')
+SINGLE_FLIGHT = os.environ.get('single_flight', 'true')
+FLIGHT_TTL = int(os.environ.get('flight_ttl', '120'))  # leader가 이 시간 안에 완료하지 않으면 다른 요청이 leader가 됨
+FLIGHT_POLL_INTERVAL = float(os.environ.get('flight_poll_interval', '0.5'))
+REQUEST_DEDUPE_TTL = int(os.environ.get('request_dedupe_ttl', '3600'))
+RECENT_REQUEST_COUNT = 1000
+
+# call log: BatchWriteItem으로 모아서 비동기로 저장하며, 긴 답변은 zlib으로 압축하여 Binary(msg_z)로 저장
+CALL_LOG_COMPRESS_THRESHOLD = int(os.environ.get('call_log_compress_threshold', '1024'))  # bytes
+CALL_LOG_FLUSH_TIMEOUT = float(os.environ.get('call_log_flush_timeout', '5'))
+CALL_LOG_MAX_ATTEMPTS = 5
+
+# local vector index: 미리 생성된 FAISS index를 먼저 검색하고 score가 낮으면 Kendra를 사용
+VECTOR_INDEX_PATH = os.environ.get('vector_index_path')  # layer(/opt/...) 또는 /tmp 경로
+VECTOR_INDEX_S3_URI = os.environ.get('vector_index_s3_uri')  # path에 index가 없으면 s3://bucket/prefix에서 download
+VECTOR_SCORE_THRESHOLD = float(os.environ.get('vector_score_threshold', '0.75'))
+VECTOR_EMBEDDER = os.environ.get('vector_embedder', 'bedrock')  # bedrock, hash (offline test용)
+LEXICAL_MIN_COVERAGE = float(os.environ.get('lexical_min_coverage', '0.5'))  # lexical 결과로 사용할 질문 token 비율
+
+# rerank: top_k * RERANK_FETCH_FACTOR개의 후보를 embedding하여 중복을 제거하고 MMR로 top_k개를 선택
+RERANK = os.environ.get('rerank', 'true')
+RERANK_FETCH_FACTOR = int(os.environ.get('rerank_fetch_factor', '3'))
+RERANK_DUPLICATE_THRESHOLD = float(os.environ.get('rerank_duplicate_threshold', '0.95'))  # 이 이상의 cosine similarity는 중복
+MMR_LAMBDA = float(os.environ.get('mmr_lambda', '0.7'))  # 1이면 질문과의 유사도만, 0이면 다양성만 고려
+RERANK_EMBEDDING_CACHE_SIZE = int(os.environ.get('rerank_embedding_cache_size', '5000'))
+RERANK_EMBEDDING_CACHE_TTL = int(os.environ.get('rerank_embedding_cache_ttl', '3600'))
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.environ.get('max_workers', '8')))
+# 질문을 다시 작성하는 동안 진행하는 원래 질문의 검색은 executor의 작업을 기다리므로 별도의 pool을 사용
+retrieval_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.environ.get('retrieval_max_workers', '2')))
+# search_Kendra의 API 호출은 executor에서 실행 중인 retrieve_from_Kendra가 기다리므로 별도의 pool을 사용
+kendra_executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(os.environ.get('kendra_max_workers', '8')))
+
+# streaming: 토큰을 모아서 STREAM_INTERVAL(초) 또는 STREAM_CHUNK_SIZE(글자)마다 한번씩 전송
+STREAM_INTERVAL = float(os.environ.get('stream_interval', '0.05'))
+STREAM_CHUNK_SIZE = int(os.environ.get('stream_chunk_size', '64'))
+
+# logging: JSON 한 줄로 LOG_LEVEL 이상만 출력하며, 요청의 LOG_SAMPLE_RATE 비율은 DEBUG까지 출력
+# 단계별 latency(span)는 요청마다 합산하여 CloudWatch EMF(Embedded Metric Format)로 한번에 출력
+LOG_LEVEL = os.environ.get('log_level', 'INFO').upper()
+LOG_SAMPLE_RATE = float(os.environ.get('log_sample_rate', '0.01'))
+METRICS_NAMESPACE = os.environ.get('metrics_namespace', 'LambdaChat')
+LOG_LEVELS = {'DEBUG': 10, 'INFO': 20, 'WARNING': 30, 'ERROR': 40}
+
+class Span:
+    """with 블록의 실행 시간(ms)을 요청의 metric에 더합니다. 예외가 발생해도 기록합니다."""
+    __slots__ = ('logger', 'name', 'start')
+
+    def __init__(self, logger, name):
+        self.logger = logger
+        self.name = name
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.logger.metric(self.name, (time.perf_counter() - self.start) * 1000)
+        return False
+
+class Logger:
+    """요청 context(request_id, user_id 등)를 포함한 JSON log와 요청별 metric을 관리합니다.
+
+    Lambda container는 한번에 하나의 요청만 처리하므로 context와 metric은 start_request()에서 초기화합니다.
+    """
+    def __init__(self, level, sample_rate, namespace):
+        self.level = LOG_LEVELS.get(level, LOG_LEVELS['INFO'])
+        self.sample_rate = sample_rate
+        self.namespace = namespace
+        self.request_level = self.level
+        self.context = dict()
+        self.metrics = dict()  # name -> [value, unit]
+        self.lock = threading.Lock()  # span은 executor의 thread에서도 기록됨
+
+    def start_request(self, **context):
+        self.context = {key: value for key, value in context.items() if value is not None}
+        self.request_level = LOG_LEVELS['DEBUG'] if random.random() < self.sample_rate else self.level
+        with self.lock:
+            self.metrics = dict()
+
+    def enabled(self, level):
+        return LOG_LEVELS[level] >= self.request_level
+
+    def log(self, level, message, **fields):
+        if not self.enabled(level):
+            return
+        record = {'level': level, 'message': message}
+        record.update(self.context)
+        record.update(fields)
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+    def debug(self, message, **fields):
+        self.log('DEBUG', message, **fields)
+
+    def info(self, message, **fields):
+        self.log('INFO', message, **fields)
+
+    def warning(self, message, **fields):
+        self.log('WARNING', message, **fields)
+
+    def error(self, message, **fields):
+        self.log('ERROR', message, **fields)
+
+    def exception(self, message, **fields):
+        self.log('ERROR', message, error=traceback.format_exc(), **fields)
+
+    def span(self, name):
+        return Span(self, name)
+
+    def traced(self, name):
+        """함수 전체를 span으로 측정하는 decorator."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def metric(self, name, value, unit='Milliseconds'):
+        """같은 요청에서 여러번 기록된 metric은 합산합니다 (예: websocket_send)."""
+        with self.lock:
+            if name in self.metrics:
+                self.metrics[name][0] += value
+            else:
+                self.metrics[name] = [value, unit]
+
+    def emit_metrics(self, **dimensions):
+        """요청의 metric을 EMF로 출력하며, CloudWatch가 log에서 metric을 추출합니다."""
+        with self.lock:
+            metrics, self.metrics = self.metrics, dict()
+        if not metrics:
+            return
+
+        record = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [list(dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit} for name, (_, unit) in metrics.items()]
+                }]
+            }
+        }
+        record.update(dimensions)
+        record.update({name: round(value, 3) for name, (value, _) in metrics.items()})
+        if 'request_id' in self.context:  # dimension이 아닌 property로 검색에만 사용
+            record['request_id'] = self.context['request_id']
+        print(json.dumps(record, ensure_ascii=False, default=str))
+
+logger = Logger(LOG_LEVEL, LOG_SAMPLE_RATE, METRICS_NAMESPACE)
+
+# boto3 client pool: container마다 (service, region, endpoint, config)별로 하나의 client를 재사용
+BOTO_CONFIG = Config(
+    max_pool_connections=int(os.environ.get('max_pool_connections', '50')),
+    connect_timeout=float(os.environ.get('connect_timeout', '3')),
+    read_timeout=float(os.environ.get('read_timeout', '10')),
+    retries={
+        'max_attempts': 10,
+        'mode': 'adaptive'
+    },
+    tcp_keepalive=True
+)
+BEDROCK_CONFIG = BOTO_CONFIG.merge(Config(
+    read_timeout=300,  # streaming 응답은 생성이 끝날때까지 연결을 유지
+    retries={
+        'max_attempts': 30,
+        'mode': 'adaptive'
+    }
+))
+
+clients = dict()
+client_lock = threading.Lock()
+
+def get_client(service_name, region_name=None, endpoint_url=None, config=BOTO_CONFIG):
+    key = (service_name, region_name, endpoint_url, id(config))
+    boto3_client = clients.get(key)
+    if boto3_client is None:
+        with client_lock:  # boto3의 client 생성은 thread safe하지 않음
+            boto3_client = clients.get(key)
+            if boto3_client is None:
+                boto3_client = boto3.client(
+                    service_name=service_name,
+                    region_name=region_name,
+                    endpoint_url=endpoint_url,
+                    config=config
+                )
+                clients[key] = boto3_client
+    return boto3_client
+
+# naver 검색용 keep-alive connection pool (naver 검색을 처음 사용할 때 생성)
+naver_http = None
+def get_naver_http():
+    global naver_http
+    if naver_http is None:
+        with client_lock:
+            if naver_http is None:
+                naver_http = urllib3.PoolManager(
+                    maxsize=10,
+                    timeout=urllib3.Timeout(connect=1.0, read=NAVER_TIMEOUT),
+                    retries=False
+                )
+    return naver_http
 
 # websocket
 connection_url = os.environ.get('connection_url')
-client = boto3.client('apigatewaymanagementapi', endpoint_url=connection_url)
+client = get_client('apigatewaymanagementapi', endpoint_url=connection_url)
             
-boto3_bedrock = boto3.client(
-    service_name='bedrock-runtime',
-    region_name=bedrock_region,
-    config=Config(
-        retries = {
-            'max_attempts': 30
-        }            
-    )
-)
+bedrock_endpoint_url = os.environ.get('bedrock_endpoint_url')  # test용 stub Bedrock runtime
+boto3_bedrock = get_client('bedrock-runtime', region_name=bedrock_region, endpoint_url=bedrock_endpoint_url, config=BEDROCK_CONFIG)
 
 HUMAN_PROMPT = "\n\nHuman:"
 AI_PROMPT = "\n\nAssistant:"
-def get_parameter(modelId):
-    if modelId == 'anthropic.claude-v2:1':
+MODEL_MAX_TOKENS = {
+    'anthropic.claude-v2:1': 8191, # 8k
+    'anthropic.claude-v2': 8191,
+    'anthropic.claude-instant-v1': 8191,
+    'amazon.titan-text-express-v1': 8192,
+}
+def get_parameter(modelId, max_tokens=None):
+    max_tokens = min(max_tokens or MODEL_MAX_TOKENS.get(modelId, 4096), MODEL_MAX_TOKENS.get(modelId, 4096))
+    if modelId.startswith('anthropic.claude'):
         return {
-            "max_tokens_to_sample":8191, # 8k
+            "max_tokens_to_sample":max_tokens,
             "temperature":0.1,
             "top_k":250,
             "top_p":0.9,
             "stop_sequences": [HUMAN_PROMPT]            
         }
-parameters = get_parameter(modelId)
-    
-# LLM 정의
-llm = Bedrock(
-model_id=modelId, 
-client=boto3_bedrock, 
-streaming=True,
-callbacks=[StreamingStdOutCallbackHandler()],
-model_kwargs=parameters)
-    
-
-map_chain = dict() # RAG
-map_chat = dict() # general conversation  
-    
-kendraRetriever = AmazonKendraRetriever(
-    index_id=kendraIndex,
-    top_k=top_k,
-    region_name=kendra_region,
-    attribute_filter = {
-        "EqualsTo": {
-            "Key": "_language_code",
-            "Value": {
-                "StringValue": "ko"
-            }
-        },
-    },
-)
+    elif modelId.startswith('amazon.titan'):
+        return {
+            "maxTokenCount":max_tokens,
+            "temperature":0.1,
+            "topP":0.9
+        }
+    return None  # 그 외의 model은 model의 기본 parameter를 사용하며 max_tokens를 제한하지 않음
+
+# model routing: 요청마다 질문의 길이/복잡도, convType, FAQ 여부, latency SLO로 model과 max_tokens를 선택
+MODEL_ROUTING = os.environ.get('model_routing', 'true')
+FAST_MODEL_ID = os.environ.get('fast_model_id', 'anthropic.claude-instant-v1')
+CLIENT_MODEL_IDS = [m for m in os.environ.get('client_model_ids', '').split(',') if m]  # client가 지정하면 그대로 사용하는 model
+LATENCY_SLO = float(os.environ.get('latency_slo', '60'))  # 답변 완료까지의 목표 시간(초)
+MODEL_POOL = list(dict.fromkeys([modelId, FAST_MODEL_ID] + [m for m in os.environ.get('model_pool', '').split(',') if m] + CLIENT_MODEL_IDS))
+
+# LLM 정의: model별 Bedrock LLM을 container마다 미리 생성
+def create_llm(model_id):
+    return Bedrock(
+        model_id=model_id, 
+        client=boto3_bedrock, 
+        streaming=True,
+        model_kwargs=get_parameter(model_id))
+
+def create_llms(pool):
+    """pool의 model별 LLM을 생성하며, 생성할 수 없는 model은 log를 남기고 pool에서 제외합니다."""
+    llms = dict()
+    for model_id in pool:
+        if get_parameter(model_id) is None:
+            logger.warning('model parameters are not supported. use the default parameters of the model', model_id=model_id)
+        try:
+            llms[model_id] = create_llm(model_id)
+        except Exception:
+            logger.exception('error in create_llms', model_id=model_id)
+    if modelId not in llms:
+        raise Exception(f'Not able to create the LLM for model_id: {modelId}')
+    return llms
+
+llms = create_llms(MODEL_POOL)
+MODEL_POOL = list(llms)
+llm = llms[modelId]
     
-# Langchain Memory 활용 - 채팅 이력 고려
-chat_memory = ConversationBufferMemory(human_prefix='Human', ai_prefix='Assistant')
-conversation = ConversationChain(llm=llm, verbose=False, memory=chat_memory)
 
-def get_prompt_template(query, convType):
-    print('[get_prompt_template]')
- 
-    pattern_hangul = re.compile('[\u3131-\u3163\uac00-\ud7a3]+')
-    word_kor = pattern_hangul.search(str(query))
-    print('word_kor: ', word_kor)
+# 사용자별 대화 이력: 사용자 수, 전체 크기(bytes), idle 시간으로 제한
+HISTORY_TURNS = 20
+SESSION_MAX_USERS = int(os.environ.get('session_max_users', '1000'))
+SESSION_MAX_BYTES = int(os.environ.get('session_max_bytes', str(64*1024*1024)))
+SESSION_IDLE_TTL = int(os.environ.get('session_idle_ttl', '3600'))
+
+# 대화 요약: 이력이 HISTORY_TOKEN_BUDGET을 넘으면 최근 HISTORY_RECENT_TOKENS 안의 turn을 제외한 이전 turn을 요약으로 합침
+# 이전 turn이 HISTORY_SUMMARY_MIN_TURNS개 이상 쌓였을 때만 요약하므로 답변마다 요약하지 않음
+HISTORY_TOKEN_BUDGET = int(os.environ.get('history_token_budget', '1500'))
+HISTORY_RECENT_TOKENS = int(os.environ.get('history_recent_tokens', '1000'))
+HISTORY_SUMMARY_MIN_TURNS = int(os.environ.get('history_summary_min_turns', '4'))
+SUMMARY_MODEL_ID = os.environ.get('summary_model_id', FAST_MODEL_ID)
+SUMMARY_MAX_TOKENS = 512
+SUMMARY_FLUSH_TIMEOUT = float(os.environ.get('summary_flush_timeout', '1'))  # 응답 후 요약을 기다리는 최대 시간(초)
+
+summary_llm = Bedrock(
+    model_id=SUMMARY_MODEL_ID, 
+    client=boto3_bedrock, 
+    model_kwargs=get_parameter(SUMMARY_MODEL_ID, SUMMARY_MAX_TOKENS))
+
+# query condensation: 이전 대화에 의존하는 질문만 fast model로 다시 작성하며, 원래 질문의 검색과 동시에 진행
+CONDENSE = os.environ.get('condense', 'true')
+CONDENSE_MODEL_ID = os.environ.get('condense_model_id', FAST_MODEL_ID)
+CONDENSE_MAX_TOKENS = 128
+CONDENSE_TIMEOUT = float(os.environ.get('condense_timeout', '3'))
+CONDENSE_MIN_TOKENS = 6  # 이보다 짧은 질문은 이전 대화에 의존한다고 판단 (예: "그럼 가격은?")
+CONDENSE_CACHE_SIZE = int(os.environ.get('condense_cache_size', '1000'))
+CONDENSE_CACHE_TTL = int(os.environ.get('condense_cache_ttl', '3600'))
+
+condense_llm = Bedrock(
+    model_id=CONDENSE_MODEL_ID, 
+    client=boto3_bedrock, 
+    model_kwargs=get_parameter(CONDENSE_MODEL_ID, CONDENSE_MAX_TOKENS))
+    
+# RetrievalQA, ConversationalRetrievalChain에서만 사용하므로 chain을 생성할 때 만듦
+kendraRetriever = None
+def get_kendra_retriever():
+    global kendraRetriever
+    if kendraRetriever is None:
+        from langchain.retrievers import AmazonKendraRetriever
+        kendraRetriever = AmazonKendraRetriever(
+            index_id=kendraIndex,
+            top_k=top_k,
+            region_name=kendra_region,
+            client=get_client('kendra', region_name=kendra_region),
+            attribute_filter = {
+                "EqualsTo": {
+                    "Key": "_language_code",
+                    "Value": {
+                        "StringValue": "ko"
+                    }
+                },
+            },
+        )
+    return kendraRetriever
 
-    if word_kor and word_kor != 'None':
-        if convType == "normal": # General Conversation
-            prompt_template = """\n\nHuman: 다음의 <history>는 Human과 Assistant의 친근한 이전 대화입니다. Assistant은 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. Assistant는 모르는 질문을 받으면 솔직히 모른다고 말합니다.
+# prompt templates: 줄마다의 들여쓰기와 공백도 token으로 계산되므로 제거한 후 (language, convType)별로 미리 생성
+PROMPT_TEMPLATES = {
+    ('ko', 'normal'): """\n\nHuman: 다음의 <history>는 Human과 Assistant의 친근한 이전 대화입니다. Assistant은 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. Assistant는 모르는 질문을 받으면 솔직히 모른다고 말합니다.
 
-            <history>
-            {history}
-            </history>
+        <history>
+        {history}
+        </history>
 
-            <question>            
-            {input}
-            </question>
-            
-            Assistant:"""
+        <question>
+        {input}
+        </question>
 
-        elif (convType=='qa'):  # RAG
-            prompt_template = """\n\nHuman: 다음의 참고자료를 이용하여 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. Assistant는 모르는 질문을 받으면 솔직히 모른다고 말합니다.
-        
-            참고자료:
-            {context}
+        Assistant:""",
+    ('ko', 'qa'): """\n\nHuman: 다음의 참고자료를 이용하여 상황에 맞는 구체적인 세부 정보를 충분히 제공합니다. Assistant는 모르는 질문을 받으면 솔직히 모른다고 말합니다.
 
-            질문:            
-            {question}
+        참고자료:
+        {context}
 
-            Assistant:"""
-                
-    else:  # English
-        if convType == "normal": # General Conversation
-            prompt_template = """\n\nHuman: Using the following conversation, answer friendly for the newest question. If you don't know the answer, just say that you don't know, don't try to make up an answer. You will be acting as a thoughtful advisor.
+        질문:
+        {question}
 
-            <history>
-            {history}
-            </history>
-            
-            <question>            
-            {input}
-            </question>
+        Assistant:""",
+    ('en', 'normal'): """\n\nHuman: Using the following conversation, answer friendly for the newest question. If you don't know the answer, just say that you don't know, don't try to make up an answer. You will be acting as a thoughtful advisor.
+
+        <history>
+        {history}
+        </history>
+
+        <question>
+        {input}
+        </question>
+
+        Assistant:""",
+    ('en', 'qa'): """\n\nHuman: Use the following information to provide a concise answer to the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer.
+
+        Reference Information:
+        {context}
+
+        Question:
+        {question}
+
+        Assistant:""",
+    ('ko', 'condense'): """
+        <history>
+        {chat_history}
+        </history>
+
+        Human: <history>를 참조하여, 다음의 <question>의 뜻을 명확히 하는 새로운 질문을 한국어로 생성하세요. 새로운 질문은 원래 질문의 중요한 단어를 반드시 포함합니다.
+
+        <question>
+        {question}
+        </question>
+
+        Assistant: 새로운 질문:""",
+    ('en', 'condense'): """
+        <history>
+        {chat_history}
+        </history>
+        Answer only with the new question.
+
+        Human: using <history>, rephrase the follow up <question> to be a standalone question. The standalone question must have main words of the original question.
+
+        <quesion>
+        {question}
+        </question>
+
+        Assistant: Standalone question:""",
+    ('ko', 'summary'): """\n\nHuman: 다음의 <summary>는 이전 대화의 요약이고 <history>는 그 이후의 대화입니다. 두 내용을 합쳐서 이후 대화에 필요한 사실과 사용자의 질문, 요청을 중심으로 간결하게 요약하세요.
+
+        <summary>
+        {summary}
+        </summary>
+
+        <history>
+        {history}
+        </history>
 
-            Assistant:"""
+        Assistant: 요약:""",
+    ('en', 'summary'): """\n\nHuman: <summary> is the summary of the earlier conversation and <history> is the conversation after it. Merge them into a concise summary that keeps the facts, questions and requests needed for the rest of the conversation.
 
-        elif (convType=='qa'):  # RAG
-            prompt_template = """\n\nHuman: Use the following information to provide a concise answer to the question at the end. If you don't know the answer, just say that you don't know, don't try to make up an answer. 
+        <summary>
+        {summary}
+        </summary>
+
+        <history>
+        {history}
+        </history>
+
+        Assistant: Summary:""",
+    ('ko', 'faq'): """\n\nHuman: 다음의 <faq>는 고객 질문에 대한 공식 답변입니다. <faq>의 내용만 사용하여 <question>에 대한 답변을 짧고 자연스럽게 다시 작성하세요. 내용을 추가하거나 바꾸지 않습니다.
+
+        <faq>
+        질문: {faq_question}
+        답변: {answer}
+        </faq>
+
+        <question>
+        {question}
+        </question>
+
+        Assistant:""",
+    ('en', 'faq'): """\n\nHuman: <faq> is the official answer for a customer question. Using only the content of <faq>, rewrite it as a short and natural answer to <question>. Do not add or change any facts.
+
+        <faq>
+        Question: {faq_question}
+        Answer: {answer}
+        </faq>
+
+        <question>
+        {question}
+        </question>
+
+        Assistant:""",
+    ('en', 'conversational_condense'): """
+        <history>
+        {chat_history}
+        </history>
+        Answer only with the new question.
+
+        Human: using <history>, rephrase the follow up <question> to be a standalone question.
+
+        <quesion>
+        {question}
+        </question>
+
+        Assistant: Standalone question:""",
+}
+
+def compile_template(template):
+    return PromptTemplate.from_template('\n'.join(line.strip() for line in template.split('\n')))
+
+PROMPTS = {key: compile_template(template) for key, template in PROMPT_TEMPLATES.items()}
+
+pattern_hangul = re.compile('[\u3131-\u3163\uac00-\ud7a3]')
+
+def get_language(text):  # 첫번째 한글에서 검색을 멈춤. 요청마다 한번만 계산하여 전달
+    return 'ko' if pattern_hangul.search(text) else 'en'
+
+def get_prompt_template(language, convType):
+    return PROMPTS[(language, convType)]
+
+# chain registry: chain 객체는 container마다 (language, convType, kind, model_id)별로 한번만 생성
+# Lambda container는 한번에 하나의 요청만 처리하므로 대화 이력(memory)은 요청마다 chain에 설정
+chains = dict()
+chain_lock = threading.Lock()
+
+def get_chain(language, convType, kind, model_id=modelId):
+    key = (language, convType, kind, model_id)
+    chain = chains.get(key)
+    if chain is None:
+        with chain_lock:
+            chain = chains.get(key)
+            if chain is None:
+                chain = create_chain(language, convType, kind, model_id)
+                chains[key] = chain
+                logger.info('chain is created', key=key)
+    return chain
+
+def create_chain(language, convType, kind, model_id):
+    llm = llms[model_id]
+    if kind == 'conversation':
+        from langchain.chains import ConversationChain
+        from langchain.memory import ConversationBufferWindowMemory
+        return ConversationChain(
+            llm=llm, 
+            verbose=False, 
+            prompt=get_prompt_template(language, convType),
+            memory=ConversationBufferWindowMemory(human_prefix='Human', ai_prefix='Assistant', k=HISTORY_TURNS)
+        )
+    elif kind == 'condense':
+        from langchain.chains import LLMChain
+        return LLMChain(llm=condense_llm, prompt=get_prompt_template(language, 'condense'))
+    elif kind == 'RetrievalQA':
+        from langchain.chains import RetrievalQA
+        return RetrievalQA.from_chain_type(
+            llm=llm,
+            chain_type="stuff",
+            retriever=get_kendra_retriever(),
+            return_source_documents=True,
+            chain_type_kwargs={"prompt": get_prompt_template(language, convType)}
+        )
+    elif kind == 'ConversationalRetrievalChain':
+        from langchain.memory import ConversationBufferWindowMemory
+        memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=HISTORY_TURNS)
+        return create_ConversationalRetrievalChain(llm, get_prompt_template(language, convType), retriever=get_kendra_retriever(), memory_chain=memory_chain)
+    raise Exception(f'Not supported chain: {kind}')
+
+# context packing: 참고자료를 PROMPT_TOKEN_BUDGET 안에서 우선순위(검색/rerank 순서)대로 채움
+PROMPT_TOKEN_BUDGET = int(os.environ.get('prompt_token_budget', '4000'))
+HANGUL_TOKENS_PER_CHAR = 1.0  # Claude tokenizer에서 한글은 대략 글자당 1 token
+LATIN_CHARS_PER_TOKEN = 4.0   # 영어/숫자/기호는 대략 4글자당 1 token
+MIN_TRIMMED_TOKENS = 50       # 이보다 짧게 잘리는 참고자료는 넣지 않음
+
+pattern_hangul_char = re.compile('[\u1100-\u11ff\u3131-\u318e\uac00-\ud7a3]')
+pattern_sentence_end = re.compile(r'(?<=[.!?。])\s+|\n+')
+
+def estimate_tokens(text):
+    """tokenizer 없이 한글 글자 수와 나머지 글자 수로 token 수를 추정합니다."""
+    hangul = len(pattern_hangul_char.findall(text))
+    others = len(text) - hangul - text.count(' ')
+    return int(hangul * HANGUL_TOKENS_PER_CHAR + others / LATIN_CHARS_PER_TOKEN + text.count(' ') / 4) + 1
+
+def trim_to_tokens(text, max_tokens):
+    """문장 경계에서 max_tokens 이하가 되도록 앞부분의 문장만 남깁니다.
+
+    첫 문장부터 max_tokens를 넘으면(문장 경계가 없는 긴 텍스트 등) 글자 단위로 자릅니다.
+    """
+    sentences = []
+    tokens = 0
+    for sentence in pattern_sentence_end.split(text):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        sentence_tokens = estimate_tokens(sentence)
+        if tokens + sentence_tokens > max_tokens:
+            break
+        sentences.append(sentence)
+        tokens += sentence_tokens
+    if not sentences and max_tokens > 0:
+        text = text.strip()
+        low, high = 0, len(text)  # max_tokens 이하가 되는 가장 긴 prefix를 이분 탐색
+        while low < high:
+            middle = (low + high + 1) // 2
+            if estimate_tokens(text[:middle]) <= max_tokens:
+                low = middle
+            else:
+                high = middle - 1
+        excerpt = text[:low].rstrip()
+        return excerpt, estimate_tokens(excerpt) if excerpt else 0
+    return ' '.join(sentences), tokens
+
+def pack_context(PROMPT, question, relevant_docs, budget=PROMPT_TOKEN_BUDGET):
+    """질문과 template을 제외한 token budget 안에서 참고자료를 순서대로 넣어 (context, 사용한 문서, 통계)를 반환합니다.
+
+    budget을 넘는 참고자료는 문장 경계에서 자르고, 그 이후의 참고자료는 사용하지 않습니다.
+    """
+    base_tokens = estimate_tokens(PROMPT.format(context='', question=question))
+    remaining = budget - base_tokens
+    
+    parts = []
+    used_docs = []
+    trimmed = 0
+    for doc in relevant_docs:
+        excerpt = doc['metadata']['excerpt']
+        tokens = estimate_tokens(excerpt)
+        if tokens + 1 > remaining:  # 구분자 포함
+            excerpt, tokens = trim_to_tokens(excerpt, remaining - 1)
+            if tokens < MIN_TRIMMED_TOKENS:
+                break
+            trimmed += 1
+        parts.append(excerpt)
+        used_docs.append(doc)
+        remaining -= tokens + 1  # 구분자
+        if remaining <= 0:
+            break
+    
+    stats = {
+        'prompt_tokens': budget - remaining,
+        'context_tokens': budget - remaining - base_tokens,
+        'budget': budget,
+        'docs': len(relevant_docs),
+        'packed': len(used_docs),
+        'trimmed': trimmed,
+    }
+    return '\n\n'.join(parts), used_docs, stats
+
+# 답변 길이(token)의 예상값. max_tokens는 예상값의 2배로 제한
+ANSWER_TOKENS = {
+    'faq': 400,       # FAQ 답변을 다듬는 경우
+    'chat': 600,      # 일반 대화
+    'qa': 1000,       # 참고자료를 이용한 답변
+    'complex': 2000,  # 비교/분석/요약 등
+}
+LATENCY_PRIORS = {  # 측정값이 없을 때 사용하는 (첫 token까지의 시간(초), 초당 token 수)
+    'anthropic.claude-v2:1': (1.5, 40),
+    'anthropic.claude-v2': (1.5, 40),
+    'anthropic.claude-instant-v1': (0.6, 100),
+    'amazon.titan-text-express-v1': (1.0, 50),
+}
+SIMPLE_QUERY_TOKENS = 20
+COMPLEX_QUERY_TOKENS = 60
+pattern_complex = re.compile('비교|차이|분석|이유|왜|장단점|요약|정리|자세히|compare|differen|explain|why|analy|summar|detail|step by step')
+
+class ModelRoute:
+    __slots__ = ('model_id', 'max_tokens', 'reason', 'category', 'predicted_latency', 'started_at')
+    
+    def __init__(self, model_id, max_tokens, reason, category, predicted_latency):
+        self.model_id = model_id
+        self.max_tokens = max_tokens
+        self.reason = reason
+        self.category = category
+        self.predicted_latency = predicted_latency
+        self.started_at = time.time()
+
+class ModelRouter:
+    """요청마다 model과 max_tokens를 선택하고, 결과 latency를 model별 이동 평균으로 반영합니다.
+
+    client가 지정한 model이 client_model_ids에 있으면 그대로 사용합니다. 그 외에는 짧은 일반 대화나
+    FAQ에 대한 답변은 fast model을, 나머지는 기본 model을 사용하되 기본 model의 예상 latency가
+    latency_slo를 넘으면 fast model을 사용합니다. 선택과 결과는 정책 조정을 위해 log로 남깁니다.
+    """
+    EWMA_ALPHA = 0.2
+    
+    def __init__(self, default_model_id, fast_model_id, pool, client_model_ids, latency_slo, enabled=True):
+        self.default_model_id = default_model_id
+        self.fast_model_id = fast_model_id if fast_model_id in pool else default_model_id
+        self.pool = pool
+        self.client_model_ids = client_model_ids
+        self.latency_slo = latency_slo
+        self.enabled = enabled
+        self.current = None  # 현재 요청에서 마지막으로 선택된 route (취소된 token 수 추정용)
+        self.stats = dict()
+        for model_id in pool:
+            ttft, tps = LATENCY_PRIORS.get(model_id, (1.0, 40))
+            self.stats[model_id] = {'requests': 0, 'ttft': ttft, 'tps': tps}
+        
+    def predict_latency(self, model_id, tokens):
+        stats = self.stats[model_id]
+        return stats['ttft'] + tokens / stats['tps']
+    
+    def get_category(self, text, convType, faq_hit):
+        query_tokens = estimate_tokens(text)
+        if faq_hit:
+            return 'faq', query_tokens
+        if query_tokens > COMPLEX_QUERY_TOKENS or text.count('?') >= 2 or pattern_complex.search(text.lower()):
+            return 'complex', query_tokens
+        return ('qa' if convType == 'qa' else 'chat'), query_tokens
+    
+    def route(self, text, convType, faq_hit=False, requested_model_id=None):
+        category, query_tokens = self.get_category(text, convType, faq_hit)
+        
+        if requested_model_id in self.client_model_ids and requested_model_id in self.pool:
+            model_id, reason = requested_model_id, 'client'
+        elif not self.enabled:
+            model_id, reason = self.default_model_id, 'default'
+        elif category == 'faq' or (category == 'chat' and query_tokens <= SIMPLE_QUERY_TOKENS):
+            model_id, reason = self.fast_model_id, category if category == 'faq' else 'simple'
+        else:
+            model_id, reason = self.default_model_id, category
+            predicted = self.predict_latency(model_id, ANSWER_TOKENS[category])
+            if predicted > self.latency_slo and self.predict_latency(self.fast_model_id, ANSWER_TOKENS[category]) < predicted:
+                model_id, reason = self.fast_model_id, 'slo'
+        
+        max_tokens = min(ANSWER_TOKENS[category] * 2, MODEL_MAX_TOKENS.get(model_id, 4096))
+        route = ModelRoute(model_id, max_tokens, reason, category, self.predict_latency(model_id, ANSWER_TOKENS[category]))
+        logger.info('model route', 
+            model_id=model_id,
+            reason=reason,
+            category=category,
+            query_tokens=query_tokens,
+            max_tokens=max_tokens,
+            predicted_latency=round(route.predicted_latency, 3))
+        self.current = route
+        return route
+    
+    def record(self, route, streamer):
+        """생성이 끝난 후 첫 token까지의 시간과 초당 token 수를 반영합니다."""
+        if not streamer.tokens:  # cache된 답변 등 LLM을 호출하지 않은 경우
+            return
+        elapsed = time.time() - route.started_at
+        ttft = streamer.first_token_at - route.started_at
+        tps = streamer.tokens / max(elapsed - ttft, 1e-3)
+        
+        stats = self.stats[route.model_id]
+        stats['requests'] += 1
+        stats['ttft'] += self.EWMA_ALPHA * (ttft - stats['ttft'])
+        stats['tps'] += self.EWMA_ALPHA * (tps - stats['tps'])
+        logger.metric('llm_first_token', ttft * 1000)
+        logger.metric('llm_total', elapsed * 1000)
+        logger.metric('llm_output_tokens', streamer.tokens, 'Count')
+        logger.info('model route result', 
+            model_id=route.model_id,
+            reason=route.reason,
+            category=route.category,
+            max_tokens=route.max_tokens,
+            predicted_latency=round(route.predicted_latency, 3),
+            latency=round(elapsed, 3),
+            first_token_latency=round(ttft, 3),
+            output_tokens=streamer.tokens,
+            slo_met=elapsed <= self.latency_slo)
+
+model_router = ModelRouter(modelId, FAST_MODEL_ID, MODEL_POOL, CLIENT_MODEL_IDS, LATENCY_SLO, MODEL_ROUTING == 'true')
+
+def get_llm(route):  # 한번에 하나의 요청만 처리하므로 선택된 LLM의 max_tokens를 요청마다 설정
+    selected = llms[route.model_id]
+    selected.model_kwargs = get_parameter(route.model_id, route.max_tokens)
+    return selected
+
+# websocket frame protocol
+# {'v', 'type': delta|final|typing|error|resync, 'request_id', 'seq', 'offset', 'text'}
+# final/resync frame은 전체 답변의 length(UTF-16 code unit)와 checksum(UTF-8 crc32)을 포함
+FRAME_VERSION = 1
+RECENT_ANSWER_COUNT = 100
+
+recent_answers = dict()  # resync를 위한 최근 답변 ((user_id, request_id) -> text)
+
+def text_length(text):  # javascript의 string.length와 동일하게 UTF-16 code unit으로 계산
+    return len(text.encode('utf-16-le')) // 2
+
+def make_frame(requestId, type, seq=0, offset=0, text=""):
+    return {
+        'v': FRAME_VERSION,
+        'type': type,
+        'request_id': requestId,
+        'seq': seq,
+        'offset': offset,
+        'text': text
+    }
+
+class FrameBatcher:
+    """답변 텍스트를 delta frame으로 묶어서 전송합니다.
+
+    버퍼가 chunk_size 글자를 넘거나 마지막 전송 후 interval(초)이 지나면 flush하며,
+    close()는 남은 텍스트와 함께 length/checksum을 담은 final frame을 전송합니다.
+    single flight의 leader이면(flight) 등록된 follower에게도 각자의 request_id, seq, offset으로 같은 frame을 전송하며,
+    새 follower에게는 그때까지 전송된 텍스트를 먼저 한번에 전송합니다.
+    """
+    def __init__(self, connectionId, requestId, interval=STREAM_INTERVAL, chunk_size=STREAM_CHUNK_SIZE):
+        self.connectionId = connectionId
+        self.requestId = requestId
+        self.interval = interval
+        self.chunk_size = chunk_size
+        
+        self.seq = 0
+        self.offset = 0    # 전송된 전체 길이
+        self.checksum = 0
+        self.buffer = []
+        self.buffered = 0
+        self.sent = []
+        self.last_sent = time.time()
+        
+        self.flight = None       # single flight leader
+        self.followers = dict()  # follower requestId -> (connectionId, seq, offset)
+        self.detached = False    # leader의 연결이 끊겼지만 follower에게 계속 전송 중
+        
+    def write(self, text):
+        if not text:
+            return
+        self.buffer.append(text)
+        self.buffered += len(text)
+        
+        if self.buffered >= self.chunk_size or time.time() - self.last_sent >= self.interval:
+            self.flush()
+            
+    def _take(self):
+        text = "".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        return text
+    
+    def _send(self, type, text, **extra):
+        if not self.detached:
+            frame = make_frame(self.requestId, type, self.seq, self.offset, text)
+            frame.update(extra)
+            try:
+                sendMessage(self.connectionId, frame)
+            except ConnectionGone:
+                if not self.followers:
+                    raise
+                self.detached = True
+        
+        for requestId in list(self.followers):
+            self._send_follower(requestId, type, text, **extra)
+        if self.detached and not self.followers:
+            raise ConnectionGone(self.connectionId)
+        
+        self.seq += 1
+        self.offset += text_length(text)
+        self.last_sent = time.time()
+        
+    def _send_follower(self, requestId, type, text, **extra):
+        connectionId, seq, offset = self.followers[requestId]
+        frame = make_frame(requestId, type, seq, offset, text)
+        frame.update(extra)
+        try:
+            sendMessage(connectionId, frame)
+        except Exception:  # follower가 직접 답변을 전송하도록 served에서 제외
+            logger.info('follower is dropped', follower_request_id=requestId)
+            self.followers.pop(requestId)
+            return
+        self.followers[requestId] = (connectionId, seq + 1, offset + text_length(text))
+        
+    def _add_followers(self, force=False):
+        if self.flight is None:
+            return
+        for connectionId, requestId in self.flight.poll(force):
+            self.followers[requestId] = (connectionId, 0, 0)
+            if self.sent:
+                self._send_follower(requestId, 'delta', "".join(self.sent))
             
-            Reference Information:
-            {context}
-                        
-            Question:
-            {question}
+    def _account(self, text):
+        self.checksum = zlib.crc32(text.encode('utf-8'), self.checksum)
+        self.sent.append(text)
+    
+    def flush(self):
+        if not self.buffer:
+            return
+        self._add_followers()
+        text = self._take()
+        self._account(text)
+        self._send('delta', text)
+        
+    def close(self):
+        self._add_followers(force=True)  # final frame 전에 등록된 follower는 모두 전송
+        text = self._take()
+        self._account(text)
+        length = self.offset + text_length(text)
+        self._send('final', text, length=length, checksum=self.checksum)
+        
+    @property
+    def streamed(self):
+        return self.seq > 0 or self.buffered > 0
 
-            Assistant:"""
+class WebSocketStreamingCallbackHandler(BaseCallbackHandler):
+    """Bedrock에서 생성되는 토큰을 FrameBatcher를 통해 WebSocket으로 바로 전달합니다.
 
-    return PromptTemplate.from_template(prompt_template)
+    연결이 끊기면 ConnectionGone을 발생시켜 Bedrock stream을 중단합니다 (raise_error).
+    """
+    raise_error = True
+    
+    def __init__(self, connectionId, requestId):
+        self.connectionId = connectionId
+        self.batcher = FrameBatcher(connectionId, requestId)
+        self.first_token_at = None
+        self.tokens = 0
+        self.served = False  # single flight의 leader가 이 요청의 답변을 전송함
+        
+    def on_llm_new_token(self, token, **kwargs):
+        if connection_registry.is_dead(self.connectionId) and not self.batcher.followers:
+            raise ConnectionGone(self.connectionId)
+        if self.first_token_at is None:
+            self.first_token_at = time.time()
+        self.tokens += 1
+        self.batcher.write(token)
+        
+    def write(self, text):
+        self.batcher.write(text)
+        
+    def close(self):
+        self.batcher.close()
+        
+    @property
+    def streamed(self):
+        return self.batcher.streamed
+    
+    @property
+    def flight(self):
+        return self.batcher.flight
+
+def remember_answer(userId, requestId, text):
+    recent_answers[(userId, requestId)] = text
+    while len(recent_answers) > RECENT_ANSWER_COUNT:
+        recent_answers.pop(next(iter(recent_answers)))
+
+# cancellation: 답변 frame 전송 중 GoneException이 발생하면 생성 중인 답변을 중단하고, 끊긴 connection이 사용한 session을 정리
+DEAD_CONNECTION_COUNT = 1000
+
+class ConnectionGone(Exception):
+    """client와의 WebSocket 연결이 끊겨서 답변을 전송할 수 없습니다."""
+
+class ConnectionRegistry:
+    """connection별 상태 (GoneException이 발생한 connection과 connection이 사용한 session key).
+
+    Lambda container는 한번에 하나의 요청만 처리하므로 생성 중에 끊긴 연결은 답변 frame을 전송할 때의
+    GoneException으로만 알 수 있습니다. $disconnect는 생성이 끝난 후 또는 다른 container에서 처리되므로
+    생성을 중단하는데 사용하지 않고 session memory만 해제합니다.
+    """
+    def __init__(self, max_count):
+        self.max_count = max_count
+        self.dead = collections.OrderedDict()      # connectionId -> 끊긴 시간
+        self.sessions = collections.OrderedDict()  # connectionId -> session key set
+        self.lock = threading.Lock()
+        
+    def add_session(self, connectionId, key):
+        with self.lock:
+            self.sessions.setdefault(connectionId, set()).add(key)
+            self.sessions.move_to_end(connectionId)
+            while len(self.sessions) > self.max_count:
+                self.sessions.popitem(last=False)
+                
+    def is_dead(self, connectionId):
+        return connectionId in self.dead
+    
+    def mark_dead(self, connectionId):
+        """GoneException이 발생한 connection으로 기록하여 이후의 전송과 생성을 중단합니다."""
+        with self.lock:
+            self.dead[connectionId] = time.time()
+            self.dead.move_to_end(connectionId)
+            while len(self.dead) > self.max_count:
+                self.dead.popitem(last=False)
+                
+    def pop_sessions(self, connectionId):
+        """connection이 사용한 session key를 반환합니다."""
+        with self.lock:
+            return self.sessions.pop(connectionId, set())
+
+connection_registry = ConnectionRegistry(DEAD_CONNECTION_COUNT)
+
+def close_connection(connectionId, reason):
+    """연결이 끊긴 connection의 session memory를 해제합니다. 다시 연결하면 call log에서 이력을 가져옵니다."""
+    keys = connection_registry.pop_sessions(connectionId)
+    for key in keys:
+        session_store.remove(key)
+    logger.info('connection is closed', reason=reason, released_sessions=len(keys))
+
+def record_cancellation(streamer):
+    """생성이 중단된 답변의 token 수와, 예상 답변 길이 대비 생성하지 않은 token 수를 기록합니다."""
+    route = model_router.current
+    saved = max(ANSWER_TOKENS[route.category] - streamer.tokens, 0) if route is not None else 0
+    logger.metric('cancelled', 1, 'Count')
+    logger.metric('cancel_tokens_saved', saved, 'Count')
+    logger.info('generation is cancelled', 
+        model_id=route.model_id if route is not None else None,
+        output_tokens=streamer.tokens,
+        tokens_saved=saved)
+
+def find_answer(jsonBody):
+    """이 container의 recent_answers 또는 call log에 저장된 답변을 반환하며, 없으면 None입니다."""
+    requestId = jsonBody['request_id']
+    text = recent_answers.get((jsonBody.get('user_id'), requestId))  # 다른 사용자의 답변은 가져오지 않음
+    if text is None and 'user_id' in jsonBody and 'request_time' in jsonBody:  # 다른 container에서 생성된 답변
+        try:
+            dynamodb_client = get_client('dynamodb')
+            resp = dynamodb_client.get_item(
+                TableName=callLogTableName,
+                Key={
+                    'user_id': {'S': jsonBody['user_id']},
+                    'request_time': {'S': jsonBody['request_time']}
+                }
+            )
+            if 'Item' in resp and resp['Item']['request_id']['S'] == requestId:
+                text = decode_msg(resp['Item'])
+        except Exception:
+            logger.exception('error in find_answer')
+    return text
 
-def readStreamMsg(connectionId, requestId, stream):
-    print("[readStreamMsg]")
-    msg = ""
-    if stream:
-        for event in stream:
-            print('event: ', event)
-            msg = msg + event
-
-            result = {
-                'request_id': requestId,
-                'msg': msg
-            }
-            sendMessage(connectionId, result)
-    print('msg: ', msg)
-    return msg
+def resync(connectionId, jsonBody):
+    logger.debug('[resync]')
+    requestId = jsonBody['request_id']
+    
+    text = find_answer(jsonBody)
+    if text is None:
+        sendErrorMessage(connectionId, requestId, "답변을 다시 가져올 수 없습니다.")
+        return
+    sendResyncMessage(connectionId, requestId, text)
     
+def sendResyncMessage(connectionId, requestId, text):
+    frame = make_frame(requestId, 'resync', 0, 0, text)
+    frame['length'] = text_length(text)
+    frame['checksum'] = zlib.crc32(text.encode('utf-8'))
+    sendMessage(connectionId, frame)
+        
 def sendMessage(id, body):
-    print('[sendMessage]')
-    print(body)
+    logger.debug('[sendMessage]', body=body)
+    if connection_registry.is_dead(id):
+        raise ConnectionGone(id)
     try:
-        client.post_to_connection(
-            ConnectionId=id, 
-            Data=json.dumps(body, ensure_ascii=False)
-        )
+        with logger.span('websocket_send'):
+            client.post_to_connection(
+                ConnectionId=id, 
+                Data=json.dumps(body, ensure_ascii=False)
+            )
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') == 'GoneException':
+            connection_registry.mark_dead(id)
+            close_connection(id, 'GoneException')
+            raise ConnectionGone(id)
+        logger.exception('error in sendMessage')
+        raise Exception ("Not able to send a message")
     except Exception:
-        err_msg = traceback.format_exc()
-        print('err_msg: ', err_msg)
+        logger.exception('error in sendMessage')
         raise Exception ("Not able to send a message")
         
 def sendErrorMessage(connectionId, requestId, msg):
-    errorMsg = {
-        'request_id': requestId,
-        'msg': msg,
-        'status': 'error'
-    }
-    print('error: ', json.dumps(errorMsg))
+    errorMsg = make_frame(requestId, 'error', text=msg)
+    logger.warning('error frame', frame=errorMsg)
     sendMessage(connectionId, errorMsg)
 
-# 대화 기록을 저장할 딕셔너리
-map = dict()  # Conversation
-
-def getResponse(connectionId, jsonBody):
+class Turn:
+    """한번의 질문/답변으로, MSG_LENGTH로 잘라서 저장합니다."""
+    __slots__ = ('human', 'ai', 'size', 'request_time')
+    
+    def __init__(self, human, ai, request_time=""):
+        self.human = human[:MSG_LENGTH]
+        self.ai = ai[:MSG_LENGTH]
+        self.size = len(self.human.encode('utf-8')) + len(self.ai.encode('utf-8'))
+        self.request_time = request_time
+
+class Session:
+    __slots__ = ('key', 'turns', 'bytes', 'last_access', 'last_request_time', 'summary', 'summarized_until')
+    
+    def __init__(self, key, max_turns):
+        self.key = key
+        self.turns = collections.deque(maxlen=max_turns)
+        self.bytes = 0
+        self.last_access = time.time()
+        self.last_request_time = ""  # 마지막으로 반영된 이력의 request_time
+        self.summary = ""           # summarized_until까지의 turn에 대한 요약
+        self.summarized_until = ""
+
+class SessionMemoryStore:
+    """(userId, convType)별 대화 이력 저장소.
+
+    사용자 수가 max_sessions를 넘거나 전체 크기가 max_bytes를 넘으면 가장 오래 사용하지 않은 session부터 제거하고,
+    idle_ttl(초) 동안 사용하지 않은 session도 제거합니다.
+    """
+    def __init__(self, max_sessions, max_bytes, idle_ttl, max_turns):
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self.max_turns = max_turns
+        
+        self.sessions = collections.OrderedDict()
+        self.bytes = 0
+        self.lock = threading.Lock()
+        self.metrics = {'sessions': 0, 'bytes': 0, 'hit': 0, 'miss': 0, 'evicted_lru': 0, 'evicted_bytes': 0, 'evicted_idle': 0}
+        
+    def get(self, key):
+        with self.lock:
+            self._expire()
+            session = self.sessions.get(key)
+            if session is None:
+                self._count('miss')
+                return None
+            
+            session.last_access = time.time()
+            self.sessions.move_to_end(key)
+            self._count('hit')
+            return session
+        
+    def create(self, key):
+        session = Session(key, self.max_turns)
+        with self.lock:
+            self._pop(key)
+            self.sessions[key] = session
+            self._evict()
+        return session
+    
+    def remove(self, key):
+        with self.lock:
+            self._pop(key)
+            self._update_metrics()
+        
+    def add_turn(self, session, human, ai, request_time=""):
+        turn = Turn(human, ai, request_time)
+        with self.lock:
+            if request_time > session.last_request_time:
+                session.last_request_time = request_time
+
+            delta = turn.size
+            if len(session.turns) == session.turns.maxlen:
+                delta -= session.turns[0].size
+            session.turns.append(turn)
+            session.bytes += delta
+            
+            if self.sessions.get(session.key) is session:
+                self.bytes += delta
+                self._evict()
     
-    print('[getResponse]')
+    def set_summary(self, session, summary, until):
+        """until까지의 turn을 summary로 대체합니다."""
+        with self.lock:
+            if until < session.summarized_until:  # 더 최근의 요약이 이미 반영됨
+                return
+            delta = len(summary.encode('utf-8')) - len(session.summary.encode('utf-8'))
+            while session.turns and session.turns[0].request_time <= until:
+                delta -= session.turns.popleft().size
+            session.summary = summary
+            session.summarized_until = until
+            session.bytes += delta
+            
+            if self.sessions.get(session.key) is session:
+                self.bytes += delta
+                self._update_metrics()
+    
+    def _pop(self, key):
+        session = self.sessions.pop(key, None)
+        if session is not None:
+            self.bytes -= session.bytes
+        return session
+            
+    def _expire(self):
+        expire_time = time.time() - self.idle_ttl
+        while self.sessions:
+            key, session = next(iter(self.sessions.items()))
+            if session.last_access >= expire_time:
+                break
+            self._pop(key)
+            self._count('evicted_idle')
+        self._update_metrics()
+            
+    def _evict(self):
+        while len(self.sessions) > self.max_sessions:
+            self._pop(next(iter(self.sessions)))
+            self._count('evicted_lru')
+        while self.bytes > self.max_bytes and len(self.sessions) > 1:
+            self._pop(next(iter(self.sessions)))
+            self._count('evicted_bytes')
+        self._update_metrics()
+            
+    def _count(self, metric):
+        self.metrics[metric] += 1
+        logger.metric(f'session_{metric}', 1, 'Count')
+        
+    def _update_metrics(self):
+        self.metrics['sessions'] = len(self.sessions)
+        self.metrics['bytes'] = self.bytes
+
+session_store = SessionMemoryStore(SESSION_MAX_USERS, SESSION_MAX_BYTES, SESSION_IDLE_TTL, HISTORY_TURNS)
+
+def get_memory_chain(session):  # RAG
+    from langchain.memory import ConversationBufferWindowMemory
+    from langchain.schema import SystemMessage
+    memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=HISTORY_TURNS)
+    if session.summary:
+        memory_chain.chat_memory.add_message(SystemMessage(content=session.summary))
+    for turn in session.turns:
+        memory_chain.chat_memory.add_user_message(turn.human)
+        memory_chain.chat_memory.add_ai_message(turn.ai)
+    return memory_chain
+
+def get_memory_chat(session):  # general conversation
+    from langchain.memory import ConversationBufferWindowMemory
+    from langchain.schema import SystemMessage
+    memory_chat = ConversationBufferWindowMemory(human_prefix='Human', ai_prefix='Assistant', k=HISTORY_TURNS)
+    if session.summary:
+        memory_chat.chat_memory.add_message(SystemMessage(content=session.summary))
+    for turn in session.turns:
+        memory_chat.save_context({"input": turn.human}, {"output": turn.ai})
+    return memory_chat
+
+def getResponse(connectionId, jsonBody, streamer):
+    
+    logger.debug('[getResponse]')
 
     userId = jsonBody['user_id']
     body = jsonBody['body']
@@ -208,201 +1244,715 @@ def getResponse(connectionId, jsonBody):
     convType = jsonBody['conv_type'] # conversation type
     modelId = jsonBody['model_id']
     
-    global conversation, enableReference
-    global map_chain, map_chat, memory_chat, memory_chain
-    # global llm, modelId, enableReference, rag_type, conversation
-    # global parameters, map_chain, map_chat, memory_chat, memory_chain, debugMessageMode
-    
     reference = ""
         
-    # create memory
-    if convType=='qa':
-        if userId in map_chain:  
-            memory_chain = map_chain[userId]
-            print('memory_chain exist. reuse it!')
-        else: 
-            memory_chain = ConversationBufferWindowMemory(memory_key="chat_history", output_key='answer', return_messages=True, k=20)
-            map_chain[userId] = memory_chain
-            print('memory_chain does not exist. create new one!')
-
-            allowTime = getAllowTime()
-            load_chat_history(userId, allowTime, convType)
-
-    else:    # normal 
-        if userId in map_chat:  
-            memory_chat = map_chat[userId]
-            print('memory_chat exist. reuse it!')
-        else:
-            memory_chat = ConversationBufferWindowMemory(human_prefix='Human', ai_prefix='Assistant', k=20)
-            map_chat[userId] = memory_chat
-            print('memory_chat does not exist. create new one!')        
-
-            allowTime = getAllowTime()
-            load_chat_history(userId, allowTime, convType)
-        
-        conversation = ConversationChain(llm=llm, verbose=False, memory=memory_chat)
-    
-    # create memory
-    # if userId in map:  
-    #     print('memory exist. reuse it!')        
-    #     chat_memory = map[userId]
-    # else: 
-    #     print('memory does not exist. create new one!')        
-    #     chat_memory = ConversationBufferMemory(human_prefix='Human', ai_prefix='Assistant')
-    #     map[userId] = chat_memory
-
-    #     allowTime = getAllowTime()
-    #     load_chatHistory(userId, allowTime, convType)
-        
-    #     conversation = ConversationChain(llm=llm, verbose=False, memory=chat_memory)
+    # 사용자별 대화 이력 (convType별로 분리)
+    connection_registry.add_session(connectionId, (userId, convType))
+    session = session_store.get((userId, convType))
+    if session is None:
+        session = session_store.create((userId, convType))
+        logger.debug('session does not exist. create new one!')
+
+        allowTime = getAllowTime()
+        load_chat_history(session, userId, allowTime)
+    else:
+        logger.debug('session exist. reuse it!')
+        if jsonBody.get('last_request_time', '') > session.last_request_time:  # 이전 답변이 다른 container에서 생성됨
+            load_chat_history(session, userId, getAllowTime())
     
-    start = int(time.time())
+    start = time.perf_counter()
     
     msg = ""
     if type == 'text':
         text = body
+        language = get_language(text)
         
         if convType == 'qa':   # question & answering
-            msg, reference = get_answer_using_RAG(text, convType, connectionId, requestId)
+            msg, reference = get_answer_using_RAG(text, language, convType, connectionId, requestId, streamer, session, modelId)
         else: # general conversation
-            msg = get_answer_from_conversation(text, conversation, convType, connectionId, requestId)
+            route = model_router.route(text, convType, requested_model_id=modelId)
+            get_llm(route)
+            conversation = get_chain(language, convType, 'conversation', route.model_id)
+            conversation.memory = get_memory_chat(session)
+            msg = get_answer_from_conversation(text, conversation, convType, connectionId, requestId, streamer)
+            model_router.record(route, streamer)
+        
+        session_store.add_turn(session, text, msg, requestTime)
+        logger.metric('session_count', session_store.metrics['sessions'], 'Count')
+        logger.metric('session_bytes', session_store.metrics['bytes'], 'Bytes')
+        logger.debug('session store', **session_store.metrics)
+        history_summarizer.put(session, userId, requestId)
         
-    elapsed_time = int(time.time()) - start
-    print("total run time(sec): ", elapsed_time)
+    elapsed_time = time.perf_counter() - start
+    logger.metric('total', elapsed_time * 1000)
+    logger.info('total run time', elapsed_sec=round(elapsed_time, 3))
     
     return msg, reference
     
-def get_answer_from_conversation(text, conversation, convType, connectionId, requestId):
-    print('[get_answer_from_conversation]')
-    conversation.prompt = get_prompt_template(text, convType)
+def get_answer_from_conversation(text, conversation, convType, connectionId, requestId, streamer):
+    logger.debug('[get_answer_from_conversation]')
     try: 
         isTyping(connectionId, requestId) 
-        stream = conversation.predict(input=text)
+        stream = conversation.predict(input=text, callbacks=[streamer])
         msg = stream
+    except ConnectionGone:
+        raise
     except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)        
+        logger.exception('error in get_answer_from_conversation')
         
         raise Exception ("Not able to request to LLM")     
 
     return msg
     
 def isTyping(connectionId, requestId):    
-    msg_proceeding = {
-        'request_id': requestId,
-        'msg': '입력중...',
-        'status': 'istyping'
-    }
+    msg_proceeding = make_frame(requestId, 'typing', text='입력중...')
     sendMessage(connectionId, msg_proceeding)
         
-def load_chat_history(userId, allowTime, convType):
-    print('[load_chat_history]')
-    dynamodb_client = boto3.client('dynamodb')
-
-    response = dynamodb_client.query(
-        TableName=callLogTableName,
-        KeyConditionExpression='user_id = :userId AND request_time > :allowTime',
-        ExpressionAttributeValues={
+def load_chat_history(session, userId, allowTime):
+    """최신 HISTORY_TURNS개의 이력만 역순으로 가져오며, session에 이미 이력이 있으면 그 이후의 이력만 가져옵니다."""
+    logger.debug('[load_chat_history]')
+    dynamodb_client = get_client('dynamodb')
+    
+    since = max(allowTime, session.last_request_time)
+    params = {
+        'TableName': callLogTableName,
+        'KeyConditionExpression': '#user_id = :userId AND #request_time > :allowTime',
+        'ProjectionExpression': '#request_time, #body, #msg, #msg_z, #type, #summary, #summarized_until',
+        'ExpressionAttributeNames': {
+            '#user_id': 'user_id',
+            '#request_time': 'request_time',
+            '#body': 'body',
+            '#msg': 'msg',
+            '#msg_z': 'msg_z',
+            '#type': 'type',
+            '#summary': 'summary',
+            '#summarized_until': 'summarized_until'
+        },
+        'ExpressionAttributeValues': {
             ':userId': {'S': userId},
-            ':allowTime': {'S': allowTime}
-        }
-    )
-
-    for item in response['Items']:
-        text = item['body']['S']
+            ':allowTime': {'S': since}
+        },
+        'ScanIndexForward': False,  # 최신 이력부터
+        'Limit': HISTORY_TURNS
+    }
+    
+    items = []
+    summary = None  # 가장 최근의 요약. 그 이전의 이력은 요약에 포함되어 있으므로 가져오지 않음
+    while len(items) < HISTORY_TURNS and summary is None:
+        with logger.span('history_load'):
+            response = dynamodb_client.query(**params)
+        for item in response['Items']:
+            if item['type']['S'] == 'summary':
+                summary = item
+                break
+            if item['type']['S'] == 'text':
+                items.append(item)
+                if len(items) >= HISTORY_TURNS:
+                    break
+            
+        if 'LastEvaluatedKey' not in response:
+            break
+        params['ExclusiveStartKey'] = response['LastEvaluatedKey']
+    logger.debug('history', count=len(items))
+
+    if summary is not None:
+        session_store.set_summary(session, summary['summary']['S'], summary['summarized_until']['S'])
+    for item in reversed(items):
+        text, msg = decode_history_item(item)
+        session_store.add_turn(session, text, msg, item['request_time']['S'])
+
+def decode_history_item(item):
+    text = item['body']['S'][:MSG_LENGTH]
+    msg = decode_msg(item, MSG_LENGTH)
+    return text, msg
+
+def decode_msg(item, length=None):
+    """call log의 답변을 반환하며, 압축된 경우(msg_z) length 글자만큼만 압축을 풉니다."""
+    if 'msg_z' not in item:
         msg = item['msg']['S']
-        type = item['type']['S']
-
-        if type == 'text':
-            if convType=='qa':
-                memory_chain.chat_memory.add_user_message(text)
-                if len(msg) > MSG_LENGTH:
-                    memory_chain.chat_memory.add_ai_message(msg[:MSG_LENGTH])                         
-                else:
-                    memory_chain.chat_memory.add_ai_message(msg)                       
+        return msg[:length] if length else msg
+    
+    if length:
+        data = zlib.decompressobj().decompress(item['msg_z']['B'], length*4)  # UTF-8은 글자당 최대 4 bytes
+        return data.decode('utf-8', errors='ignore')[:length]
+    return zlib.decompress(item['msg_z']['B']).decode('utf-8')
+
+embeddings = None
+def get_embeddings():
+    global embeddings
+    if embeddings is None:
+        from langchain.embeddings import BedrockEmbeddings
+        embeddings = BedrockEmbeddings(
+            client=boto3_bedrock,
+            region_name=bedrock_region,
+            model_id=embedding_model_id
+        )
+    return embeddings
+
+class LRUCache:
+    """container 내부의 LRU cache.
+
+    항목 수가 max_size를 넘거나 크기의 합이 max_bytes를 넘으면 오래된 항목부터 제거하고,
+    ttl(초)이 지난 항목은 조회할 때 제거합니다.
+    """
+    def __init__(self, max_size, ttl, max_bytes=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+        
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            value, expire_at, size = item
+            if expire_at < time.time():
+                del self.items[key]
+                self.bytes -= size
+                return None
+            self.items.move_to_end(key)
+            return value
+        
+    def put(self, key, value, ttl=None):
+        size = len(json.dumps(value, ensure_ascii=False).encode('utf-8')) if self.max_bytes else 0
+        with self.lock:
+            if key in self.items:
+                self.bytes -= self.items[key][2]
+            self.items[key] = (value, time.time() + (ttl or self.ttl), size)
+            self.items.move_to_end(key)
+            self.bytes += size
+            
+            while self.items and (len(self.items) > self.max_size or (self.max_bytes and self.bytes > self.max_bytes)):
+                _, (_, _, evicted) = self.items.popitem(last=False)
+                self.bytes -= evicted
+                
+    def __len__(self):
+        return len(self.items)
+
+class DynamoDBCache:
+    """container 간에 공유되는 cache로, expire_at을 DynamoDB TTL attribute로 사용합니다."""
+    def __init__(self, table_name, ttl):
+        self.table_name = table_name
+        self.ttl = ttl
+        
+    def get(self, key):
+        try:
+            resp = get_client('dynamodb').get_item(
+                TableName=self.table_name,
+                Key={'cache_key': {'S': key}}
+            )
+        except Exception:
+            logger.exception('error in DynamoDBCache.get')
+            return None
+        
+        item = resp.get('Item')
+        if item is None or int(item['expire_at']['N']) < time.time():
+            return None
+        return json.loads(item['value']['S'])
+        
+    def put(self, key, value, ttl=None):
+        try:
+            get_client('dynamodb').put_item(
+                TableName=self.table_name,
+                Item={
+                    'cache_key': {'S': key},
+                    'value': {'S': json.dumps(value, ensure_ascii=False)},
+                    'expire_at': {'N': str(int(time.time() + (ttl or self.ttl)))}
+                }
+            )
+        except Exception:
+            logger.exception('error in DynamoDBCache.put')
+
+class NoCache:
+    def get(self, key):
+        return None
+    
+    def put(self, key, value, ttl=None):
+        pass
+
+def create_cache_backend(backend, max_size, ttl, table_name):
+    if backend == 'dynamodb' and table_name:
+        return DynamoDBCache(table_name, ttl)
+    elif backend == 'memory':
+        return LRUCache(max_size, ttl)
+    else:
+        return NoCache()
+
+pattern_punctuation = re.compile(r'[^\w\s]')
+pattern_whitespace = re.compile(r'\s+')
+def normalize_query(query):
+    # NFKC: 호환용 자모(ㄱ, ㅏ)를 조합형으로 바꾸고 자모 시퀀스를 음절로 합침
+    query = unicodedata.normalize('NFKC', str(query)).lower()
+    query = pattern_punctuation.sub(' ', query)
+    return pattern_whitespace.sub(' ', query).strip()
+
+def get_doc_fingerprint(relevant_docs):
+    ids = []
+    for doc in relevant_docs:
+        metadata = doc['metadata']
+        ids.append(metadata.get('document_id') or metadata.get('source', '') + metadata.get('title', ''))
+    return hashlib.sha1("\n".join(sorted(ids)).encode('utf-8')).hexdigest()
+
+class AnswerCache:
+    """RAG 답변 cache.
+
+    exact tier는 정규화된 질문으로, semantic tier는 BedrockEmbeddings + FAISS로 유사한 질문을 찾으며
+    두 경우 모두 검색된 문서의 fingerprint가 같을 때만 hit로 처리합니다.
+    """
+    def __init__(self, backend, semantic, threshold, max_size):
+        self.backend = backend
+        self.semantic = semantic
+        self.threshold = threshold
+        self.max_size = max_size
+        
+        self.embeddings = None
+        self.vectorstore = None
+        self.vectors = collections.deque(maxlen=max_size)  # (normalized query, embedding, key)
+        self.indexed = 0
+        self.lock = threading.Lock()
+        self.metrics = {'exact_hit': 0, 'semantic_hit': 0, 'stale': 0, 'miss': 0}
+    
+    def _embed(self, text):
+        self.embeddings = get_embeddings()
+        return self.embeddings.embed_query(text)
+    
+    def _search(self, embedding):
+        with self.lock:
+            if self.vectorstore is None:
+                return None, 0
+            docs = self.vectorstore.similarity_search_with_score_by_vector(embedding, k=1)
+        if not docs:
+            return None, 0
+        doc, score = docs[0]
+        return doc.metadata['key'], 1 - score / 2  # normalize_L2 이므로 squared L2 distance를 cosine similarity로 변환
+    
+    def _index(self, normalized, embedding, key):
+        with self.lock:
+            self.vectors.append((normalized, embedding, key))
+            
+            if self.vectorstore is None or self.indexed >= 2 * self.max_size:  # 제거된 항목이 쌓이면 다시 생성
+                from langchain.vectorstores.faiss import FAISS
+                self.vectorstore = FAISS.from_embeddings(
+                    text_embeddings=[(text, vector) for text, vector, _ in self.vectors],
+                    embedding=self.embeddings,
+                    metadatas=[{'key': k} for _, _, k in self.vectors],
+                    normalize_L2=True
+                )
+                self.indexed = len(self.vectors)
             else:
-                if len(msg) > MSG_LENGTH:
-                    memory_chat.save_context({"input": text}, {"output": msg[:MSG_LENGTH]})
-                else:
-                    memory_chat.save_context({"input": text}, {"output": msg})
+                self.vectorstore.add_embeddings(text_embeddings=[(normalized, embedding)], metadatas=[{'key': key}])
+                self.indexed += 1
+    
+    def _count(self, metric):
+        self.metrics[metric] += 1
+        logger.metric(f'answer_cache_{metric}', 1, 'Count')
+        logger.debug('answer cache', **self.metrics)
+        
+    def lookup(self, query, fingerprint):
+        """(cached answer, query embedding)을 반환하며, embedding은 store()에서 재사용합니다."""
+        normalized = normalize_query(query)
+        key = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        
+        entry = self.backend.get(key)
+        if entry is not None:
+            if entry['fingerprint'] == fingerprint:
+                self._count('exact_hit')
+                return entry, None
+            self._count('stale')
+        
+        embedding = None
+        if self.semantic == 'true':
+            try:
+                embedding = self._embed(normalized)
+                similar_key, similarity = self._search(embedding)
+                logger.debug('similar query', key=similar_key, similarity=similarity)
                 
-            chat_memory.save_context({"input": text}, {"output": msg}) 
+                if similar_key and similarity >= self.threshold:
+                    entry = self.backend.get(similar_key)
+                    if entry is not None and entry['fingerprint'] == fingerprint:
+                        self._count('semantic_hit')
+                        return entry, embedding
+            except Exception:
+                logger.exception('error in AnswerCache.lookup')
+        
+        self._count('miss')
+        return None, embedding
+    
+    def store(self, query, fingerprint, msg, embedding=None):
+        normalized = normalize_query(query)
+        key = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        
+        self.backend.put(key, {
+            'query': normalized,
+            'fingerprint': fingerprint,
+            'msg': msg
+        })
+        if embedding is not None:
+            try:
+                self._index(normalized, embedding, key)
+            except Exception:
+                logger.exception('error in AnswerCache.store')
 
-def get_answer_using_RAG(text, convType, connectionId, requestId):    
-    print('[get_answer_using_RAG]')
-    reference = ""
-    if rag_method == 'RetrievalQA': # RetrievalQA
-        revised_question = get_revised_question(connectionId, requestId, text) 
-        print('revised_question: ', revised_question)
-        PROMPT = get_prompt_template(revised_question, convType)
+answer_cache = AnswerCache(
+    backend=create_cache_backend(ANSWER_CACHE_BACKEND, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL, answerCacheTableName),
+    semantic=SEMANTIC_CACHE if ANSWER_CACHE_BACKEND != 'none' else 'false',
+    threshold=SEMANTIC_CACHE_THRESHOLD,
+    max_size=ANSWER_CACHE_SIZE
+)
+
+class RetrievalCache:
+    """검색 결과(relevant_docs) cache.
+
+    container 내부의 LRU(local)를 먼저 확인하고 retrievalCacheTableName이 있으면 DynamoDB(shared)를 확인합니다.
+    결과가 없는 검색([])도 negative_ttl 동안 cache하여 알려진 miss에 대해 다시 검색하지 않습니다.
+    """
+    def __init__(self, local, shared, negative_ttl):
+        self.local = local
+        self.shared = shared
+        self.negative_ttl = negative_ttl
+        self.metrics = {'hit': 0, 'negative_hit': 0, 'miss': 0}
+        
+    def get(self, key):
+        relevant_docs = self.local.get(key)
+        if relevant_docs is None and self.shared is not None:
+            relevant_docs = self.shared.get(key)
+            if relevant_docs is not None:
+                self.local.put(key, relevant_docs, None if relevant_docs else self.negative_ttl)
+        
+        if relevant_docs is None:
+            metric = 'miss'
+        elif relevant_docs:
+            metric = 'hit'
+        else:
+            metric = 'negative_hit'
+        self.metrics[metric] += 1
+        logger.metric(f'retrieval_cache_{metric}', 1, 'Count')
+        logger.debug('retrieval cache', **self.metrics)
+        return relevant_docs
+    
+    def put(self, key, relevant_docs):
+        ttl = None if relevant_docs else self.negative_ttl
+        self.local.put(key, relevant_docs, ttl)
+        if self.shared is not None:
+            self.shared.put(key, relevant_docs, ttl)
+
+def get_retrieval_cache_key(source, query, top_k=None):
+    if source == 'kendra':
+        parts = [source, kendraIndex, normalize_query(query), str(top_k), json.dumps(KENDRA_ATTRIBUTE_FILTER, sort_keys=True)]
+    else:
+        parts = [source, normalize_query(query)]
+    return hashlib.sha1("\n".join(parts).encode('utf-8')).hexdigest()
 
-        retriever = kendraRetriever
+retrieval_cache = RetrievalCache(
+    local=LRUCache(RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL, RETRIEVAL_CACHE_BYTES),
+    shared=DynamoDBCache(retrievalCacheTableName, RETRIEVAL_CACHE_TTL) if retrievalCacheTableName else None,
+    negative_ttl=RETRIEVAL_NEGATIVE_TTL
+)
 
-        qa = RetrievalQA.from_chain_type(
-            llm=llm,
-            chain_type="stuff",
-            retriever=retriever,
-            return_source_documents=True,
-            chain_type_kwargs={"prompt": PROMPT}
+def is_conditional_check_failed(e):
+    return isinstance(e, ClientError) and e.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+class Flight:
+    """leader가 생성 중인 답변. FrameBatcher가 poll()로 새로 등록된 follower를 가져옵니다."""
+    def __init__(self, single_flight, key, requestId):
+        self.single_flight = single_flight
+        self.key = key
+        self.requestId = requestId
+        self.known = set()  # 이미 가져온 follower requestId
+        self.polled_at = time.time()
+        
+    def poll(self, force=False):
+        """FLIGHT_POLL_INTERVAL마다 새로 등록된 follower의 (connectionId, requestId)를 반환합니다."""
+        if not force and time.time() - self.polled_at < self.single_flight.poll_interval:
+            return []
+        self.polled_at = time.time()
+        followers = [(c, r) for c, r in self.single_flight.get_followers(self.key) if r not in self.known]
+        self.known.update(r for _, r in followers)
+        return followers
+    
+    def complete(self, msg, reference, served):
+        self.single_flight.complete(self.key, self.requestId, msg, reference, served)
+        
+    def abort(self):
+        self.single_flight.release(self.key, self.requestId)
+
+class SingleFlight:
+    """DynamoDB의 conditional write로 같은 key의 답변을 하나의 leader만 생성하도록 합니다.
+
+    처음 도착한 요청은 leader가 되어 답변을 생성하고, 뒤에 도착한 follower는 item의 followers에 자신의 connection을
+    등록한 후 leader가 완료될 때까지 기다립니다. leader는 follower에게도 frame을 전송하고, 완료되면 답변과
+    전송한 follower(served)를 저장합니다. served에 없는 follower는 저장된 답변을 직접 전송하며,
+    leader가 실패하거나 응답이 없으면(ttl) 직접 답변을 생성합니다.
+    """
+    def __init__(self, table_name, ttl, poll_interval, request_ttl):
+        self.table_name = table_name
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.request_ttl = request_ttl
+        
+    def join(self, key, connectionId, requestId):
+        """(leader이면 Flight, follower로 등록되었는지)를 반환하며, 실패하면 (None, False)입니다."""
+        dynamodb_client = get_client('dynamodb')
+        now = int(time.time())
+        try:
+            dynamodb_client.put_item(
+                TableName=self.table_name,
+                Item={
+                    'flight_key': {'S': key},
+                    'leader': {'S': requestId},
+                    'status': {'S': 'running'},
+                    'expire_at': {'N': str(now + self.ttl)}
+                },
+                ConditionExpression='attribute_not_exists(flight_key) OR expire_at < :now',
+                ExpressionAttributeValues={':now': {'N': str(now)}}
+            )
+            return Flight(self, key, requestId), False
+        except Exception as e:
+            if not is_conditional_check_failed(e):
+                logger.exception('error in SingleFlight.join')
+                return None, False
+        
+        try:
+            dynamodb_client.update_item(
+                TableName=self.table_name,
+                Key={'flight_key': {'S': key}},
+                UpdateExpression='SET followers = list_append(if_not_exists(followers, :empty), :follower)',
+                ConditionExpression='#status = :running',
+                ExpressionAttributeNames={'#status': 'status'},
+                ExpressionAttributeValues={
+                    ':empty': {'L': []},
+                    ':follower': {'L': [{'M': {'connection_id': {'S': connectionId}, 'request_id': {'S': requestId}}}]},
+                    ':running': {'S': 'running'}
+                }
+            )
+        except Exception as e:
+            if not is_conditional_check_failed(e):  # 이미 완료된 경우는 wait()에서 저장된 답변을 사용
+                logger.exception('error in SingleFlight.join')
+                return None, False
+        return None, True
+    
+    def _get(self, key):
+        resp = get_client('dynamodb').get_item(
+            TableName=self.table_name,
+            Key={'flight_key': {'S': key}},
+            ConsistentRead=True
         )
+        return resp.get('Item')
+    
+    def get_followers(self, key):
+        try:
+            item = self._get(key) or {}
+        except Exception:
+            logger.exception('error in SingleFlight.get_followers')
+            return []
+        return [(f['M']['connection_id']['S'], f['M']['request_id']['S']) for f in item.get('followers', {}).get('L', [])]
+    
+    def wait(self, key, requestId):
+        """leader가 완료하면 (msg, reference, served)를, 실패하거나 ttl이 지나면 None을 반환합니다."""
+        deadline = time.time() + self.ttl
+        while time.time() < deadline:
+            try:
+                item = self._get(key)
+            except Exception:
+                logger.exception('error in SingleFlight.wait')
+                return None
+            if item is None or int(item['expire_at']['N']) < time.time():  # leader가 실패함
+                return None
+            if item['status']['S'] == 'done':
+                served = requestId in [r['S'] for r in item.get('served', {}).get('L', [])]
+                return item['msg']['S'], item['reference']['S'], served
+            time.sleep(self.poll_interval)
+        return None
+    
+    def complete(self, key, requestId, msg, reference, served):
+        try:
+            get_client('dynamodb').update_item(
+                TableName=self.table_name,
+                Key={'flight_key': {'S': key}},
+                UpdateExpression='SET #status = :done, msg = :msg, #reference = :reference, served = :served',
+                ConditionExpression='leader = :leader',
+                ExpressionAttributeNames={'#status': 'status', '#reference': 'reference'},
+                ExpressionAttributeValues={
+                    ':done': {'S': 'done'},
+                    ':msg': {'S': msg},
+                    ':reference': {'S': reference},
+                    ':served': {'L': [{'S': r} for r in served]},
+                    ':leader': {'S': requestId}
+                }
+            )
+        except Exception:
+            logger.exception('error in SingleFlight.complete')
+            
+    def release(self, key, requestId):
+        try:
+            get_client('dynamodb').delete_item(
+                TableName=self.table_name,
+                Key={'flight_key': {'S': key}},
+                ConditionExpression='leader = :leader',
+                ExpressionAttributeValues={':leader': {'S': requestId}}
+            )
+        except Exception:
+            logger.exception('error in SingleFlight.release')
+            
+    def claim_request(self, userId, requestId):
+        """사용자의 처음 도착한 request_id이면 True를 반환합니다."""
+        try:
+            get_client('dynamodb').put_item(
+                TableName=self.table_name,
+                Item={
+                    'flight_key': {'S': f'request#{userId}#{requestId}'},
+                    'expire_at': {'N': str(int(time.time()) + self.request_ttl)}
+                },
+                ConditionExpression='attribute_not_exists(flight_key)'
+            )
+        except Exception as e:
+            if is_conditional_check_failed(e):
+                return False
+            logger.exception('error in SingleFlight.claim_request')
+        return True
+    
+    def release_request(self, userId, requestId):
+        """답변하지 못한 요청은 재전송되면 다시 처리합니다."""
+        try:
+            get_client('dynamodb').delete_item(
+                TableName=self.table_name,
+                Key={'flight_key': {'S': f'request#{userId}#{requestId}'}}
+            )
+        except Exception:
+            logger.exception('error in SingleFlight.release_request')
+
+single_flight = SingleFlight(inflightTableName, FLIGHT_TTL, FLIGHT_POLL_INTERVAL, REQUEST_DEDUPE_TTL) if inflightTableName and SINGLE_FLIGHT == 'true' else None
+
+def get_flight_key(question, fingerprint, convType, model_id):
+    """이전 대화와 무관한 질문은 검색 전에 (질문, 요청한 model)로, 그 외에는 다시 작성된 질문, 문서 fingerprint, 선택된 model로 key를 만듭니다."""
+    parts = [normalize_query(question), fingerprint, convType, model_id]
+    return hashlib.sha1("\n".join(parts).encode('utf-8')).hexdigest()
+
+recent_requests = collections.OrderedDict()  # (user_id, request_id) -> 도착 시간
+
+def is_duplicate_request(userId, requestId):
+    """double-click이나 재전송으로 사용자의 같은 request_id가 다시 도착했는지 확인합니다."""
+    key = (userId, requestId)
+    if key in recent_requests:
+        return True
+    recent_requests[key] = time.time()
+    while len(recent_requests) > RECENT_REQUEST_COUNT:
+        recent_requests.popitem(last=False)
+    return single_flight is not None and not single_flight.claim_request(userId, requestId)
+
+def release_request(userId, requestId):
+    recent_requests.pop((userId, requestId), None)
+    if single_flight is not None:
+        single_flight.release_request(userId, requestId)
+
+def join_flight(flight_key, connectionId, requestId, streamer):
+    """follower이면 leader가 생성한 (msg, reference)를 반환하고, leader이면 streamer에 flight를 설정하고 None을 반환합니다."""
+    flight, following = single_flight.join(flight_key, connectionId, requestId)
+    if following:  # 같은 답변을 생성 중인 leader가 있음
+        isTyping(connectionId, requestId)
+        result = single_flight.wait(flight_key, requestId)
+        if result is not None:
+            msg, reference, streamer.served = result
+            logger.info('single flight', role='follower', served=streamer.served)
+            logger.metric('single_flight_follower', 1, 'Count')
+            return msg, reference
+        logger.info('single flight leader is gone. generate the answer')
+    streamer.batcher.flight = flight
+    return None
+
+def get_answer_using_RAG(text, language, convType, connectionId, requestId, streamer, session, requestedModelId=None):    
+    logger.debug('[get_answer_using_RAG]')
+    reference = ""
+    if rag_method == 'RetrievalQA': # RetrievalQA
+        revised_question = get_revised_question(connectionId, requestId, text, language, session) 
+        logger.info('revised_question', question=revised_question)
+
+        route = model_router.route(revised_question, convType, requested_model_id=requestedModelId)
+        get_llm(route)
+        qa = get_chain(language, convType, 'RetrievalQA', route.model_id)
         isTyping(connectionId, requestId) 
-        result = qa({"query": revised_question})    
-        print('result: ', result)
+        result = qa({"query": revised_question}, callbacks=[streamer])    
+        model_router.record(route, streamer)
+        logger.debug('result', result=result)
         msg = result['result']
 
         source_documents = result['source_documents']
-        print('source_documents: ', source_documents)
+        logger.debug('source_documents', source_documents=source_documents)
 
         if len(source_documents)>=1 and enableReference=='true':
             reference = get_reference(source_documents, rag_method)    
 
     elif rag_method == 'ConversationalRetrievalChain': # ConversationalRetrievalChain
-        PROMPT = get_prompt_template(text, convType)
-        qa = create_ConversationalRetrievalChain(PROMPT, retriever=kendraRetriever)            
+        route = model_router.route(text, convType, requested_model_id=requestedModelId)
+        get_llm(route)
+        qa = get_chain(language, convType, 'ConversationalRetrievalChain', route.model_id)
+        qa.memory = get_memory_chain(session)
 
-        result = qa({"question": text})
+        result = qa({"question": text}, callbacks=[streamer])
+        model_router.record(route, streamer)
         
         msg = result['answer']
-        print('\nquestion: ', result['question'])    
-        print('answer: ', result['answer'])    
-        print('source_documents: ', result['source_documents']) 
+        logger.debug('result', question=result['question'], answer=result['answer'], source_documents=result['source_documents'])
 
         if len(result['source_documents'])>=1 and enableReference=='true':
             reference = get_reference(result['source_documents'], rag_method)
     
     elif rag_method == 'RetrievalPrompt': # RetrievalPrompt
-        # revised_question = get_revised_question(connectionId, requestId, text) # generate new prompt using chat history
-        revised_question = text # 임시 수정
-        print('revised_question: ', revised_question)      
-
-        relevant_docs = retrieve_from_Kendra(query=revised_question, top_k=top_k)
-        print('relevant_docs: ', json.dumps(relevant_docs))
-        
-        if len(relevant_docs) == 0:
-            print('No relevant document! So use naver api')
-            relevant_docs = retrieve_from_naver_search_api(revised_question)
-
-        relevant_context = ""
-        for document in relevant_docs:
-            relevant_context = relevant_context + document['metadata']['excerpt'] + "\n\n"
-        print('relevant_context: ', relevant_context)
-
-        PROMPT = get_prompt_template(revised_question, convType)
-        #print('PROMPT: ', PROMPT)
-        try: 
-            isTyping(connectionId, requestId) 
-            stream = llm(PROMPT.format(context=relevant_context, question=revised_question))
-            msg = stream
-        except Exception:
-            err_msg = traceback.format_exc()
-            print('error message: ', err_msg)       
-            raise Exception ("Not able to request to LLM")    
+        if single_flight is not None and not needs_condensation(text, session):  # 이전 대화와 무관한 질문은 검색 전에 같은 질문의 leader를 찾음
+            result = join_flight(get_flight_key(text, '', convType, requestedModelId or ''), connectionId, requestId, streamer)
+            if result is not None:
+                return result
+        
+        candidate_k = top_k * RERANK_FETCH_FACTOR if RERANK == 'true' else top_k
+        revised_question, relevant_docs = retrieve_with_condensation(connectionId, requestId, text, language, session, candidate_k)
+        logger.info('revised_question', question=revised_question)
+
+        faq_doc = get_faq_doc(revised_question, relevant_docs)
+        if faq_doc is not None:
+            msg = get_answer_from_faq(revised_question, language, faq_doc, connectionId, requestId, streamer, requestedModelId)
+            if enableReference=='true' and faq_doc['metadata']['title']:
+                reference = get_reference([faq_doc], rag_method)
+            return msg, reference
+
+        if RERANK == 'true':
+            relevant_docs = rerank_documents(revised_question, relevant_docs, top_k)
+        logger.debug('relevant_docs', relevant_docs=relevant_docs)
+        
+        fingerprint = get_doc_fingerprint(relevant_docs)
+        cached, embedding = answer_cache.lookup(revised_question, fingerprint)
+        if cached:
+            msg = cached['msg']
+            streamer.write(msg)
+        else:
+            PROMPT = get_prompt_template(language, convType)
+            relevant_context, relevant_docs, stats = pack_context(PROMPT, revised_question, relevant_docs)
+            logger.info('prompt tokens', **stats)
+            logger.debug('relevant_context', context=relevant_context)
+
+            route = model_router.route(revised_question, convType, is_faq_hit(relevant_docs), requestedModelId)
+            if single_flight is not None and streamer.flight is None:  # 다시 작성된 질문과 검색된 문서로 leader를 찾음
+                result = join_flight(get_flight_key(revised_question, fingerprint, convType, route.model_id), connectionId, requestId, streamer)
+                if result is not None:
+                    return result
+            
+            try: 
+                isTyping(connectionId, requestId) 
+                stream = get_llm(route)(PROMPT.format(context=relevant_context, question=revised_question), callbacks=[streamer])
+                msg = stream
+                model_router.record(route, streamer)
+            except ConnectionGone:
+                raise
+            except Exception:
+                logger.exception('error in get_answer_using_RAG')
+                raise Exception ("Not able to request to LLM")    
+            
+            answer_cache.store(revised_question, fingerprint, msg, embedding)
 
         if len(relevant_docs)>=1 and enableReference=='true':
             reference = get_reference(relevant_docs, rag_method)
-
-    memory_chain.chat_memory.add_user_message(text)  
-    memory_chain.chat_memory.add_ai_message(msg)
     
     return msg, reference
     
@@ -415,29 +1965,32 @@ def retrieve_from_naver_search_api(query):
     naver_client_id = os.environ.get('naver_client_id')
     naver_client_secret = os.environ.get('naver_client_secret')
     
-    encText = urllib.parse.quote(query)
-    url = "https://openapi.naver.com/v1/search/blog.json?query=" + encText
-    request = urllib.request.Request(url)
-    request.add_header("X-Naver-Client-Id", naver_client_id)
-    request.add_header("X-Naver-Client-Secret", naver_client_secret)
+    key = get_retrieval_cache_key('naver', query)
+    relevant_docs = retrieval_cache.get(key)
+    if relevant_docs is not None:
+        logger.debug('retrieval cache hit', source='naver', count=len(relevant_docs))
+        return relevant_docs
     
     relevant_docs = []
     
     try:
-        response = urllib.request.urlopen(request)
+        with logger.span('naver'):
+            response = get_naver_http().request(
+                'GET', 
+                NAVER_API_URL, 
+                fields={'query': query},
+                headers={
+                    "X-Naver-Client-Id": naver_client_id,
+                    "X-Naver-Client-Secret": naver_client_secret
+                }
+            )
         
-        rescode = response.getcode()
+        rescode = response.status
         if(rescode==200):
-            response_body = response.read()
-            result = json.loads(response_body.decode('utf-8'))
-            print(result)
+            result = json.loads(response.data.decode('utf-8'))
+            logger.debug('naver result', result=result)
             if "items" in result:
-                print('testing...')
                 for item in result['items']:
-                    
-                    # test
-                    print(item)
-                    
                     doc_info = {
                         "rag_type": 'search',
                         "api_type": "naver api",
@@ -452,115 +2005,602 @@ def retrieve_from_naver_search_api(query):
                     }
                     relevant_docs.append(doc_info)
             else:
-                print("No 'items' found in the API response")
+                logger.warning("No 'items' found in the API response")
+            retrieval_cache.put(key, relevant_docs)
         else:
-            print(f"Error: Naver API returned status code {rescode}")
-    except Exception as e:
-        print(f"Error in retrieve_from_naver_search_api: {str(e)}")
+            logger.error('Naver API returned an error', status=rescode)
+    except Exception:
+        logger.exception('error in retrieve_from_naver_search_api')
     
     return relevant_docs
-    
-def get_revised_question(connectionId, requestId, query):    
-    print('[get_revised_question]')
-    # check korean
-    pattern_hangul = re.compile('[\u3131-\u3163\uac00-\ud7a3]+')
-    word_kor = pattern_hangul.search(str(query))
-    print('word_kor: ', word_kor)
 
-    if word_kor and word_kor != 'None':
-        condense_template = """
-        <history>
-        {chat_history}
-        </history>
-
-        Human: <history>를 참조하여, 다음의 <question>의 뜻을 명확히 하는 새로운 질문을 한국어로 생성하세요. 새로운 질문은 원래 질문의 중요한 단어를 반드시 포함합니다.
+vector_index = None
+vector_index_state = 'unloaded'  # unloaded, loaded, unavailable
+lexical_index = None
+lexical_index_state = 'unloaded'
+vector_index_lock = threading.Lock()
+
+def download_vector_index(s3_uri, path):
+    import local_index
+    logger.debug('[download_vector_index]')
+    bucket, _, prefix = s3_uri[len('s3://'):].partition('/')
+    s3_client = get_client('s3')
+    
+    os.makedirs(path, exist_ok=True)
+    for name in [local_index.META_FILE, local_index.STORE_FILE, local_index.OFFSETS_FILE, local_index.FAISS_FILE, local_index.LEXICAL_FILE]:
+        key = f"{prefix.rstrip('/')}/{name}" if prefix else name
+        try:
+            s3_client.download_file(bucket, key, os.path.join(path, name))
+        except ClientError:
+            if name in [local_index.FAISS_FILE, local_index.LEXICAL_FILE]:  # vector 또는 lexical index만 있는 경우
+                logger.warning('index file is not found', name=name, s3_uri=s3_uri)
+            else:
+                raise
+
+def ensure_local_index():
+    import local_index
+    if not os.path.exists(os.path.join(VECTOR_INDEX_PATH, local_index.META_FILE)) and VECTOR_INDEX_S3_URI:
+        download_vector_index(VECTOR_INDEX_S3_URI, VECTOR_INDEX_PATH)
+
+def get_vector_index():
+    global vector_index, vector_index_state
+    import local_index
+    if vector_index_state != 'unloaded':
+        return vector_index
+    
+    with vector_index_lock:
+        if vector_index_state == 'unloaded':
+            vector_index_state = 'unavailable'
+            if VECTOR_INDEX_PATH:
+                try:
+                    ensure_local_index()
+                    if os.path.exists(os.path.join(VECTOR_INDEX_PATH, local_index.FAISS_FILE)):
+                        vector_index = local_index.VectorIndex(VECTOR_INDEX_PATH)
+                        vector_index_state = 'loaded'
+                        logger.info('vector index', meta=vector_index.meta)
+                except Exception:
+                    logger.exception('error in get_vector_index')
+    return vector_index
+
+def get_lexical_index():
+    global lexical_index, lexical_index_state
+    import local_index
+    if lexical_index_state != 'unloaded':
+        return lexical_index
+    
+    with vector_index_lock:
+        if lexical_index_state == 'unloaded':
+            lexical_index_state = 'unavailable'
+            if VECTOR_INDEX_PATH:
+                try:
+                    ensure_local_index()
+                    if os.path.exists(os.path.join(VECTOR_INDEX_PATH, local_index.LEXICAL_FILE)):
+                        lexical_index = local_index.LexicalIndex(VECTOR_INDEX_PATH)
+                        lexical_index_state = 'loaded'
+                        logger.info('lexical index', count=lexical_index.count, terms=len(lexical_index.terms))
+                except Exception:
+                    logger.exception('error in get_lexical_index')
+    return lexical_index
+
+vector_embeddings = None
+def get_vector_embeddings():
+    global vector_embeddings
+    import local_index
+    if vector_embeddings is None:
+        if VECTOR_EMBEDDER == 'hash':
+            index = get_vector_index()
+            vector_embeddings = local_index.HashingEmbeddings(index.dim if index is not None else 256)
+        else:
+            vector_embeddings = get_embeddings()
+    return vector_embeddings
+
+def get_confidence(score):  # cosine similarity를 Kendra의 ScoreConfidence 단계로 변환
+    if score >= 0.9:
+        return 'VERY_HIGH'
+    elif score >= 0.8:
+        return 'HIGH'
+    elif score >= 0.7:
+        return 'MEDIUM'
+    else:
+        return 'LOW'
+    
+def get_local_doc_info(chunk, rag_type, api_type, confidence, score):
+    return {
+        "rag_type": rag_type,
+        "api_type": api_type,
+        "confidence": confidence,
+        "metadata": {
+            "document_id": chunk.get('document_id', ''),
+            "source": chunk.get('source', ''),
+            "title": chunk.get('title', ''),
+            "excerpt": chunk.get('excerpt', ''),
+        },
+        "assessed_score": score,
+    }
 
-        <question>            
-        {question}
-        </question>
-            
-        Assistant: 새로운 질문:"""
-    else: 
-        condense_template = """
-        <history>
-        {chat_history}
-        </history>
-        Answer only with the new question.
+def retrieve_from_local_index(query, top_k):
+    """local index에서 문서를 찾아 (relevant_docs, fallback_docs)를 반환합니다.
+
+    VECTOR_SCORE_THRESHOLD 이상인 vector 검색 결과는 relevant_docs로 바로 사용합니다.
+    그렇지 않으면 질문 token의 LEXICAL_MIN_COVERAGE 이상을 포함하는 BM25 결과를 vector 순위와
+    reciprocal rank fusion으로 합쳐 fallback_docs로 반환하며, Kendra miss 시 naver 검색 대신 사용합니다.
+    """
+    import local_index
+    if not VECTOR_INDEX_PATH:
+        return [], []
+    logger.debug('[retrieve_from_local_index]')
+    
+    vector_results = []
+    if get_vector_index() is not None:
+        try:
+            embedding = get_vector_embeddings().embed_query(query)
+            vector_results = vector_index.search_ids(embedding, top_k * 2)
+        except Exception:
+            logger.exception('error in retrieve_from_local_index')
+    
+    relevant_docs = []
+    for score, i in vector_results:
+        if score < VECTOR_SCORE_THRESHOLD:
+            break
+        chunk = vector_index.store.get(i)
+        logger.debug('vector search', score=round(score, 4), title=chunk.get('title', ''))
+        relevant_docs.append(get_local_doc_info(chunk, 'vector', 'faiss', get_confidence(score), score))
+        if len(relevant_docs) >= top_k:
+            break
+    if len(relevant_docs) >= 1:
+        return relevant_docs, []
+    
+    if get_lexical_index() is None:
+        logger.info('No relevant document in local index! So use Kendra')
+        return [], []
+    
+    start = time.time()
+    lexical_results = {}
+    for score, i, coverage in lexical_index.search(query, top_k * 2):
+        if coverage >= LEXICAL_MIN_COVERAGE:
+            lexical_results[i] = (score, coverage)
+    
+    # vector 순위는 lexical 조건을 만족한 chunk 안에서만 순서를 보정하는 데 사용
+    rankings = [list(lexical_results), [i for _, i in vector_results if i in lexical_results]]
+    fallback_docs = []
+    for i in local_index.reciprocal_rank_fusion(rankings)[:top_k]:
+        score, coverage = lexical_results[i]
+        chunk = lexical_index.store.get(i)
+        logger.debug('lexical search', bm25=round(score, 4), coverage=round(coverage, 2), title=chunk.get('title', ''))
+        fallback_docs.append(get_local_doc_info(chunk, 'lexical', 'bm25', 'HIGH' if coverage >= 0.8 else 'MEDIUM', score))
+    logger.metric('lexical_search', (time.time() - start) * 1000)
+    logger.info('No relevant document in vector index! So use Kendra', lexical_docs=len(fallback_docs))
+    return [], fallback_docs
+
+def is_out_of_corpus(query):
+    query = query.lower()
+    return any(keyword and keyword in query for keyword in OUT_OF_CORPUS_KEYWORDS)
+
+def retrieve_with_hedging(query, top_k, fallback_docs=None):
+    """Kendra를 우선 사용하고, 결과가 없을 때를 대비해 naver 검색을 미리 시작합니다.
+
+    Kendra가 HEDGE_DELAY 안에 끝나지 않거나 corpus 밖의 질문이면 naver 검색을 동시에 요청하므로
+    Kendra miss의 latency는 Kendra + Naver가 아닌 두 latency 중 큰 값이 됩니다.
+    local lexical index의 결과(fallback_docs)가 있으면 Kendra miss 시 naver 검색 대신 사용합니다.
+    """
+    logger.debug('[retrieve_with_hedging]')
+    kendra_future = executor.submit(retrieve_from_Kendra, query, top_k)
+    
+    naver_future = None
+    if is_out_of_corpus(query):
+        logger.info('out of corpus. start naver search')
+        naver_future = executor.submit(retrieve_from_naver_search_api, query)
+    elif not fallback_docs:
+        concurrent.futures.wait([kendra_future], timeout=HEDGE_DELAY)
+        if not kendra_future.done():
+            logger.info('Kendra is slow. start naver search')
+            naver_future = executor.submit(retrieve_from_naver_search_api, query)
+    
+    try:
+        relevant_docs = kendra_future.result(timeout=KENDRA_TIMEOUT)
+    except Exception:
+        logger.exception('error in retrieve_with_hedging')
+        relevant_docs = []
+    
+    if len(relevant_docs) >= 1:
+        if naver_future is not None:
+            naver_future.cancel()
+        return relevant_docs
+    
+    if fallback_docs and naver_future is None:
+        logger.info('No relevant document! So use local lexical index')
+        return fallback_docs
+    
+    logger.info('No relevant document! So use naver api')
+    if naver_future is None:
+        naver_future = executor.submit(retrieve_from_naver_search_api, query)
+    try:
+        return naver_future.result(timeout=NAVER_TIMEOUT)
+    except Exception:
+        logger.exception('error in retrieve_with_hedging')
+        return []
+    
+def retrieve_documents(query, top_k):
+    """local index, Kendra, naver 검색 순서로 문서를 찾습니다."""
+    relevant_docs, local_docs = retrieve_from_local_index(query, top_k)
+    if len(relevant_docs) == 0:
+        relevant_docs = retrieve_with_hedging(query, top_k, local_docs)
+    return relevant_docs
 
-        Human: using <history>, rephrase the follow up <question> to be a standalone question. The standalone question must have main words of the original question.
-         
-        <quesion>
-        {question}
-        </question>
+pattern_follow_up = re.compile(
+    r'^(그럼|그러면|그래서|그리고|그건|그거|그게|그것|이건|이거|이게|이것|저건|저거|또|더|위의?|방금|아까|그 |이 |저 )'
+    r'|(그건|그거|그게|그것|이건|이거|이게|저거)'
+    r'|^(what about|how about|and |also |then |so )|\b(it|its|that|this|those|these|they|them)\b',
+    re.IGNORECASE
+)
 
-        Assistant: Standalone question:"""
+def needs_condensation(text, session):
+    """이전 대화가 있고, 질문이 짧거나 지시어/접속어로 이전 대화를 참조하는 경우에만 질문을 다시 작성합니다."""
+    if CONDENSE != 'true' or (not session.turns and not session.summary):
+        return False
+    return estimate_tokens(text) < CONDENSE_MIN_TOKENS or pattern_follow_up.search(text.strip()) is not None
 
-    print('condense_template: ', condense_template)
+CONFIDENCE_SCORES = {'VERY_HIGH': 1.0, 'HIGH': 0.75, 'MEDIUM': 0.5, 'NOT_AVAILABLE': 0.5, 'LOW': 0.25}
 
-    condense_prompt_claude = PromptTemplate.from_template(condense_template)
-        
-    condense_prompt_chain = LLMChain(llm=llm, prompt=condense_prompt_claude)
+def score_documents(query, relevant_docs):
+    """상위 3개 문서와 query의 평균 cosine similarity이며, embedding에 실패하면 confidence를 사용합니다."""
+    import numpy as np
+    if not relevant_docs:
+        return 0.0
+    try:
+        doc_vectors = embed_excerpts([doc['metadata']['excerpt'] for doc in relevant_docs])
+        similarity = doc_vectors @ embed_query(query).ravel()
+        return float(np.sort(similarity)[-3:].mean())
+    except Exception:
+        logger.exception('error in score_documents')
+        return max(CONFIDENCE_SCORES.get(doc['confidence'], 0.5) for doc in relevant_docs)
+
+def retrieve_with_condensation(connectionId, requestId, text, language, session, top_k):
+    """(검색에 사용한 질문, 문서)를 반환합니다.
+
+    질문을 다시 작성해야 하면 원래 질문의 검색을 먼저 시작하고, 다시 작성된 질문으로도 검색하여
+    다시 작성된 질문에 대한 score가 높은 쪽을 사용합니다. 다시 작성하는데 실패하거나
+    CONDENSE_TIMEOUT을 넘으면 원래 질문의 검색 결과를 사용합니다.
+    """
+    if not needs_condensation(text, session):
+        return text, retrieve_documents(text, top_k)
+    
+    logger.debug('[retrieve_with_condensation]')
+    raw_future = retrieval_executor.submit(retrieve_documents, text, top_k)
+    condense_future = executor.submit(get_revised_question, connectionId, requestId, text, language, session)
+    try:
+        revised_question = condense_future.result(timeout=CONDENSE_TIMEOUT)
+    except Exception:
+        logger.exception('error in retrieve_with_condensation')
+        return text, raw_future.result()
+    
+    if normalize_query(revised_question) == normalize_query(text):
+        return text, raw_future.result()
+    
+    revised_docs = retrieve_documents(revised_question, top_k)
+    raw_docs = raw_future.result()
+    
+    revised_score = score_documents(revised_question, revised_docs)
+    raw_score = score_documents(revised_question, raw_docs)
+    logger.info('condensation', raw_score=round(raw_score, 4), raw_docs=len(raw_docs), revised_score=round(revised_score, 4), revised_docs=len(revised_docs))
+    if raw_score > revised_score:
+        return text, raw_docs
+    return revised_question, revised_docs
+
+rerank_embedding_cache = LRUCache(RERANK_EMBEDDING_CACHE_SIZE, RERANK_EMBEDDING_CACHE_TTL)
+
+def embed_query(query):
+    import numpy as np
+    import local_index
+    key = 'query:' + hashlib.sha256(query.encode('utf-8')).hexdigest()
+    vector = rerank_embedding_cache.get(key)
+    if vector is None:
+        vector = local_index.normalize(np.asarray(get_vector_embeddings().embed_query(query), dtype=np.float32))
+        rerank_embedding_cache.put(key, vector)
+    return vector
+
+def embed_excerpts(excerpts):
+    """excerpt hash별로 cache된 embedding을 사용하고, 나머지는 한번의 embed_documents()로 요청합니다."""
+    import numpy as np
+    import local_index
+    keys = [hashlib.sha256(excerpt.encode('utf-8')).hexdigest() for excerpt in excerpts]
+    vectors = [rerank_embedding_cache.get(key) for key in keys]
+    
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        embedded = get_vector_embeddings().embed_documents([excerpts[i] for i in missing])
+        for i, vector in zip(missing, embedded):
+            vectors[i] = np.asarray(vector, dtype=np.float32)
+            rerank_embedding_cache.put(keys[i], vectors[i])
+    logger.debug('rerank embeddings', cached=len(excerpts) - len(missing), embedded=len(missing))
+    return local_index.normalize(np.vstack(vectors))
+
+@logger.traced('rerank')
+def rerank_documents(query, relevant_docs, top_k):
+    """후보 문서를 질문과의 cosine similarity로 다시 정렬하여 top_k개를 선택합니다.
+
+    이미 선택된 문서와 RERANK_DUPLICATE_THRESHOLD 이상 유사한 문서는 중복으로 제외하고,
+    MMR(maximal marginal relevance)로 질문과 관련 있으면서 서로 다른 내용의 문서를 고릅니다.
+    embedding에 실패하면 검색 순서대로 top_k개를 사용합니다.
+    """
+    import numpy as np
+    if len(relevant_docs) <= 1:
+        return relevant_docs[:top_k]
+    logger.debug('[rerank_documents]')
+    
+    try:
+        doc_vectors = embed_excerpts([doc['metadata']['excerpt'] for doc in relevant_docs])
+        query_vector = embed_query(query)
+    except Exception:
+        logger.exception('error in rerank_documents')
+        return relevant_docs[:top_k]
+    
+    relevance = doc_vectors @ query_vector.ravel()
+    similarity = doc_vectors @ doc_vectors.T
+    
+    selected = []
+    max_similarity = np.full(len(relevant_docs), -1.0, dtype=np.float32)  # 선택된 문서와의 최대 유사도
+    available = np.ones(len(relevant_docs), dtype=bool)
+    while len(selected) < top_k and available.any():
+        mmr = MMR_LAMBDA * relevance - (1 - MMR_LAMBDA) * np.maximum(max_similarity, 0)
+        i = int(np.argmax(np.where(available, mmr, -np.inf)))
+        selected.append(i)
+        max_similarity = np.maximum(max_similarity, similarity[i])
+        available &= max_similarity < RERANK_DUPLICATE_THRESHOLD  # 선택된 문서 자신도 제외됨
+    
+    logger.info('rerank', candidates=len(relevant_docs), selected=len(selected), duplicates=len(relevant_docs) - len(selected) - int(available.sum()))
+    return [dict(relevant_docs[i], rerank_score=float(relevance[i])) for i in selected]  # cache된 검색 결과는 변경하지 않음
+    
+condense_cache = LRUCache(CONDENSE_CACHE_SIZE, CONDENSE_CACHE_TTL)
+
+def get_revised_question(connectionId, requestId, query, language, session):    
+    logger.debug('[get_revised_question]')
+    # 이전 대화가 바뀌면 다시 작성하도록 마지막 turn의 request_time을 key에 포함
+    key = json.dumps([session.key, session.last_request_time, normalize_query(query)], ensure_ascii=False)
+    revised_question = condense_cache.get(key)
+    if revised_question is not None:
+        logger.info('revised_question', question=revised_question, cached=True)
+        return revised_question
+    
+    condense_prompt_chain = get_chain(language, 'qa', 'condense', CONDENSE_MODEL_ID)
 
-    chat_history = extract_chat_history_from_memory()
+    chat_history = extract_chat_history_from_memory(session)
     try:         
-        revised_question = condense_prompt_chain.run({"chat_history": chat_history, "question": query})
+        start = time.time()
+        with logger.span('condense'):
+            revised_question = condense_prompt_chain.run({"chat_history": "\n".join(chat_history), "question": query})
+        revised_question = clean_revised_question(revised_question) or query
 
-        print('revised_question: '+revised_question)
+        logger.info('revised_question', question=revised_question, elapsed_sec=round(time.time() - start, 3))
 
     except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)                     
+        logger.exception('error in get_revised_question')
         raise Exception ("Not able to request to LLM")    
     
+    condense_cache.put(key, revised_question)
     return revised_question
+
+pattern_question_tag = re.compile(r'</?questi?on>')
+
+def clean_revised_question(text):  # 첫번째 줄만 사용하고 tag와 따옴표를 제거
+    for line in pattern_question_tag.sub('', text).split('\n'):
+        line = line.strip().strip('"\'')
+        if line:
+            return line
+    return ""
     
 _ROLE_MAP = {"human": "\n\nHuman: ", "ai": "\n\nAssistant: "}
-def extract_chat_history_from_memory():
-    print('[extract_chat_history_from_memory]')
+def _get_chat_history(chat_history):  # ConversationalRetrievalChain의 condense prompt에 넣을 대화 이력
+    buffer = ""
+    for message in chat_history:
+        buffer += _ROLE_MAP.get(message.type, f"\n\n{message.type}: ") + message.content
+    return buffer
+
+def extract_chat_history_from_memory(session):
+    logger.debug('[extract_chat_history_from_memory]')
     chat_history = []
-    chats = memory_chain.load_memory_variables({})    
-    # print('chats: ', chats)
-
-    for dialogue_turn in chats['chat_history']:
-        role_prefix = _ROLE_MAP.get(dialogue_turn.type, f"{dialogue_turn.type}: ")
-        history = f"{role_prefix[2:]}{dialogue_turn.content}"
-        if len(history)>MSG_LENGTH:
-            chat_history.append(history[:MSG_LENGTH])
-        else:
-            chat_history.append(history)
+    if session.summary:
+        chat_history.append(f"System: {session.summary}")
+    
+    for turn in session.turns:
+        for role, content in (("human", turn.human), ("ai", turn.ai)):
+            history = f"{_ROLE_MAP[role][2:]}{content}"
+            if len(history)>MSG_LENGTH:
+                chat_history.append(history[:MSG_LENGTH])
+            else:
+                chat_history.append(history)
 
     return chat_history
 
 def getAllowTime():
     d = datetime.datetime.now() - datetime.timedelta(days = 2)
     timeStr = str(d)[0:19]
-    print('allow time: ',timeStr)
+    logger.debug('allow time', allow_time=timeStr)
 
     return timeStr
     
+class CallLogWriter:
+    """call log를 queue에 모아서 BatchWriteItem으로 저장하는 write-behind writer.
+
+    submit()은 queue를 25개 단위로 나누어 thread pool에서 저장을 시작하고,
+    flush()는 저장이 끝날 때까지 기다립니다. Lambda가 멈추기 전에 flush()를 호출해야 합니다.
+    """
+    BATCH_SIZE = 25  # BatchWriteItem의 최대 item 수
+    
+    def __init__(self, table_name, max_attempts=CALL_LOG_MAX_ATTEMPTS):
+        self.table_name = table_name
+        self.max_attempts = max_attempts
+        self.queue = []
+        self.futures = []
+        self.lock = threading.Lock()
+        
+    def put(self, item):
+        with self.lock:
+            self.queue.append(item)
+            
+    def submit(self):
+        with self.lock:
+            while self.queue:
+                batch = self.queue[:self.BATCH_SIZE]
+                self.queue = self.queue[self.BATCH_SIZE:]
+                self.futures.append(executor.submit(self._write, batch))
+                
+    def flush(self, timeout=CALL_LOG_FLUSH_TIMEOUT):
+        self.submit()
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+        
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        if not_done:
+            logger.warning('call log is not written', batches=len(not_done), timeout=timeout)
+        for future in done:
+            if future.exception() is not None:
+                logger.error('error in CallLogWriter', error=str(future.exception()))
+    
+    def _write(self, items):
+        dynamodb_client = get_client('dynamodb')
+        request_items = {
+            self.table_name: [{'PutRequest': {'Item': item}} for item in items]
+        }
+        
+        for attempt in range(self.max_attempts):
+            with logger.span('dynamodb_write'):
+                resp = dynamodb_client.batch_write_item(RequestItems=request_items)
+            request_items = resp.get('UnprocessedItems')
+            if not request_items:
+                return
+            
+            logger.warning('unprocessed items', count=len(request_items[self.table_name]), attempt=attempt+1)
+            if attempt < self.max_attempts - 1:
+                time.sleep(min(0.05 * 2**attempt, 1))  # exponential backoff
+        
+        raise Exception ("Not able to write into dynamodb")
+
+call_log_writer = CallLogWriter(callLogTableName)
+
+class HistorySummarizer:
+    """대화 이력이 token_budget을 넘으면 최근 recent_tokens 안의 turn을 제외한 이전 turn을 요약으로 합칩니다.
+
+    최근 turn은 token 수로 정하며 (최소 1개), 이전 turn이 min_turns개 이상일 때만 여러 turn을 한번에 요약합니다.
+
+    put()은 요약이 필요한 session을 모으고, submit()은 답변 전송이 끝난 후 thread pool에서 요약을 시작하며,
+    flush()는 요약을 timeout까지만 기다립니다. 끝나지 않은 요약은 다음 호출에서 이어서 진행되고 그 호출의 flush()가
+    다시 기다립니다. 요약은 session에 반영하고 call log table에 type이 'summary'인 item으로 저장하여
+    다른 container에서 이력을 가져올 때 사용합니다.
+    """
+    def __init__(self, token_budget, recent_tokens, min_turns):
+        self.token_budget = token_budget
+        self.recent_tokens = recent_tokens
+        self.min_turns = min_turns
+        self.pending = []
+        self.futures = []
+        self.running = set()  # 요약 중인 session key
+        self.lock = threading.Lock()
+        
+    def split_turns(self, session):
+        """(요약할 이전 turn, 이전 turn의 token 수, 최근 turn의 token 수)를 반환합니다."""
+        turns = list(session.turns)
+        recent = 0
+        count = 0
+        for turn in reversed(turns):
+            tokens = estimate_tokens(turn.human) + estimate_tokens(turn.ai)
+            if count >= 1 and recent + tokens > self.recent_tokens:
+                break
+            recent += tokens
+            count += 1
+        older = turns[:len(turns) - count]
+        return older, sum(estimate_tokens(turn.human) + estimate_tokens(turn.ai) for turn in older), recent
+        
+    def needs_summary(self, session):
+        older, older_tokens, recent_tokens = self.split_turns(session)
+        if len(older) < self.min_turns:
+            return False
+        return estimate_tokens(session.summary) + older_tokens + recent_tokens > self.token_budget
+        
+    def put(self, session, userId, requestId):
+        if self.needs_summary(session):
+            with self.lock:
+                if session.key not in self.running:
+                    self.running.add(session.key)
+                    self.pending.append((session, userId, requestId))
+                
+    def submit(self):
+        with self.lock:
+            for args in self.pending:
+                self.futures.append(executor.submit(self._summarize, *args))
+            self.pending = []
+            
+    def flush(self, timeout=SUMMARY_FLUSH_TIMEOUT):
+        self.submit()
+        with self.lock:
+            futures = self.futures
+            self.futures = []
+        
+        done, not_done = concurrent.futures.wait(futures, timeout=timeout)
+        if not_done:  # 응답을 늦추지 않도록 다음 호출로 넘김
+            logger.info('summary is carried over', sessions=len(not_done), timeout=timeout)
+            with self.lock:
+                self.futures.extend(not_done)
+        for future in done:
+            if future.exception() is not None:
+                logger.error('error in HistorySummarizer', error=str(future.exception()))
+                
+    def _summarize(self, session, userId, requestId):
+        try:
+            self._update_summary(session, userId, requestId)
+        finally:
+            with self.lock:
+                self.running.discard(session.key)
+                
+    def _update_summary(self, session, userId, requestId):
+        turns, _, _ = self.split_turns(session)
+        if not turns:
+            return
+        until = turns[-1].request_time
+        
+        history = "\n".join(f"Human: {turn.human}\nAssistant: {turn.ai}" for turn in turns)
+        PROMPT = get_prompt_template(get_language(history), 'summary')
+        start = time.time()
+        summary = summary_llm(PROMPT.format(summary=session.summary, history=history)).strip()
+        logger.info('summary', turns=len(turns), until=until, tokens=estimate_tokens(summary), elapsed_sec=round(time.time() - start, 3))
+        
+        session_store.set_summary(session, summary, until)
+        call_log_writer.put({
+            'user_id': {'S': userId},
+            'request_id': {'S': requestId},
+            'request_time': {'S': f'{until}#summary'},  # 요약된 마지막 turn 바로 다음에 정렬
+            'type': {'S': 'summary'},
+            'summary': {'S': summary},
+            'summarized_until': {'S': until}
+        })
+        call_log_writer.submit()
+
+history_summarizer = HistorySummarizer(HISTORY_TOKEN_BUDGET, HISTORY_RECENT_TOKENS, HISTORY_SUMMARY_MIN_TURNS)
+
 def save_text_into_db(userId, requestId, requestTime, type, body, msg):
     
-    print('save_text_into_db')
+    logger.debug('[save_text_into_db]')
     
     item = {
         'user_id': {'S':userId},
         'request_id': {'S':requestId},
         'request_time': {'S':requestTime},
         'type': {'S':type},
-        'body': {'S':body},
-        'msg': {'S':msg}
+        'body': {'S':body}
     }
     
-    dynamodb_client = boto3.client('dynamodb')
-    try:
-        resp =  dynamodb_client.put_item(TableName=callLogTableName, Item=item)
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)
-        raise Exception ("Not able to write into dynamodb")   
+    data = msg.encode('utf-8')
+    if len(data) > CALL_LOG_COMPRESS_THRESHOLD:
+        item['msg_z'] = {'B': zlib.compress(data)}
+    else:
+        item['msg'] = {'S':msg}
+    
+    call_log_writer.put(item)
+    call_log_writer.submit()
         
 def extract_relevant_doc_for_kendra(query_id, apiType, query_result):
-    print('[extract_relevant_doc_for_kendra]')
+    logger.debug('[extract_relevant_doc_for_kendra]')
     rag_type = "kendra"
     if(apiType == "retrieve"): # retrieve API
         excerpt = query_result["Content"] # 발췌문
@@ -649,146 +2689,238 @@ def extract_relevant_doc_for_kendra(query_id, apiType, query_result):
                 "query_id": query_id,
                 "feedback_token": feedback_token
             }
+        
+        if query_result_type == "QUESTION_ANSWER":  # FAQ fast path에서 답변만 전송
+            doc_info['metadata']['question'] = question_text
+            doc_info['metadata']['answer'] = answer
     return doc_info
     
+KENDRA_ATTRIBUTE_FILTER = {
+    "EqualsTo": {      
+        "Key": "_language_code",
+        "Value": {
+            "StringValue": "ko"
+        }
+    },
+}
+
+def kendra_retrieve(query, top_k):
+    kendra_client = get_client('kendra', region_name=kendra_region, endpoint_url=kendra_endpoint_url)
+    return kendra_client.retrieve(
+        IndexId = kendraIndex,
+        QueryText = query,
+        PageSize = top_k,      
+        AttributeFilter = KENDRA_ATTRIBUTE_FILTER,      
+    )
+
+def kendra_query(query, page_size, result_type=None):
+    kendra_client = get_client('kendra', region_name=kendra_region, endpoint_url=kendra_endpoint_url)
+    params = {
+        'IndexId': kendraIndex,
+        'QueryText': query,
+        'PageSize': page_size,
+        'AttributeFilter': KENDRA_ATTRIBUTE_FILTER,
+    }
+    if result_type:
+        params['QueryResultTypeFilter'] = result_type  # 'QUESTION_ANSWER', 'ANSWER', "DOCUMENT"
+    return kendra_client.query(**params)
+
+def get_future_result(future, name):
+    """완료된 future의 결과를 반환하며, 시간 초과나 실패한 branch는 None으로 처리합니다."""
+    if future is None or not future.done():
+        if future is not None:
+            future.cancel()
+        logger.warning('Kendra branch timeout', branch=name)
+        return None
+    try:
+        return future.result()
+    except Exception:
+        logger.exception('error in Kendra branch', branch=name)
+        return None
+    
 def retrieve_from_Kendra(query, top_k):
-    print('[retrieve_from_Kendra]')
-    print('query: ', query)
+    logger.debug('[retrieve_from_Kendra]')
+    logger.debug('query', query=query)
     
-    index_id = kendraIndex
+    key = get_retrieval_cache_key('kendra', query, top_k)
+    relevant_docs = retrieval_cache.get(key)
+    if relevant_docs is not None:
+        logger.debug('retrieval cache hit', source='kendra', count=len(relevant_docs))
+        return relevant_docs
     
-    kendra_client = boto3.client(
-        service_name='kendra', 
-        region_name=kendra_region,
-        config = Config(
-            retries=dict(
-                max_attempts=10
-            )
-        )
-    )
+    with logger.span('kendra'):
+        relevant_docs, complete = search_Kendra(query, top_k)
+    if complete:  # 시간 초과된 branch가 있으면 cache하지 않음
+        retrieval_cache.put(key, relevant_docs)
+    return relevant_docs
+
+def search_Kendra(query, top_k):
+    """Kendra 검색 결과와 모든 branch가 제시간에 응답했는지 여부를 반환합니다."""
+    
+    # Retrieve, FAQ Query, fallback Query를 동시에 요청 (latency: sum -> max)
+    futures = {
+        'retrieve': kendra_executor.submit(kendra_retrieve, query, top_k),
+        'faq': kendra_executor.submit(kendra_query, query, 1, "QUESTION_ANSWER"),
+    }
+    if KENDRA_SPECULATIVE_QUERY == 'true':
+        futures['query'] = kendra_executor.submit(kendra_query, query, top_k)
+    
+    deadline = time.time() + KENDRA_TIMEOUT
+    concurrent.futures.wait([futures['retrieve']], timeout=KENDRA_TIMEOUT)
+    if not futures['retrieve'].done():
+        logger.warning('Retrieve API timeout!')
+        for future in futures.values():
+            future.cancel()
+        return [], False
     
     try:
-        resp =  kendra_client.retrieve(
-            IndexId = index_id,
-            QueryText = query,
-            PageSize = top_k,      
-            AttributeFilter = {
-                "EqualsTo": {      
-                    "Key": "_language_code",
-                    "Value": {
-                        "StringValue": "ko"
-                    }
-                },
-            },      
-        )
-        print('resp: ', resp)
-        query_id = resp["QueryId"]
-        
-        if len(resp["ResultItems"]) >= 1:
-            relevant_docs = []
-            retrieve_docs = []
-            for query_result in resp["ResultItems"]:
-                confidence = query_result["ScoreAttributes"]['ScoreConfidence']
-                retrieve_docs.append(extract_relevant_doc_for_kendra(query_id = query_id, apiType = "retrieve", query_result = query_result))
-                
-            print('Looking for FAQ...')
-            try:
-                resp =  kendra_client.query(
-                    IndexId = index_id,
-                    QueryText = query,
-                    PageSize = 1, 
-                    QueryResultTypeFilter = "QUESTION_ANSWER",  # 'QUESTION_ANSWER', 'ANSWER', "DOCUMENT"
-                    AttributeFilter = {
-                        "EqualsTo": {      
-                            "Key": "_language_code",
-                            "Value": {
-                                "StringValue": "ko"
-                            }
-                        },
-                    },      
-                )
-                    
-                print('query resp:', json.dumps(resp))
-                query_id = resp["QueryId"]
-                    
-                if len(resp["ResultItems"]) >= 1:
-                        
-                    for query_result in resp["ResultItems"]:
-                        confidence = query_result["ScoreAttributes"]['ScoreConfidence']
-    
-                        if confidence == 'VERY_HIGH' or confidence == 'HIGH' or confidence == 'NOT_AVAILABLE': 
-                            relevant_docs.append(extract_relevant_doc_for_kendra(query_id=query_id, apiType="query", query_result=query_result))
-    
-                            if len(relevant_docs) >= top_k:
-                                break
-                else:
-                    print('No result for FAQ')
+        resp = futures['retrieve'].result()
+    except Exception:
+        logger.exception('error in search_Kendra')
+        for future in futures.values():
+            future.cancel()
+        raise Exception ("Not able to retrieve from Kendra")     
+    logger.debug('resp', resp=resp)
+    query_id = resp["QueryId"]
+    
+    relevant_docs = []
+    if len(resp["ResultItems"]) >= 1:
+        if 'query' in futures:
+            futures['query'].cancel()
             
-            except Exception:
-                err_msg = traceback.format_exc()
-                print('error message: ', err_msg)
-                raise Exception ("Not able to query from Kendra")                
-
-            for doc in retrieve_docs:                
-                if len(relevant_docs) >= top_k:
-                    break
-                else:
-                    relevant_docs.append(doc)        
+        retrieve_docs = []
+        for query_result in resp["ResultItems"]:
+            retrieve_docs.append(extract_relevant_doc_for_kendra(query_id = query_id, apiType = "retrieve", query_result = query_result))
             
-        else:
-            print('No result for Retrieve API!')
-            try:
-                resp =  kendra_client.query(
-                    IndexId = index_id,
-                    QueryText = query,
-                    PageSize = top_k,
-                    AttributeFilter = {
-                        "EqualsTo": {      
-                            "Key": "_language_code",
-                            "Value": {
-                                "StringValue": "ko"
-                            }
-                        },
-                    },      
-                )
-                print('query resp:', resp)
-                query_id = resp["QueryId"]
+        logger.debug('Looking for FAQ...')
+        concurrent.futures.wait([futures['faq']], timeout=max(0, deadline - time.time()))
+        resp = get_future_result(futures['faq'], 'FAQ')
+        complete = resp is not None
+            
+        if resp and len(resp["ResultItems"]) >= 1:
+            logger.debug('query resp', resp=resp)
+            query_id = resp["QueryId"]
                 
-                if len(resp["ResultItems"]) >= 1:
-                    relevant_docs = []
-                    for query_result in resp["ResultItems"]:
-                        confidence = query_result["ScoreAttributes"]['ScoreConfidence']
+            for query_result in resp["ResultItems"]:
+                confidence = query_result["ScoreAttributes"]['ScoreConfidence']
 
-                        if confidence == 'VERY_HIGH' or confidence == 'HIGH' or confidence == 'MEDIUM' or confidence == 'NOT_AVAILABLE': 
-                            relevant_docs.append(extract_relevant_doc_for_kendra(query_id=query_id, apiType="query", query_result=query_result))
+                if confidence == 'VERY_HIGH' or confidence == 'HIGH' or confidence == 'NOT_AVAILABLE': 
+                    relevant_docs.append(extract_relevant_doc_for_kendra(query_id=query_id, apiType="query", query_result=query_result))
 
-                            if len(relevant_docs) >= top_k:
-                                break
+                    if len(relevant_docs) >= top_k:
+                        break
+        else:
+            logger.debug('No result for FAQ')
 
-                else: 
-                    print('No result for Query API. Finally, no relevant docs!')
-                    relevant_docs = []
+        for doc in retrieve_docs:                
+            if len(relevant_docs) >= top_k:
+                break
+            else:
+                relevant_docs.append(doc)        
+        
+    else:
+        logger.info('No result for Retrieve API!')
+        futures['faq'].cancel()
+        
+        if 'query' not in futures:
+            futures['query'] = kendra_executor.submit(kendra_query, query, top_k)
+            deadline = time.time() + KENDRA_TIMEOUT
+        concurrent.futures.wait([futures['query']], timeout=max(0, deadline - time.time()))
+        resp = get_future_result(futures['query'], 'Query')
+        complete = resp is not None
+        
+        if resp and len(resp["ResultItems"]) >= 1:
+            logger.debug('query resp', resp=resp)
+            query_id = resp["QueryId"]
+            
+            for query_result in resp["ResultItems"]:
+                confidence = query_result["ScoreAttributes"]['ScoreConfidence']
 
-            except Exception:
-                err_msg = traceback.format_exc()
-                print('error message: ', err_msg)
-                raise Exception ("Not able to query from Kendra")
-                
-    except Exception:
-        err_msg = traceback.format_exc()
-        print('error message: ', err_msg)        
-        raise Exception ("Not able to retrieve from Kendra")     
+                if confidence == 'VERY_HIGH' or confidence == 'HIGH' or confidence == 'MEDIUM' or confidence == 'NOT_AVAILABLE': 
+                    relevant_docs.append(extract_relevant_doc_for_kendra(query_id=query_id, apiType="query", query_result=query_result))
 
-    for i, rel_doc in enumerate(relevant_docs):
-        print(f'## Document {i+1}: {json.dumps(rel_doc)}')  
+                    if len(relevant_docs) >= top_k:
+                        break
+        else: 
+            logger.info('No result for Query API. Finally, no relevant docs!')
+
+    if logger.enabled('DEBUG'):
+        for i, rel_doc in enumerate(relevant_docs):
+            logger.debug(f'## Document {i+1}', document=rel_doc)
 
     if len(relevant_docs) >= 1:
-        return check_confidence(query, relevant_docs)
+        return check_confidence(query, relevant_docs, top_k), complete
     else:
-        return relevant_docs
+        return relevant_docs, complete
 
-def check_confidence(query, relevant_docs):
-    print('[check_confidence]')
+def is_faq_hit(relevant_docs):  # 신뢰도가 높은 Kendra FAQ 답변이 포함된 경우
+    for doc in relevant_docs:
+        if doc['api_type'] == 'query' and doc['metadata'].get('type') == 'QUESTION_ANSWER' and doc['confidence'] in ['VERY_HIGH', 'HIGH']:
+            return True
+    return False
+
+def get_faq_terms(text):  # 조사/어미가 붙은 한글 3-gram은 잘 맞지 않으므로 2글자 이하의 한글 token과 영어 단어만 비교
+    import local_index
+    return {token for token in local_index.tokenize(text) if len(token) <= 2 or token[0] <= '\u024f'}
+
+def get_faq_similarity(query, faq_question):
+    if FAQ_SIMILARITY == 'lexical':  # 질문 token 중 FAQ 질문에 포함된 비율
+        terms = get_faq_terms(query)
+        return len(terms & get_faq_terms(faq_question)) / len(terms) if terms else 0.0
+    elif FAQ_SIMILARITY == 'embedding':
+        return float(embed_query(query).ravel() @ embed_query(faq_question).ravel())
+    return 1.0
+
+def get_faq_doc(query, relevant_docs):
+    """FAQ fast path로 답변할 수 있으면 첫번째 FAQ 문서를 반환합니다."""
+    if FAQ_FAST_PATH not in ['answer', 'polish']:
+        return None
+    
+    for doc in relevant_docs:
+        if doc['api_type'] == 'query' and doc['metadata'].get('type') == 'QUESTION_ANSWER':
+            break
+    else:
+        return None
+    if doc['confidence'] not in FAQ_MIN_CONFIDENCE or not doc['metadata'].get('answer'):  # answer가 없으면 이전 형식의 cache
+        return None
+    
+    try:
+        similarity = get_faq_similarity(query, doc['metadata']['question'])
+    except Exception:
+        logger.exception('error in get_faq_doc')
+        return None
+    if similarity < FAQ_SIMILARITY_THRESHOLD:
+        logger.info('faq similarity is low', similarity=round(similarity, 4), faq_question=doc['metadata']['question'])
+        return None
+    
+    logger.info('faq fast path', mode=FAQ_FAST_PATH, confidence=doc['confidence'], similarity=round(similarity, 4), faq_question=doc['metadata']['question'])
+    logger.metric('faq_fast_path', 1, 'Count')
+    return doc
+
+def get_answer_from_faq(question, language, faq_doc, connectionId, requestId, streamer, requestedModelId=None):
+    """FAQ 답변을 그대로 전송하며, polish이면 fast model로 질문에 맞게 다듬습니다. 다듬는데 실패하면 FAQ 답변을 전송합니다."""
+    metadata = faq_doc['metadata']
+    if FAQ_FAST_PATH == 'polish':
+        route = model_router.route(question, 'qa', faq_hit=True, requested_model_id=requestedModelId)
+        PROMPT = get_prompt_template(language, 'faq')
+        try:
+            isTyping(connectionId, requestId)
+            msg = get_llm(route)(PROMPT.format(faq_question=metadata['question'], answer=metadata['answer'], question=question), callbacks=[streamer])
+            model_router.record(route, streamer)
+            return msg
+        except ConnectionGone:
+            raise
+        except Exception:
+            logger.exception('error in get_answer_from_faq')
+            if streamer.streamed:  # 일부가 이미 전송됨
+                raise Exception ("Not able to request to LLM")
+    
+    msg = metadata['answer']
+    streamer.write(msg)
+    return msg
+
+def check_confidence(query, relevant_docs, top_k):
+    logger.debug('[check_confidence]')
     docs = []
     for doc in relevant_docs:
         confidence = doc['confidence']
@@ -801,7 +2933,7 @@ def check_confidence(query, relevant_docs):
     return docs
     
 def get_reference(docs, rag_method):
-    print('[get_reference]')
+    logger.debug('[get_reference]')
     if rag_method == 'RetrievalQA' or rag_method == 'ConversationalRetrievalChain':
         reference = "\n\nFrom\n"
         for i, doc in enumerate(docs):
@@ -873,27 +3005,16 @@ def get_reference(docs, rag_method):
         
     return reference
     
-def create_ConversationalRetrievalChain(PROMPT, retriever):  
-    print('[create_ConversationalRetrievalChain]')
-    condense_template = """
-        <history>
-        {chat_history}
-        </history>
-        Answer only with the new question.
-
-        Human: using <history>, rephrase the follow up <question> to be a standalone question.
-         
-        <quesion>
-        {question}
-        </question>
-
-        Assistant: Standalone question:"""
-    CONDENSE_QUESTION_PROMPT = PromptTemplate.from_template(condense_template)
+def create_ConversationalRetrievalChain(llm, PROMPT, retriever, memory_chain):  
+    logger.debug('[create_ConversationalRetrievalChain]')
+    from langchain.chains import ConversationalRetrievalChain
+    CONDENSE_QUESTION_PROMPT = get_prompt_template('en', 'conversational_condense')
         
     qa = ConversationalRetrievalChain.from_llm(
         llm=llm, 
         retriever=retriever,
         condense_question_prompt=CONDENSE_QUESTION_PROMPT, 
+        condense_question_llm=condense_llm,  # streaming하지 않으므로 다시 작성된 질문은 streamer로 전달되지 않음
         combine_docs_chain_kwargs={'prompt': PROMPT},
 
         memory=memory_chain,
@@ -908,19 +3029,131 @@ def create_ConversationalRetrievalChain(PROMPT, retriever):
 
     return qa
 
+# warm up: container 초기화(init) 또는 scheduled warm event에서 connection을 미리 열고 index/chain을 준비
+# warm_up이 'provisioned'이면 provisioned concurrency로 초기화되는 container에서만 실행
+WARM_UP = os.environ.get('warm_up', 'false')  # true, provisioned, false
+WARM_UP_BUDGET = float(os.environ.get('warm_up_budget', '5'))  # 초. 끝나지 않은 작업은 기다리지 않음
+WARM_UP_TASKS = os.environ.get('warm_up_tasks', 'bedrock,kendra,dynamodb,websocket,local_index,chains').split(',')
+
+def warm_up_bedrock():  # 1 token을 생성하여 connection과 model endpoint를 함께 준비
+    if FAST_MODEL_ID.startswith('amazon.titan'):
+        body = {'inputText': 'ping', 'textGenerationConfig': get_parameter(FAST_MODEL_ID, 1)}
+    else:
+        body = dict(get_parameter(FAST_MODEL_ID, 1) or {}, prompt=f'{HUMAN_PROMPT} ping{AI_PROMPT}')
+    boto3_bedrock.invoke_model(modelId=FAST_MODEL_ID, body=json.dumps(body), accept='application/json', contentType='application/json')
+
+def warm_up_kendra():
+    get_client('kendra', region_name=kendra_region, endpoint_url=kendra_endpoint_url).describe_index(Id=kendraIndex)
+
+def warm_up_dynamodb():
+    get_client('dynamodb').describe_table(TableName=callLogTableName)
+
+def warm_up_websocket():  # 존재하지 않는 connection이므로 실패하지만 TLS connection은 pool에 남음
+    client.get_connection(ConnectionId='warm-up')
+
+def warm_up_local_index():
+    if get_vector_index() is not None:
+        get_vector_embeddings()
+    get_lexical_index()
+
+def warm_up_chains():  # lazy import되는 chain/memory module을 load하고 chain registry를 채움
+    from langchain.memory import ConversationBufferWindowMemory
+    from langchain.schema import SystemMessage
+    for language in ['ko', 'en']:
+        for model_id in MODEL_POOL:
+            get_chain(language, 'normal', 'conversation', model_id)
+            if rag_method != 'RetrievalPrompt':
+                get_chain(language, 'qa', rag_method, model_id)
+        if rag_method == 'RetrievalPrompt' and CONDENSE == 'true':
+            get_chain(language, 'qa', 'condense', CONDENSE_MODEL_ID)
+
+# (name, function, 동시에 열 connection 수). Kendra는 Retrieve/FAQ/Query를 동시에 요청하므로 3개
+warm_up_tasks = [
+    ('bedrock', warm_up_bedrock, 1),
+    ('kendra', warm_up_kendra, 3),
+    ('dynamodb', warm_up_dynamodb, 1),
+    ('websocket', warm_up_websocket, 1),
+    ('local_index', warm_up_local_index, 1),
+    ('chains', warm_up_chains, 1),
+]
+
+def run_warm_up_task(name, func):
+    start = time.perf_counter()
+    try:
+        func()
+    except ClientError as e:  # 권한이 없거나 잘못된 요청이어도 connection은 열림
+        logger.debug('warm up', task=name, error=e.response.get('Error', {}).get('Code'))
+    return (time.perf_counter() - start) * 1000
+
+def warm_up(trigger, budget=WARM_UP_BUDGET):
+    """WARM_UP_TASKS를 동시에 실행하고 budget(초) 안에 끝난 작업의 결과를 반환합니다."""
+    logger.start_request(trigger=trigger)
+    start = time.perf_counter()
+    futures = {}
+    for name, func, connections in warm_up_tasks:
+        if name in WARM_UP_TASKS:
+            futures.update({executor.submit(run_warm_up_task, name, func): name for _ in range(connections)})
+
+    done, not_done = concurrent.futures.wait(futures, timeout=budget)
+    result = {'warmed': {}, 'failed': {}, 'timeout': sorted(set(futures[future] for future in not_done))}
+    for future in done:
+        name = futures[future]
+        if future.exception() is not None:
+            result['failed'][name] = str(future.exception())
+        else:
+            result['warmed'][name] = max(result['warmed'].get(name, 0), round(future.result(), 1))
+    result['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 1)
+
+    logger.info('warm up', **result)
+    for name, elapsed in result['warmed'].items():
+        logger.metric(f'warm_up_{name}', elapsed)
+    logger.metric('warm_up_total', result['elapsed_ms'])
+    logger.emit_metrics(trigger=trigger)
+    return result
+
 def lambda_handler(event, context):
-    
-    if event['requestContext']: 
+
+    if event.get('warm_up') or event.get('source') == 'aws.events':  # EventBridge schedule
+        return {
+            'statusCode': 200,
+            'body': json.dumps(warm_up('schedule'))
+        }
+
+    if event['requestContext']:
         connectionId = event['requestContext']['connectionId']
         routeKey = event['requestContext']['routeKey']
+        logger.start_request(connection_id=connectionId)
 
         if routeKey == '$connect':
-            print('connected!')
+            logger.info('connected!')
         elif routeKey == '$disconnect':
-            print('disconnected!')
+            close_connection(connectionId, '$disconnect')
         else:   # $default
             jsonBody = json.loads(event.get("body", ""))
-            print(jsonBody)
+            logger.start_request(connection_id=connectionId, request_id=jsonBody.get('request_id'), user_id=jsonBody.get('user_id'), conv_type=jsonBody.get('conv_type'))
+            logger.debug('request', body=jsonBody)
+            
+            if jsonBody.get('type') == 'ping':
+                return {
+                    'statusCode': 200
+                }
+            elif jsonBody.get('type') == 'resync':
+                resync(connectionId, jsonBody)
+                return {
+                    'statusCode': 200
+                }
+            elif is_duplicate_request(jsonBody['user_id'], jsonBody['request_id']):  # 재전송된 요청은 다시 생성하지 않음
+                logger.metric('duplicate_request', 1, 'Count')
+                text = find_answer(jsonBody)  # 다른 container의 답변은 call log에서 가져옴
+                logger.info('duplicate request', answered=text is not None)
+                if text is not None:
+                    sendResyncMessage(connectionId, jsonBody['request_id'], text)
+                else:  # 처음 도착한 요청이 아직 생성 중이며, 답변은 그 요청의 frame 또는 client의 resync로 받음
+                    isTyping(connectionId, jsonBody['request_id'])
+                logger.emit_metrics(conv_type=jsonBody.get('conv_type'))
+                return {
+                    'statusCode': 200
+                }
             
             text = jsonBody['body']
             requestId  = jsonBody['request_id']
@@ -929,19 +3162,53 @@ def lambda_handler(event, context):
             type = jsonBody['type']
             body = jsonBody['body']
             
+            model_router.current = None
+            streamer = WebSocketStreamingCallbackHandler(connectionId, requestId)
             try:
-                msg, reference = getResponse(connectionId, jsonBody)
-                print('msg+reference: ', msg+reference)
+                msg, reference = getResponse(connectionId, jsonBody, streamer)
+                logger.debug('msg+reference', msg=msg+reference)
             except Exception:
-                err_msg = traceback.format_exc()
-                print('err_msg: ', err_msg)
+                if streamer.flight is not None:  # 기다리는 follower는 직접 답변을 생성
+                    streamer.flight.abort()
+                release_request(userId, requestId)
+                if connection_registry.is_dead(connectionId):  # 답변 중에 연결이 끊겨서 생성을 중단함
+                    record_cancellation(streamer)
+                    call_log_writer.flush()
+                    logger.emit_metrics(conv_type=jsonBody['conv_type'])
+                    return {
+                        'statusCode': 200
+                    }
+                logger.exception('error in lambda_handler')
+                try:  # typing 상태로 남지 않도록 client에 실패를 알림
+                    sendErrorMessage(connectionId, requestId, "답변을 생성하지 못했습니다. 다시 시도해 주세요.")
+                except Exception:
+                    logger.exception('error in lambda_handler')
                 raise Exception ("Not able to send a message")
-                                
-            readStreamMsg(connectionId, requestId, msg+reference)        
             
+            # call log 저장은 마지막 frame 전송과 동시에 진행하고, 응답 전에 완료를 기다림
             save_text_into_db(userId, requestId, requestTime, type, body, msg+reference)
+            remember_answer(userId, requestId, msg+reference)
+            closed = False
+            try:
+                if not streamer.served:  # single flight의 leader가 이미 전송한 경우는 제외
+                    if not streamer.streamed:  # streaming이 되지 않은 경우 완성된 답변을 전송
+                        streamer.write(msg)
+                    streamer.write(reference)
+                    streamer.close()
+                closed = True
+                history_summarizer.submit()  # 답변 전송이 끝난 후 대화 요약
+            except ConnectionGone:  # 답변은 call log에 저장되었으므로 resync로 가져올 수 있음
+                logger.info('connection is closed before the final frame')
+            finally:
+                if streamer.flight is not None:  # final frame을 받지 못한 follower는 저장된 답변을 직접 전송
+                    streamer.flight.complete(msg, reference, list(streamer.batcher.followers) if closed else [])
+                history_summarizer.flush()
+                call_log_writer.flush()
+                logger.emit_metrics(conv_type=jsonBody['conv_type'])
     
     return {
         'statusCode': 200
     }
-            
\ No newline at end of file
+
+if WARM_UP == 'true' or (WARM_UP == 'provisioned' and os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') == 'provisioned-concurrency'):
+    warm_up('init')
@@ -1,4 +1,5 @@
 import { DynamoDB } from '@aws-sdk/client-dynamodb';
+import { inflateSync } from 'zlib';
 
 const dynamo = new DynamoDB();
 const tableName = process.env.tableName;
@@ -29,10 +30,14 @@ export const handler = async (event, context) => {
         let history = [];
         for(let item of result.Items) {
             console.log('item: ', item);
+            if (item.type.S === 'summary') {  // 대화 요약은 lambda-chat에서만 사용
+                continue;
+            }
             let request_time = item.request_time.S;
             let request_id = item.request_id.S;
             let body = item.body.S;
-            let msg = item.msg.S;
+            // 긴 답변은 zlib으로 압축되어 msg_z(Binary)에 저장됨
+            let msg = item.msg_z ? inflateSync(Buffer.from(item.msg_z.B)).toString('utf-8') : item.msg.S;
             let type = item.type.S;
 
             history.push({
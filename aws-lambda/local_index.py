@@ -0,0 +1,315 @@
+import collections
+import hashlib
+import json
+import math
+import mmap
+import os
+import re
+import shutil
+import struct
+import unicodedata
+import zlib
+
+import numpy as np
+
+# local index 디렉토리 구성
+#   meta.json      : {"version", "dim", "count", "embedding_model_id"}
+#   index.faiss    : 정규화된 벡터에 대한 FAISS inner product index (cosine similarity)
+#   store.bin      : chunk별 {"document_id", "title", "source", "excerpt"} JSON을 이어 붙인 blob
+#   offsets.npy    : store.bin에서 chunk i의 위치 [offsets[i], offsets[i+1]) (uint64, count+1개)
+#   vectors.npy    : 정규화된 벡터 matrix (float32 또는 float16), 재생성 시 변경되지 않은 문서의 벡터를 재사용
+#   manifest.json  : document_id별 content hash와 chunk 범위 (ingestion에서만 사용)
+#   lexical.idx    : 같은 chunk에 대한 BM25 lexical index (LexicalIndex 참조)
+FORMAT_VERSION = 1
+META_FILE = 'meta.json'
+FAISS_FILE = 'index.faiss'
+STORE_FILE = 'store.bin'
+OFFSETS_FILE = 'offsets.npy'
+VECTORS_FILE = 'vectors.npy'
+MANIFEST_FILE = 'manifest.json'
+LEXICAL_FILE = 'lexical.idx'
+LEXICAL_MAGIC = b'LEX1'
+
+pattern_space = re.compile(r'\s+')
+
+class HashingEmbeddings:
+    """네트워크 없이 사용할 수 있는 결정적(deterministic) embedding.
+
+    정규화된 텍스트의 글자 unigram/bigram을 hashing하여 dim 차원 벡터를 만들며,
+    BedrockEmbeddings와 같은 embed_query/embed_documents interface를 제공합니다.
+    """
+    def __init__(self, dim=256):
+        self.dim = dim
+
+    def _embed(self, text):
+        text = pattern_space.sub(' ', unicodedata.normalize('NFKC', str(text)).lower()).strip()
+        vector = np.zeros(self.dim, dtype=np.float32)
+        grams = list(text) + [text[i:i+2] for i in range(len(text)-1)]
+        for gram in grams:
+            digest = hashlib.md5(gram.encode('utf-8')).digest()
+            index = int.from_bytes(digest[:4], 'little') % self.dim
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        return normalize(vector).tolist()
+
+    def embed_query(self, text):
+        return self._embed(text)
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+class DocStore:
+    """offsets.npy와 store.bin을 memory-map하여 필요한 chunk만 읽습니다."""
+    def __init__(self, path):
+        self.offsets = np.load(os.path.join(path, OFFSETS_FILE), mmap_mode='r')
+        self.file = open(os.path.join(path, STORE_FILE), 'rb')
+        size = os.fstat(self.file.fileno()).st_size
+        self.blob = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, i):
+        start, end = int(self.offsets[i]), int(self.offsets[i+1])
+        return json.loads(self.blob[start:end].decode('utf-8'))
+
+class VectorIndex:
+    """미리 생성된 local vector index를 읽기 전용으로 load하고 검색합니다."""
+    def __init__(self, path):
+        import faiss
+
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != FORMAT_VERSION:
+            raise Exception(f"Not supported index version: {self.meta.get('version')}")
+
+        index_file = os.path.join(path, FAISS_FILE)
+        try:
+            self.index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:  # mmap을 지원하지 않는 index type
+            self.index = faiss.read_index(index_file)
+        self.store = DocStore(path)
+
+    @property
+    def dim(self):
+        return self.index.d
+
+    def search_ids(self, vector, top_k):
+        """[(score, chunk id)]를 score 내림차순으로 반환합니다."""
+        query = normalize(vector).reshape(1, -1)
+        scores, ids = self.index.search(query, top_k)
+        return [(float(score), int(i)) for score, i in zip(scores[0], ids[0]) if i >= 0]
+
+    def search(self, vector, top_k):
+        """[(score, chunk)]를 score 내림차순으로 반환합니다."""
+        return [(score, self.store.get(i)) for score, i in self.search_ids(vector, top_k)]
+
+# 한글은 띄어쓰기와 조사가 불규칙하므로 형태소 분석 대신 글자 bigram/trigram을 token으로 사용
+pattern_hangul_token = re.compile('[\u1100-\u11ff\u3131-\u318e\uac00-\ud7a3]+|[a-z0-9\u00c0-\u024f]+')
+
+def tokenize(text):
+    text = unicodedata.normalize('NFKC', str(text)).lower()
+    tokens = []
+    for run in pattern_hangul_token.findall(text):
+        if run[0] > '\u024f':  # 한글
+            if len(run) == 1:
+                tokens.append(run)
+            tokens.extend(run[i:i+2] for i in range(len(run)-1))
+            tokens.extend(run[i:i+3] for i in range(len(run)-2))
+        else:
+            tokens.append(run)
+    return tokens
+
+def write_lexical_index(path, texts, k1=1.2, b=0.75):
+    """texts(chunk 순서)에 대한 BM25 index를 하나의 파일로 씁니다.
+
+    파일 구성: magic | header 길이(uint32) | header JSON(8 bytes 정렬) | doc_lengths(uint32 x N)
+              | df(uint32 x T) | offsets(uint64 x T+1) | postings
+    term별 postings는 doc id의 차이값(uint32)과 tf(uint16)를 이어 붙여 zlib으로 압축합니다.
+    """
+    postings = collections.defaultdict(list)
+    doc_lengths = np.zeros(len(texts), dtype=np.uint32)
+    for doc_id, text in enumerate(texts):
+        counts = collections.Counter(tokenize(text))
+        doc_lengths[doc_id] = sum(counts.values())
+        for term, tf in counts.items():
+            postings[term].append((doc_id, tf))
+
+    terms = sorted(postings)
+    df = np.zeros(len(terms), dtype=np.uint32)
+    offsets = np.zeros(len(terms) + 1, dtype=np.uint64)
+    blocks = []
+    for t, term in enumerate(terms):
+        ids = np.array([doc_id for doc_id, _ in postings[term]], dtype=np.uint32)
+        tfs = np.array([min(tf, 65535) for _, tf in postings[term]], dtype=np.uint16)
+        deltas = np.diff(ids, prepend=np.uint32(0)).astype(np.uint32)
+        block = zlib.compress(deltas.tobytes() + tfs.tobytes())
+        blocks.append(block)
+        df[t] = len(ids)
+        offsets[t+1] = offsets[t] + len(block)
+
+    header = json.dumps({
+        'version': FORMAT_VERSION,
+        'count': len(texts),
+        'avgdl': float(doc_lengths.mean()) if len(texts) else 0.0,
+        'k1': k1,
+        'b': b,
+        'terms': terms,
+    }, ensure_ascii=False).encode('utf-8')
+    header += b' ' * (-(len(LEXICAL_MAGIC) + 4 + len(header)) % 8)
+
+    with open(path, 'wb') as f:
+        f.write(LEXICAL_MAGIC)
+        f.write(struct.pack('<I', len(header)))
+        f.write(header)
+        f.write(doc_lengths.tobytes())
+        f.write(df.tobytes())
+        f.write(offsets.tobytes())
+        for block in blocks:
+            f.write(block)
+
+class LexicalIndex:
+    """write_lexical_index()로 생성된 파일을 memory-map하여 BM25로 검색합니다.
+
+    vector index와 관계없이 meta.json과 store를 직접 읽으므로 lexical index만 있어도 사용할 수 있습니다.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as f:
+            self.meta = json.load(f)
+        if self.meta.get('version') != FORMAT_VERSION:
+            raise Exception(f"Not supported index version: {self.meta.get('version')}")
+
+        self.file = open(os.path.join(path, LEXICAL_FILE), 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.data[:len(LEXICAL_MAGIC)] != LEXICAL_MAGIC:
+            raise Exception('Not a lexical index')
+
+        pos = len(LEXICAL_MAGIC)
+        header_length = struct.unpack_from('<I', self.data, pos)[0]
+        pos += 4
+        header = json.loads(self.data[pos:pos+header_length].decode('utf-8'))
+        pos += header_length
+
+        self.count = header['count']
+        if self.count != self.meta.get('count'):
+            raise Exception(f"lexical index has {self.count} chunks but meta.json has {self.meta.get('count')}")
+        self.avgdl = header['avgdl'] or 1.0
+        self.k1 = header['k1']
+        self.b = header['b']
+        self.terms = {term: t for t, term in enumerate(header['terms'])}
+
+        self.doc_lengths = np.frombuffer(self.data, dtype=np.uint32, count=self.count, offset=pos)
+        pos += 4 * self.count
+        self.df = np.frombuffer(self.data, dtype=np.uint32, count=len(self.terms), offset=pos)
+        pos += 4 * len(self.terms)
+        self.offsets = np.frombuffer(self.data, dtype=np.uint64, count=len(self.terms) + 1, offset=pos)
+        pos += 8 * (len(self.terms) + 1)
+        self.postings_start = pos
+
+        self.store = DocStore(path)
+
+    def postings(self, t):
+        n = int(self.df[t])
+        start = self.postings_start + int(self.offsets[t])
+        end = self.postings_start + int(self.offsets[t+1])
+        block = zlib.decompress(self.data[start:end])
+        ids = np.cumsum(np.frombuffer(block, dtype=np.uint32, count=n), dtype=np.int64)
+        tfs = np.frombuffer(block, dtype=np.uint16, count=n, offset=4*n).astype(np.float32)
+        return ids, tfs
+
+    def search(self, query, top_k):
+        """[(bm25 score, chunk id, coverage)]를 score 내림차순으로 반환합니다.
+
+        coverage는 index에 있는 질문 token의 idf 합 중 chunk에 포함된 token의 idf 합의 비율이며,
+        "어떻게 하나요"와 같이 corpus에 없는 token은 제외하고 흔한 token의 비중은 낮춥니다.
+        """
+        query_terms = [self.terms[term] for term in set(tokenize(query)) if term in self.terms]
+        if not query_terms or not self.count:
+            return []
+
+        scores = np.zeros(self.count, dtype=np.float32)
+        matched = np.zeros(self.count, dtype=np.float32)
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lengths.astype(np.float32) / self.avgdl)
+        total_idf = 0.0
+        for t in query_terms:
+            ids, tfs = self.postings(t)
+            df = len(ids)
+            idf = math.log(1 + (self.count - df + 0.5) / (df + 0.5))
+            scores[ids] += idf * tfs * (self.k1 + 1) / (tfs + norm[ids])
+            matched[ids] += idf
+            total_idf += idf
+
+        candidates = np.flatnonzero(matched)
+        if len(candidates) > top_k:
+            candidates = candidates[np.argpartition(-scores[candidates], top_k)[:top_k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(float(scores[i]), int(i), float(matched[i]) / total_idf) for i in candidates]
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """여러 검색 결과(chunk id 순위 목록)를 reciprocal rank fusion으로 합칩니다."""
+    scores = collections.defaultdict(float)
+    for ranking in rankings:
+        for rank, i in enumerate(ranking):
+            scores[i] += 1 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def read_existing(path):
+    """이전에 생성된 index의 (meta, manifest, vectors, store)를 반환하며, 없으면 None을 반환합니다."""
+    try:
+        with open(os.path.join(path, META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(os.path.join(path, MANIFEST_FILE), encoding='utf-8') as f:
+            manifest = json.load(f)
+        vectors = np.load(os.path.join(path, VECTORS_FILE), mmap_mode='r') if meta.get('dim') else None
+        store = DocStore(path)
+    except FileNotFoundError:
+        return None
+    return meta, manifest, vectors, store
+
+def write_index(path, chunks, vectors, meta, manifest, dtype='float32', lexical=True):
+    """chunks와 vectors(chunk 수 x dim)로 index 디렉토리를 새로 쓰고, 완성된 후 기존 디렉토리와 교체합니다.
+
+    vectors가 None이면 vector index 없이 lexical index만 생성합니다.
+    """
+    tmp_path = path.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    dim = 0
+    if vectors is not None:
+        import faiss
+
+        vectors = normalize(vectors)
+        dim = int(vectors.shape[1])
+        np.save(os.path.join(tmp_path, VECTORS_FILE), vectors.astype(dtype))
+
+        index = faiss.IndexFlatIP(dim)
+        index.add(vectors)
+        faiss.write_index(index, os.path.join(tmp_path, FAISS_FILE))
+
+    if lexical:
+        write_lexical_index(os.path.join(tmp_path, LEXICAL_FILE), [chunk['title'] + ' ' + chunk['excerpt'] for chunk in chunks])
+
+    offsets = np.zeros(len(chunks) + 1, dtype=np.uint64)
+    with open(os.path.join(tmp_path, STORE_FILE), 'wb') as f:
+        for i, chunk in enumerate(chunks):
+            data = json.dumps(chunk, ensure_ascii=False).encode('utf-8')
+            f.write(data)
+            offsets[i+1] = offsets[i] + len(data)
+    np.save(os.path.join(tmp_path, OFFSETS_FILE), offsets)
+
+    with open(os.path.join(tmp_path, MANIFEST_FILE), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    with open(os.path.join(tmp_path, META_FILE), 'w', encoding='utf-8') as f:
+        json.dump(dict(meta, version=FORMAT_VERSION, dim=dim, count=len(chunks), dtype=dtype), f, ensure_ascii=False)
+
+    old_path = path.rstrip('/') + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
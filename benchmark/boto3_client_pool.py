@@ -0,0 +1,45 @@
+"""boto3 client pool benchmark.
+
+매 요청마다 client를 새로 만드는 경우(cold)와 get_client()로 재사용하는 경우(pooled)의
+DynamoDB 호출 latency를 local stub endpoint에 대해 측정합니다.
+
+    python benchmark/boto3_client_pool.py --calls 200
+"""
+import argparse
+import time
+
+import boto3
+
+from common import load_lambda_chat, report, start_stub_server
+
+def run(calls):
+    lambda_chat = load_lambda_chat()
+    server, endpoint_url = start_stub_server()
+
+    key = {'user_id': {'S': 'benchmark'}, 'request_time': {'S': '2024-01-01 00:00:00'}}
+
+    cold = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        dynamodb_client = boto3.client('dynamodb', endpoint_url=endpoint_url)
+        dynamodb_client.get_item(TableName='benchmark', Key=key)
+        cold.append(time.perf_counter() - start)
+
+    pooled = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        dynamodb_client = lambda_chat.get_client('dynamodb', endpoint_url=endpoint_url)
+        dynamodb_client.get_item(TableName='benchmark', Key=key)
+        pooled.append(time.perf_counter() - start)
+
+    server.shutdown()
+
+    report('cold client', cold)
+    report('pooled client', pooled)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    run(args.calls)
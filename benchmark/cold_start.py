@@ -0,0 +1,104 @@
+"""lambda-chat.py의 cold start 측정: import time breakdown과 첫 요청의 초기화 시간.
+
+매 run마다 새 python process(-X importtime)에서 lambda-chat.py를 load하고,
+package별 import 시간(self time 합계)과 module 초기화 시간, 그리고 첫번째/두번째 요청에서
+chain과 memory를 준비하는 시간을 측정합니다. LLM과 AWS API는 호출하지 않습니다.
+
+    python benchmark/cold_start.py --runs 5 --top 15
+    python benchmark/cold_start.py --env '{"rag_method": "RetrievalQA"}'
+"""
+import argparse
+import collections
+import json
+import os
+import subprocess
+import sys
+import time
+
+from common import load_lambda_chat, report
+
+MARKER = 'cold start: load lambda-chat'
+
+def prepare_request(lambda_chat, userId):
+    """요청마다 LLM 호출 전까지 실행되는 chain/memory 준비 과정."""
+    for convType in ['normal', 'qa']:
+        session = lambda_chat.session_store.get((userId, convType)) or lambda_chat.session_store.create((userId, convType))
+        if convType == 'normal':
+            lambda_chat.get_chain('ko', convType, 'conversation')
+            lambda_chat.get_memory_chat(session)
+        elif lambda_chat.rag_method == 'RetrievalPrompt':
+            lambda_chat.get_chain('ko', convType, 'condense', lambda_chat.CONDENSE_MODEL_ID)
+        else:
+            lambda_chat.get_chain('ko', convType, lambda_chat.rag_method)
+            lambda_chat.get_memory_chain(session)
+
+def child(env):
+    sys.stderr.write(MARKER + '\n')
+    sys.stderr.flush()
+
+    start = time.perf_counter()
+    lambda_chat = load_lambda_chat(env)
+    load = time.perf_counter() - start
+
+    invocations = []
+    for i in range(2):
+        start = time.perf_counter()
+        prepare_request(lambda_chat, f'benchmark-{i}')
+        invocations.append(time.perf_counter() - start)
+
+    print(json.dumps({'load': load, 'first': invocations[0], 'second': invocations[1]}))
+
+def parse_importtime(stderr):
+    """marker 이후의 'import time:' 줄에서 top-level package별 self time(초)을 합산합니다."""
+    packages = collections.Counter()
+    started = False
+    for line in stderr.splitlines():
+        if line == MARKER:
+            started = True
+            continue
+        if not started or not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        packages[name.strip().split('.')[0]] += int(self_us) / 1e6
+    return packages
+
+def run(runs, top, env):
+    loads, imports, firsts, seconds = [], [], [], []
+    packages = collections.Counter()
+    for _ in range(runs):
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child', '--env', json.dumps(env)],
+            capture_output=True, text=True, check=True
+        )
+        timings = json.loads(result.stdout.strip().splitlines()[-1])
+        run_packages = parse_importtime(result.stderr)
+        packages.update(run_packages)
+
+        loads.append(timings['load'])
+        imports.append(sum(run_packages.values()))
+        firsts.append(timings['first'])
+        seconds.append(timings['second'])
+
+    print(f'{"package":<24} {"import(ms)":>10}')
+    for name, elapsed in packages.most_common(top):
+        print(f'{name:<24} {elapsed / runs * 1000:10.1f}')
+    print()
+
+    report('module load', loads)
+    report('  imports', imports)
+    report('  init', [load - imported for load, imported in zip(loads, imports)])
+    report('first request setup', firsts)
+    report('second request setup', seconds)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=15, help='출력할 package 수')
+    parser.add_argument('--env', default='{}', help='lambda-chat.py 환경 변수 (JSON), 예: {"rag_method": "RetrievalQA"}')
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(json.loads(args.env))
+    else:
+        run(args.runs, args.top, json.loads(args.env))
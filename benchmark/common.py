@@ -0,0 +1,77 @@
+import importlib.util
+import json
+import os
+import sys
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'aws-lambda')
+LAMBDA_PATH = os.path.join(LAMBDA_DIR, 'lambda-chat.py')
+
+# lambda-chat.py가 import 시점에 읽는 환경 변수 (benchmark용 더미 값)
+LAMBDA_ENV = {
+    'model_id': 'anthropic.claude-v2:1',
+    'bedrock_region': 'us-east-1',
+    'kendra_region': 'us-east-1',
+    'kendraIndex': 'benchmark-index',
+    'numberOfRelevantDocs': '4',
+    'callLogTableName': 'benchmark-call-log',
+    'connection_url': 'http://127.0.0.1:1',
+    'log_level': 'WARNING',  # 요청마다 출력되는 INFO log로 결과가 가려지지 않도록
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+}
+
+def load_lambda_chat(env=None):
+    """aws-lambda/lambda-chat.py를 'lambda_chat' module로 load합니다."""
+    for key, value in LAMBDA_ENV.items():
+        os.environ.setdefault(key, value)
+    for key, value in (env or {}).items():
+        os.environ[key] = value
+    if LAMBDA_DIR not in sys.path:  # Lambda와 같이 handler 옆의 module을 import
+        sys.path.insert(0, LAMBDA_DIR)
+
+    spec = importlib.util.spec_from_file_location('lambda_chat', LAMBDA_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class StubHandler(BaseHTTPRequestHandler):
+    """모든 AWS JSON API 요청에 빈 JSON으로 응답하는 keep-alive stub."""
+    protocol_version = 'HTTP/1.1'
+    response_body = {}
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+
+        body = json.dumps(self.response_body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.0')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_server(handler=StubHandler):
+    """127.0.0.1의 빈 port에서 stub server를 띄우고 (server, endpoint_url)을 반환합니다."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return values[index]
+
+def report(name, elapsed):
+    """elapsed(초) 목록을 ms 단위 p50/p90/p99로 출력합니다."""
+    print(f'{name:<24} n={len(elapsed):<5} '
+          f'p50={percentile(elapsed, 50) * 1000:8.3f}ms '
+          f'p90={percentile(elapsed, 90) * 1000:8.3f}ms '
+          f'p99={percentile(elapsed, 99) * 1000:8.3f}ms')
@@ -0,0 +1,83 @@
+"""Kendra miss 시 serial fallback과 hedged retrieval의 latency 비교.
+
+local stub server가 Kendra(빈 결과)와 Naver 검색 API를 지정된 지연 시간으로 흉내냅니다.
+
+    python benchmark/hedged_retrieval.py --kendra-delay 0.5 --naver-delay 0.4
+"""
+import argparse
+import json
+import time
+
+from http.server import BaseHTTPRequestHandler
+
+from common import load_lambda_chat, report, start_stub_server
+
+class KendraNaverStubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    kendra_delay = 0.5
+    naver_delay = 0.4
+
+    def _respond(self, body, content_type):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):  # Kendra Retrieve / Query
+        length = int(self.headers.get('Content-Length', 0))
+        self.rfile.read(length)
+        time.sleep(self.kendra_delay)
+        self._respond({'QueryId': 'stub', 'ResultItems': []}, 'application/x-amz-json-1.1')
+
+    def do_GET(self):  # Naver blog search
+        time.sleep(self.naver_delay)
+        items = [{
+            'title': f'<b>blog</b> {i}',
+            'description': 'stub description',
+            'bloggerlink': 'https://blog.example.com'
+        } for i in range(3)]
+        self._respond({'items': items}, 'application/json')
+
+    def log_message(self, format, *args):
+        pass
+
+def run(calls, kendra_delay, naver_delay):
+    KendraNaverStubHandler.kendra_delay = kendra_delay
+    KendraNaverStubHandler.naver_delay = naver_delay
+    server, endpoint_url = start_stub_server(KendraNaverStubHandler)
+
+    lambda_chat = load_lambda_chat({
+        'kendra_endpoint_url': endpoint_url,
+        'naver_api_url': endpoint_url + '/v1/search/blog.json',
+        'kendra_speculative_query': 'true',
+    })
+
+    serial = []
+    for i in range(calls):
+        start = time.perf_counter()
+        relevant_docs = lambda_chat.retrieve_from_Kendra(f'질문 {i}', lambda_chat.top_k)
+        if len(relevant_docs) == 0:
+            relevant_docs = lambda_chat.retrieve_from_naver_search_api(f'질문 {i}')
+        serial.append(time.perf_counter() - start)
+
+    hedged = []
+    for i in range(calls):
+        start = time.perf_counter()
+        lambda_chat.retrieve_with_hedging(f'질문 {i}', lambda_chat.top_k)
+        hedged.append(time.perf_counter() - start)
+
+    server.shutdown()
+
+    report('serial fallback', serial)
+    report('hedged retrieval', hedged)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=20)
+    parser.add_argument('--kendra-delay', type=float, default=0.5)
+    parser.add_argument('--naver-delay', type=float, default=0.4)
+    args = parser.parse_args()
+
+    run(args.calls, args.kendra_delay, args.naver_delay)
@@ -0,0 +1,51 @@
+"""질문 목록에 대한 model routing 결과(선택된 model, 이유, max_tokens)를 집계합니다.
+
+routing 정책(fast_model_id, latency_slo, client_model_ids 등)을 조정할 때 call log에서
+추출한 질문으로 각 model이 선택되는 비율을 확인합니다. LLM은 호출하지 않습니다.
+
+    python benchmark/model_routing.py --input questions.txt --conv-type qa
+"""
+import argparse
+import collections
+import json
+
+from common import load_lambda_chat
+
+SAMPLE_QUESTIONS = [
+    '안녕하세요',
+    '로밍 신청 방법',
+    '해지 위약금은 얼마인가요?',
+    '요금제별 데이터 제공량과 부가 서비스의 차이를 자세히 비교해 주세요',
+    'Why was my bill higher this month? Explain the details.',
+]
+
+def run(questions, convType, faq_hit, env):
+    lambda_chat = load_lambda_chat(env)
+
+    counts = collections.Counter()
+    max_tokens = collections.defaultdict(list)
+    for question in questions:
+        route = lambda_chat.model_router.route(question, convType, faq_hit)
+        counts[(route.model_id, route.reason)] += 1
+        max_tokens[route.model_id].append(route.max_tokens)
+
+    print()
+    for (model_id, reason), count in counts.most_common():
+        print(f'{model_id:<32} {reason:<8} {count:>5} ({count / len(questions) * 100:5.1f}%)')
+    for model_id, values in max_tokens.items():
+        print(f'{model_id:<32} avg max_tokens={sum(values) / len(values):.0f}')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', help='한 줄에 하나의 질문이 있는 파일 (없으면 예시 질문 사용)')
+    parser.add_argument('--conv-type', default='qa', choices=['qa', 'normal'])
+    parser.add_argument('--faq-hit', action='store_true')
+    parser.add_argument('--env', default='{}', help='lambda-chat.py 환경 변수 (JSON), 예: {"latency_slo": "30"}')
+    args = parser.parse_args()
+
+    questions = SAMPLE_QUESTIONS
+    if args.input:
+        with open(args.input, encoding='utf-8') as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    run(questions, args.conv_type, args.faq_hit, json.loads(args.env))
@@ -0,0 +1,59 @@
+"""요청마다 template/chain을 생성하는 경우(before)와 registry를 사용하는 경우(after)의 overhead 비교.
+
+before는 이전 get_prompt_template()과 같이 요청마다 한글 regex를 compile하고
+PromptTemplate과 ConversationChain/LLMChain을 새로 생성합니다. LLM은 호출하지 않습니다.
+
+    python benchmark/prompt_registry.py --calls 1000
+"""
+import argparse
+import re
+import time
+
+from common import load_lambda_chat, report
+
+from langchain.chains import ConversationChain, LLMChain
+
+QUERIES = ['환불 규정을 알려주세요', 'How can I change my plan?']
+
+def before(lambda_chat, query, convType):
+    pattern_hangul = re.compile('[ㄱ-ㅣ가-힣]+')
+    word_kor = pattern_hangul.search(str(query))
+    language = 'ko' if word_kor else 'en'
+
+    PROMPT = lambda_chat.PromptTemplate.from_template(lambda_chat.PROMPT_TEMPLATES[(language, convType)])
+    if convType == 'normal':
+        chain = ConversationChain(llm=lambda_chat.llm, verbose=False, prompt=PROMPT)
+    else:
+        condense_prompt = lambda_chat.PromptTemplate.from_template(lambda_chat.PROMPT_TEMPLATES[(language, 'condense')])
+        chain = LLMChain(llm=lambda_chat.llm, prompt=condense_prompt)
+    return PROMPT, chain
+
+def after(lambda_chat, query, convType):
+    language = lambda_chat.get_language(query)
+
+    PROMPT = lambda_chat.get_prompt_template(language, convType)
+    if convType == 'normal':
+        chain = lambda_chat.get_chain(language, convType, 'conversation')
+    else:
+        chain = lambda_chat.get_chain(language, 'qa', 'condense', lambda_chat.CONDENSE_MODEL_ID)
+    return PROMPT, chain
+
+def run(calls):
+    lambda_chat = load_lambda_chat()
+
+    for name, func in [('per-request build', before), ('registry', after)]:
+        for convType in ['normal', 'qa']:
+            elapsed = []
+            for i in range(calls):
+                query = QUERIES[i % len(QUERIES)]
+                start = time.perf_counter()
+                func(lambda_chat, query, convType)
+                elapsed.append(time.perf_counter() - start)
+            report(f'{name} ({convType})', elapsed)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--calls', type=int, default=1000)
+    args = parser.parse_args()
+
+    run(args.calls)
@@ -78,6 +78,149 @@ function updateMessage(messageId, content) {
     }
 }
 
+// 프레임 프로토콜 (v1): type = delta | final | typing | error | resync
+const FRAME_VERSION = 1;
+const streams = {};          // request_id -> 수신 상태
+const pendingRequests = {};  // request_id -> 전송한 메시지 (resync 요청용)
+const lastRequestTimes = {}; // conv_type -> 마지막으로 답변을 받은 request_time (서버가 다른 container의 이력을 가져오는 기준)
+let waitingRequestId = null; // 답변을 기다리는 request_id. 답변이 끝날 때까지 전송 버튼을 비활성화 (double-click, 연속 Enter 방지)
+
+function setWaitingRequest(requestId) {
+    waitingRequestId = requestId;
+    const sendButton = document.getElementById('sendButton');
+    if (sendButton) {
+        sendButton.disabled = requestId !== null;
+    }
+}
+
+function completeRequest(requestId) {
+    const request = pendingRequests[requestId];
+    if (request && (lastRequestTimes[request.conv_type] || '') < request.request_time) {
+        lastRequestTimes[request.conv_type] = request.request_time;
+    }
+    delete streams[requestId];
+    delete pendingRequests[requestId];
+    if (waitingRequestId === requestId) {
+        setWaitingRequest(null);
+    }
+}
+
+let CRC_TABLE = null;
+function crc32(text) {
+    if (CRC_TABLE === null) {
+        CRC_TABLE = new Uint32Array(256);
+        for (let n = 0; n < 256; n++) {
+            let c = n;
+            for (let k = 0; k < 8; k++) {
+                c = (c & 1) ? (0xEDB88320 ^ (c >>> 1)) : (c >>> 1);
+            }
+            CRC_TABLE[n] = c >>> 0;
+        }
+    }
+    const bytes = new TextEncoder().encode(text);
+    let crc = 0xFFFFFFFF;
+    for (let i = 0; i < bytes.length; i++) {
+        crc = CRC_TABLE[(crc ^ bytes[i]) & 0xFF] ^ (crc >>> 8);
+    }
+    return (crc ^ 0xFFFFFFFF) >>> 0;
+}
+
+function getContentElement(requestId) {
+    if (currentMessageId !== requestId) {
+        currentMessageId = requestId;
+        addMessage('', false);
+    }
+    const messageElement = document.querySelector(`.message[data-id="${requestId}"]`);
+    return messageElement ? messageElement.querySelector('.content') : null;
+}
+
+// 줄바꿈은 <br>로, 나머지는 text node로 뒤에 이어 붙임 (기존 내용은 다시 파싱하지 않음)
+function appendText(contentElement, text) {
+    const lines = text.split('\n');
+    lines.forEach((line, i) => {
+        if (i > 0) {
+            contentElement.appendChild(document.createElement('br'));
+        }
+        if (line) {
+            contentElement.appendChild(document.createTextNode(line));
+        }
+    });
+}
+
+function getStream(requestId) {
+    if (!streams[requestId]) {
+        streams[requestId] = { seq: 0, offset: 0, parts: [], gap: false, started: false };
+    }
+    return streams[requestId];
+}
+
+function requestResync(requestId) {
+    console.log('resync: ', requestId);
+    const request = pendingRequests[requestId] || {};
+    if (isConnected) {
+        webSocket.send(JSON.stringify({
+            "type": "resync",
+            "request_id": requestId,
+            "user_id": request.user_id,
+            "request_time": request.request_time
+        }));
+    }
+}
+
+function handleFrame(frame) {
+    const requestId = frame.request_id;
+    const stream = getStream(requestId);
+    const contentElement = getContentElement(requestId);
+    if (!contentElement) {
+        return;
+    }
+
+    switch (frame.type) {
+        case 'typing':
+            if (!stream.started) {
+                contentElement.textContent = frame.text;
+            }
+            break;
+        case 'delta':
+        case 'final':
+            if (frame.seq !== stream.seq || frame.offset !== stream.offset) {
+                stream.gap = true;
+            }
+            if (!stream.started) {
+                contentElement.textContent = '';
+                stream.started = true;
+            }
+            appendText(contentElement, frame.text);
+            stream.parts.push(frame.text);
+            stream.seq = frame.seq + 1;
+            stream.offset = frame.offset + frame.text.length;
+
+            if (frame.type === 'final') {
+                const text = stream.parts.join('');
+                if (stream.gap || text.length !== frame.length || crc32(text) !== frame.checksum) {
+                    requestResync(requestId);
+                } else {
+                    completeRequest(requestId);
+                }
+            }
+            break;
+        case 'resync':
+            contentElement.textContent = '';
+            appendText(contentElement, frame.text);
+            completeRequest(requestId);
+            break;
+        case 'error':
+            contentElement.textContent = frame.text;
+            delete streams[requestId];
+            if (waitingRequestId === requestId) {
+                setWaitingRequest(null);
+            }
+            break;
+    }
+    const chatMessages = document.getElementById('chatMessages');
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
 function connect(endpoint, type) {
     const ws = new WebSocket(endpoint);
 
@@ -91,7 +234,9 @@ function connect(endpoint, type) {
 
     ws.onmessage = function (event) {
         const response = JSON.parse(event.data);
-        if (response.request_id) {
+        if (response.v === FRAME_VERSION) {
+            handleFrame(response);
+        } else if (response.request_id) {
             console.log('received message: ', response.msg);
             // 줄바꿈 문자를 HTML의 <br> 태그로 변환
             const formattedMsg = response.msg.replace(/\n/g, '<br>');
@@ -108,6 +253,7 @@ function connect(endpoint, type) {
 
     ws.onclose = function () {
         isConnected = false;
+        setWaitingRequest(null); // 끊긴 연결로는 답변을 받을 수 없으므로 다시 전송할 수 있도록 함
         ws.close();
     };
 
@@ -359,6 +505,9 @@ document.addEventListener('DOMContentLoaded', function() {
 });
 
 function sendMessage() {
+    if (waitingRequestId !== null) { // 이전 요청의 답변을 기다리는 중
+        return;
+    }
     const message = userInput.value.trim();
     if (message) {
         addMessage(message, true);
@@ -377,13 +526,16 @@ function sendMessage() {
             "type": "text",
             "body": message,
             "conv_type": convType,
-            "model_id": model_id
+            "model_id": model_id,
+            "last_request_time": lastRequestTimes[convType] || ""
         };
 
         if (!isConnected) {
             webSocket = connect(endpoint, 'reconnect');
             addMessage("재연결중입니다. 잠시후 다시 시도하세요.", false);
         } else {
+            pendingRequests[requestId] = messageObj;
+            setWaitingRequest(requestId);
             webSocket.send(JSON.stringify(messageObj));
             currentMessageId = null; // 새 메시지 전송 시 currentMessageId 초기화
         }
@@ -0,0 +1,158 @@
+import importlib.util
+import json
+import os
+import re
+import sys
+
+import pytest
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'aws-lambda')
+LAMBDA_PATH = os.path.join(LAMBDA_DIR, 'lambda-chat.py')
+
+# lambda-chat.py가 import 시점에 읽는 환경 변수 (test용 더미 값, AWS API는 호출하지 않음)
+LAMBDA_ENV = {
+    'model_id': 'anthropic.claude-v2:1',
+    'bedrock_region': 'us-east-1',
+    'kendra_region': 'us-east-1',
+    'kendraIndex': 'test-index',
+    'numberOfRelevantDocs': '4',
+    'callLogTableName': 'test-call-log',
+    'connection_url': 'http://127.0.0.1:1',
+    'log_level': 'WARNING',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+}
+
+if LAMBDA_DIR not in sys.path:  # Lambda와 같이 handler 옆의 module을 import
+    sys.path.insert(0, LAMBDA_DIR)
+
+@pytest.fixture(scope='session')
+def lambda_chat():
+    """aws-lambda/lambda-chat.py를 'lambda_chat' module로 load합니다."""
+    pytest.importorskip('boto3')
+    pytest.importorskip('langchain')
+    for key, value in LAMBDA_ENV.items():
+        os.environ.setdefault(key, value)
+
+    spec = importlib.util.spec_from_file_location('lambda_chat', LAMBDA_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class FakeDynamoDB:
+    """call log table(user_id, request_time)의 query, get_item, batch_write_item과
+    inflight table(flight_key)의 conditional put/update/get/delete를 흉내냅니다."""
+    def __init__(self, error=None, page_size=100):
+        self.error = error
+        self.items = []
+        self.page_size = page_size
+        self.queries = []
+        self.batches = []
+        self.unprocessed = []  # batch_write_item마다 처리하지 않을 item 수
+        self.flights = {}      # flight_key -> item
+
+    def put(self, **attributes):
+        self.items.append({name: {'S': value} for name, value in attributes.items()})
+
+    def query(self, **params):
+        self.queries.append(params)
+        values = params['ExpressionAttributeValues']
+        items = [item for item in self.items
+                 if item['user_id']['S'] == values[':userId']['S'] and item['request_time']['S'] > values[':allowTime']['S']]
+        items.sort(key=lambda item: item['request_time']['S'], reverse=not params.get('ScanIndexForward', True))
+
+        start = params.get('ExclusiveStartKey', {}).get('index', 0)
+        limit = min(params.get('Limit', self.page_size), self.page_size)
+        response = {'Items': items[start:start+limit]}
+        if start + limit < len(items):
+            response['LastEvaluatedKey'] = {'index': start + limit}
+        return response
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        self.batches.append(len(requests))
+        skipped = self.unprocessed.pop(0) if self.unprocessed else 0
+        for request in requests[skipped:]:
+            self.items.append(request['PutRequest']['Item'])
+        if skipped:
+            return {'UnprocessedItems': {table_name: requests[:skipped]}}
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        if 'flight_key' in Key:
+            item = self.flights.get(Key['flight_key']['S'])
+        else:
+            item = next((item for item in self.items if all(item.get(name) == value for name, value in Key.items())), None)
+        return {'Item': item} if item is not None else {}
+
+    def put_item(self, TableName, Item, ConditionExpression=None, ExpressionAttributeValues=None, **kwargs):
+        key = Item['flight_key']['S']
+        self._check(self.flights.get(key), ConditionExpression, {}, ExpressionAttributeValues or {})
+        self.flights[key] = dict(Item)
+
+    def update_item(self, TableName, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        key = Key['flight_key']['S']
+        names, values = ExpressionAttributeNames or {}, ExpressionAttributeValues or {}
+        item = self.flights.get(key)
+        self._check(item, ConditionExpression, names, values)
+        item = item if item is not None else dict(Key)
+        for name, value in re.findall(r'(#?\w+) = (list_append\(if_not_exists\(\w+, :\w+\), :\w+\)|:\w+)', UpdateExpression[len('SET '):]):
+            name = names.get(name, name)
+            if value.startswith('list_append'):
+                empty, appended = re.findall(r':\w+', value)
+                value = {'L': item.get(name, values[empty])['L'] + values[appended]['L']}
+            else:
+                value = values[value]
+            item[name] = value
+        self.flights[key] = item
+
+    def delete_item(self, TableName, Key, ConditionExpression=None, ExpressionAttributeValues=None):
+        key = Key['flight_key']['S']
+        self._check(self.flights.get(key), ConditionExpression, {}, ExpressionAttributeValues or {})
+        self.flights.pop(key, None)
+
+    def _check(self, item, condition, names, values):
+        """'a OR b' 형식의 attribute_not_exists(x), x = :v, x < :v 조건만 지원합니다."""
+        if condition is None:
+            return
+        for clause in condition.split(' OR '):
+            match = re.fullmatch(r'attribute_not_exists\((\w+)\)', clause)
+            if match:
+                if item is None or match.group(1) not in item:
+                    return
+                continue
+            name, op, value = clause.split(' ')
+            attribute = (item or {}).get(names.get(name, name))
+            if attribute is None:
+                continue
+            if op == '=' and attribute == values[value]:
+                return
+            if op == '<' and float(attribute['N']) < float(values[value]['N']):
+                return
+        raise self.error({'Error': {'Code': 'ConditionalCheckFailedException'}}, 'ConditionalCheck')
+
+@pytest.fixture
+def dynamodb(lambda_chat, monkeypatch):
+    client = FakeDynamoDB(lambda_chat.ClientError)
+    get_client = lambda_chat.get_client
+    monkeypatch.setattr(lambda_chat, 'get_client', lambda service_name, *args, **kwargs: client if service_name == 'dynamodb' else get_client(service_name, *args, **kwargs))
+    return client
+
+class ApiGatewayClient:
+    """post_to_connection으로 전송된 frame을 connection별로 저장합니다."""
+    def __init__(self, error):
+        self.error = error
+        self.frames = {}
+        self.gone = set()
+
+    def post_to_connection(self, ConnectionId, Data):
+        if ConnectionId in self.gone:
+            raise self.error({'Error': {'Code': 'GoneException'}}, 'PostToConnection')
+        self.frames.setdefault(ConnectionId, []).append(json.loads(Data))
+
+@pytest.fixture
+def api(lambda_chat, monkeypatch):
+    client = ApiGatewayClient(lambda_chat.ClientError)
+    monkeypatch.setattr(lambda_chat, 'client', client)
+    return client
@@ -0,0 +1,56 @@
+import pytest
+
+import local_index
+
+@pytest.fixture
+def cache(lambda_chat, monkeypatch):
+    monkeypatch.setattr(lambda_chat, 'get_embeddings', lambda: local_index.HashingEmbeddings(64))
+    return lambda_chat.AnswerCache(lambda_chat.LRUCache(10, 60), semantic='true', threshold=0.9, max_size=10)
+
+def store(cache, query, fingerprint, msg):
+    _, embedding = cache.lookup(query, fingerprint)
+    cache.store(query, fingerprint, msg, embedding)
+
+def test_exact_hit_on_normalized_query(cache):
+    store(cache, '요금은 어떻게 청구되나요?', 'fp', '매월 청구됩니다.')
+
+    entry, embedding = cache.lookup('  요금은   어떻게 청구되나요 ', 'fp')
+    assert entry['msg'] == '매월 청구됩니다.'
+    assert embedding is None
+    assert cache.metrics['exact_hit'] == 1
+
+def test_fingerprint_change_invalidates(cache):
+    store(cache, '요금은 어떻게 청구되나요', 'fp-1', '매월 청구됩니다.')
+
+    entry, embedding = cache.lookup('요금은 어떻게 청구되나요', 'fp-2')
+    assert entry is None
+    assert embedding is not None  # store()에서 재사용
+    assert cache.metrics['stale'] == 1 and cache.metrics['miss'] == 2
+
+def test_semantic_hit(cache):
+    store(cache, '환불은 결제 후 며칠 이내에 요청할 수 있나요', 'fp', '7일 이내입니다.')
+
+    entry, _ = cache.lookup('환불은 결제 후 며칠 이내에 요청할 수 있나요 알려줘', 'fp')
+    assert entry['msg'] == '7일 이내입니다.'
+    assert cache.metrics['semantic_hit'] == 1
+
+def test_semantic_tier_checks_fingerprint_and_threshold(cache):
+    store(cache, '환불은 결제 후 며칠 이내에 요청할 수 있나요', 'fp', '7일 이내입니다.')
+
+    assert cache.lookup('환불은 결제 후 며칠 이내에 요청할 수 있나요 알려줘', 'other')[0] is None
+    assert cache.lookup('배송은 언제 시작되나요', 'fp')[0] is None
+    assert cache.metrics['semantic_hit'] == 0
+
+def test_semantic_disabled(lambda_chat):
+    cache = lambda_chat.AnswerCache(lambda_chat.LRUCache(10, 60), semantic='false', threshold=0.9, max_size=10)
+    cache.store('요금은 어떻게 청구되나요', 'fp', '매월 청구됩니다.')
+
+    assert cache.lookup('요금은 어떻게 청구되나요 알려줘', 'fp') == (None, None)
+
+def test_expired_entry_is_a_miss(lambda_chat, monkeypatch):
+    cache = lambda_chat.AnswerCache(lambda_chat.LRUCache(10, 60), semantic='false', threshold=0.9, max_size=10)
+    cache.store('요금은 어떻게 청구되나요', 'fp', '매월 청구됩니다.')
+
+    now = lambda_chat.time.time()
+    monkeypatch.setattr(lambda_chat.time, 'time', lambda: now + 61)
+    assert cache.lookup('요금은 어떻게 청구되나요', 'fp')[0] is None
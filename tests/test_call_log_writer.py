@@ -0,0 +1,40 @@
+import pytest
+
+@pytest.fixture
+def sleeps(lambda_chat, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(lambda_chat.time, 'sleep', sleeps.append)
+    return sleeps
+
+def item(i):
+    return {'user_id': {'S': 'u'}, 'request_time': {'S': f'{i:03d}'}, 'type': {'S': 'text'}}
+
+def test_batches_of_25(lambda_chat, dynamodb, sleeps):
+    writer = lambda_chat.CallLogWriter('test-call-log')
+    for i in range(30):
+        writer.put(item(i))
+    writer.flush()
+
+    assert sorted(dynamodb.batches) == [5, 25]
+    assert len(dynamodb.items) == 30
+    assert sleeps == []
+
+def test_unprocessed_items_are_retried(lambda_chat, dynamodb, sleeps):
+    dynamodb.unprocessed = [2, 1]
+    writer = lambda_chat.CallLogWriter('test-call-log', max_attempts=3)
+    for i in range(3):
+        writer.put(item(i))
+    writer.flush()
+
+    assert dynamodb.batches == [3, 2, 1]
+    assert sorted(item['request_time']['S'] for item in dynamodb.items) == ['000', '001', '002']
+    assert sleeps == [0.05, 0.1]
+
+def test_no_backoff_after_last_attempt(lambda_chat, dynamodb, sleeps):
+    dynamodb.unprocessed = [1, 1, 1]
+    writer = lambda_chat.CallLogWriter('test-call-log', max_attempts=3)
+    with pytest.raises(Exception):
+        writer._write([item(0)])
+
+    assert dynamodb.batches == [1, 1, 1]
+    assert sleeps == [0.05, 0.1]
@@ -0,0 +1,142 @@
+import datetime
+
+import pytest
+
+USER = 'user@example.com'
+START = datetime.datetime.now() - datetime.timedelta(hours=1)  # getAllowTime() 이후
+
+def at(seconds):
+    return str(START + datetime.timedelta(seconds=seconds))[0:19]
+
+@pytest.fixture
+def store(lambda_chat, monkeypatch):
+    store = lambda_chat.SessionMemoryStore(10, 1024 * 1024, 3600, lambda_chat.HISTORY_TURNS)
+    monkeypatch.setattr(lambda_chat, 'session_store', store)
+    return store
+
+def add_text(dynamodb, request_time, body, msg):
+    dynamodb.put(user_id=USER, request_time=request_time, type='text', body=body, msg=msg)
+
+def test_load_latest_turns_in_order(lambda_chat, dynamodb, store):
+    dynamodb.page_size = 3
+    for i in range(25):
+        add_text(dynamodb, f'2024-01-01 00:00:{i:02d}', f'질문 {i}', f'답변 {i}')
+    session = store.create((USER, 'qa'))
+
+    lambda_chat.load_chat_history(session, USER, '2024-01-01 00:00:00')
+    assert len(session.turns) == lambda_chat.HISTORY_TURNS
+    assert session.turns[0].human == f'질문 {25 - lambda_chat.HISTORY_TURNS}'
+    assert session.turns[-1].human == '질문 24'
+    assert session.last_request_time == '2024-01-01 00:00:24'
+
+def test_incremental_load(lambda_chat, dynamodb, store):
+    add_text(dynamodb, '2024-01-01 00:00:01', '질문 1', '답변 1')
+    session = store.create((USER, 'qa'))
+    lambda_chat.load_chat_history(session, USER, '2024-01-01 00:00:00')
+
+    add_text(dynamodb, '2024-01-01 00:00:02', '질문 2', '답변 2')
+    lambda_chat.load_chat_history(session, USER, '2024-01-01 00:00:00')
+    assert dynamodb.queries[-1]['ExpressionAttributeValues'][':allowTime']['S'] == '2024-01-01 00:00:01'
+    assert [turn.human for turn in session.turns] == ['질문 1', '질문 2']
+
+def request(request_time, last_request_time):
+    return {
+        'user_id': USER,
+        'request_id': 'r1',
+        'request_time': request_time,
+        'type': 'text',
+        'body': '안녕하세요',
+        'conv_type': 'normal',
+        'model_id': '',
+        'last_request_time': last_request_time,
+    }
+
+@pytest.fixture
+def conversation(lambda_chat, monkeypatch):
+    class Conversation:
+        memory = None
+    monkeypatch.setattr(lambda_chat, 'get_chain', lambda *args: Conversation())
+    monkeypatch.setattr(lambda_chat, 'get_answer_from_conversation', lambda *args: '반갑습니다')
+    monkeypatch.setattr(lambda_chat.history_summarizer, 'put', lambda *args: None)
+
+def test_refresh_only_when_client_has_newer_turn(lambda_chat, dynamodb, store, conversation):
+    add_text(dynamodb, at(1), '질문 1', '답변 1')
+    session = store.create((USER, 'normal'))
+    lambda_chat.load_chat_history(session, USER, lambda_chat.getAllowTime())
+    queries = len(dynamodb.queries)
+
+    streamer = lambda_chat.WebSocketStreamingCallbackHandler('c1', 'r1')
+    lambda_chat.getResponse('c1', request(at(60), at(1)), streamer)
+    assert len(dynamodb.queries) == queries  # 이 container에서 생성한 답변까지 알고 있음
+
+    add_text(dynamodb, at(90), '질문 3', '답변 3')  # 다른 container에서 처리됨
+    lambda_chat.getResponse('c1', request(at(120), at(90)), streamer)
+    assert len(dynamodb.queries) == queries + 1
+    assert [turn.human for turn in session.turns] == ['질문 1', '안녕하세요', '질문 3', '안녕하세요']
+
+def test_summary_item_folds_older_turns(lambda_chat, dynamodb, store):
+    for i in range(1, 4):
+        add_text(dynamodb, at(i), f'질문 {i}', f'답변 {i}')
+    dynamodb.put(user_id=USER, request_time=f'{at(3)}#summary', type='summary', summary='질문 1~3의 요약', summarized_until=at(3))
+    add_text(dynamodb, at(4), '질문 4', '답변 4')
+    session = store.create((USER, 'qa'))
+
+    lambda_chat.load_chat_history(session, USER, lambda_chat.getAllowTime())
+    assert session.summary == '질문 1~3의 요약'
+    assert session.summarized_until == at(3)
+    assert [turn.human for turn in session.turns] == ['질문 4']  # 요약 이전의 turn은 가져오지 않음
+
+@pytest.fixture
+def summarizer(lambda_chat, monkeypatch):
+    summarizer = lambda_chat.HistorySummarizer(token_budget=100, recent_tokens=30, min_turns=2)
+    monkeypatch.setattr(lambda_chat, 'summary_llm', lambda prompt: ' 이전 대화의 요약 ')
+    return summarizer
+
+def add_turns(store, session, count):
+    for i in range(count):
+        store.add_turn(session, f'질문 {i} ' + '가' * 20, f'답변 {i} ' + '나' * 20, at(i))
+
+def test_summary_is_persisted_and_loaded(lambda_chat, dynamodb, store, summarizer):
+    session = store.create((USER, 'qa'))
+    add_turns(store, session, 5)
+
+    summarizer.put(session, USER, 'r1')
+    summarizer.flush(timeout=5)
+    lambda_chat.call_log_writer.flush()
+    assert session.summary == '이전 대화의 요약'
+    assert [turn.human for turn in session.turns] == ['질문 4 ' + '가' * 20]
+
+    (item,) = [item for item in dynamodb.items if item['type']['S'] == 'summary']
+    assert item['request_time']['S'] == f'{at(3)}#summary'
+    assert item['summarized_until']['S'] == at(3)
+
+    other = lambda_chat.Session((USER, 'qa'), lambda_chat.HISTORY_TURNS)  # 다른 container
+    lambda_chat.load_chat_history(other, USER, lambda_chat.getAllowTime())
+    assert other.summary == '이전 대화의 요약'
+    assert other.summarized_until == at(3)
+
+def test_no_summary_below_min_turns(lambda_chat, store, summarizer):
+    session = store.create((USER, 'qa'))
+    add_turns(store, session, 2)
+
+    assert not summarizer.needs_summary(session)
+    summarizer.put(session, USER, 'r1')
+    assert summarizer.pending == []
+
+def test_flush_does_not_wait_for_slow_summary(lambda_chat, dynamodb, store, summarizer, monkeypatch):
+    release = lambda_chat.threading.Event()
+    monkeypatch.setattr(lambda_chat, 'summary_llm', lambda prompt: release.wait(5) and '이전 대화의 요약')
+    session = store.create((USER, 'qa'))
+    add_turns(store, session, 5)
+
+    summarizer.put(session, USER, 'r1')
+    summarizer.flush(timeout=0.05)
+    assert session.summary == ''
+    assert len(summarizer.futures) == 1  # 다음 호출로 넘김
+
+    release.set()
+    summarizer.flush(timeout=5)  # 다음 호출
+    lambda_chat.call_log_writer.flush()
+    assert session.summary == '이전 대화의 요약'
+    assert summarizer.futures == []
+    assert any(item['type']['S'] == 'summary' for item in dynamodb.items)
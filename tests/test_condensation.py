@@ -0,0 +1,101 @@
+import time
+
+import pytest
+
+@pytest.fixture
+def session(lambda_chat):
+    session = lambda_chat.Session(('user', 'qa'), lambda_chat.HISTORY_TURNS)
+    session.turns.append(lambda_chat.Turn('요금제는 어떻게 되나요', '기본 요금제와 프리미엄 요금제가 있습니다.', '2024-01-01 00:00:00'))
+    return session
+
+def test_needs_condensation(lambda_chat, session):
+    long_question = '서울에서 부산까지 가는 가장 빠른 교통편은 무엇인가요'
+    assert not lambda_chat.needs_condensation('그럼 가격은?', lambda_chat.Session(('user', 'qa'), 1))  # 이전 대화 없음
+    assert lambda_chat.needs_condensation('그럼 가격은?', session)
+    assert lambda_chat.needs_condensation('이건 ' + long_question, session)
+    assert lambda_chat.needs_condensation('What about the premium plan for teams?', session)
+    assert not lambda_chat.needs_condensation(long_question, session)
+
+def test_needs_condensation_with_summary_only(lambda_chat):
+    session = lambda_chat.Session(('user', 'qa'), 1)
+    session.summary = '요금제에 대한 대화'
+    assert lambda_chat.needs_condensation('가격은?', session)
+
+def test_needs_condensation_disabled(lambda_chat, session, monkeypatch):
+    monkeypatch.setattr(lambda_chat, 'CONDENSE', 'false')
+    assert not lambda_chat.needs_condensation('그럼 가격은?', session)
+
+@pytest.fixture
+def retrieval(lambda_chat, monkeypatch):
+    """query별 문서와 score를 정하고, 검색과 다시 작성된 질문을 기록합니다."""
+    class Retrieval:
+        docs = {}
+        scores = {}
+        revised = '프리미엄 요금제의 가격은?'
+        delay = 0
+
+        def __init__(self):
+            self.queries = []
+
+        def retrieve(self, query, top_k):
+            self.queries.append(query)
+            return self.docs.get(query, [])
+
+        def revise(self, connectionId, requestId, text, language, session):
+            time.sleep(self.delay)
+            if isinstance(self.revised, Exception):
+                raise self.revised
+            return self.revised
+
+        def score(self, query, docs):
+            return self.scores.get(docs[0] if docs else None, 0.0)
+
+    retrieval = Retrieval()
+    monkeypatch.setattr(lambda_chat, 'retrieve_documents', retrieval.retrieve)
+    monkeypatch.setattr(lambda_chat, 'get_revised_question', retrieval.revise)
+    monkeypatch.setattr(lambda_chat, 'score_documents', retrieval.score)
+    return retrieval
+
+def retrieve(lambda_chat, text, session):
+    return lambda_chat.retrieve_with_condensation('c1', 'r1', text, 'ko', session, 4)
+
+def test_standalone_question_is_not_condensed(lambda_chat, session, retrieval):
+    text = '서울에서 부산까지 가는 가장 빠른 교통편은 무엇인가요'
+    retrieval.docs = {text: ['raw']}
+
+    assert retrieve(lambda_chat, text, session) == (text, ['raw'])
+    assert retrieval.queries == [text]
+
+def test_revised_question_with_higher_score(lambda_chat, session, retrieval):
+    retrieval.docs = {'그럼 가격은?': ['raw'], retrieval.revised: ['revised']}
+    retrieval.scores = {'raw': 0.3, 'revised': 0.8}
+
+    assert retrieve(lambda_chat, '그럼 가격은?', session) == (retrieval.revised, ['revised'])
+    assert sorted(retrieval.queries) == sorted(['그럼 가격은?', retrieval.revised])
+
+def test_raw_docs_with_higher_score(lambda_chat, session, retrieval):
+    retrieval.docs = {'그럼 가격은?': ['raw'], retrieval.revised: ['revised']}
+    retrieval.scores = {'raw': 0.8, 'revised': 0.3}
+
+    assert retrieve(lambda_chat, '그럼 가격은?', session) == ('그럼 가격은?', ['raw'])
+
+def test_same_question_skips_second_retrieval(lambda_chat, session, retrieval):
+    retrieval.revised = '그럼  가격은'
+    retrieval.docs = {'그럼 가격은?': ['raw']}
+
+    assert retrieve(lambda_chat, '그럼 가격은?', session) == ('그럼 가격은?', ['raw'])
+    assert retrieval.queries == ['그럼 가격은?']
+
+def test_condensation_failure_uses_raw_docs(lambda_chat, session, retrieval):
+    retrieval.revised = Exception('throttled')
+    retrieval.docs = {'그럼 가격은?': ['raw']}
+
+    assert retrieve(lambda_chat, '그럼 가격은?', session) == ('그럼 가격은?', ['raw'])
+
+def test_condensation_timeout_uses_raw_docs(lambda_chat, session, retrieval, monkeypatch):
+    monkeypatch.setattr(lambda_chat, 'CONDENSE_TIMEOUT', 0.05)
+    retrieval.delay = 0.3
+    retrieval.docs = {'그럼 가격은?': ['raw']}
+
+    assert retrieve(lambda_chat, '그럼 가격은?', session) == ('그럼 가격은?', ['raw'])
+    assert retrieval.queries == ['그럼 가격은?']
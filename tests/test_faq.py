@@ -0,0 +1,108 @@
+import pytest
+
+import local_index
+
+def faq_doc(question='환불은 며칠 이내에 가능한가요', confidence='VERY_HIGH', answer='결제 후 7일 이내에 가능합니다.'):
+    return {
+        'api_type': 'query',
+        'confidence': confidence,
+        'metadata': {'type': 'QUESTION_ANSWER', 'question': question, 'answer': answer},
+    }
+
+def test_lexical_similarity(lambda_chat, monkeypatch):
+    monkeypatch.setattr(lambda_chat, 'FAQ_SIMILARITY', 'lexical')
+    assert lambda_chat.get_faq_similarity('refund policy', 'What is the refund policy') == 1.0
+    assert lambda_chat.get_faq_similarity('refund shipping', 'What is the refund policy') == 0.5
+    assert lambda_chat.get_faq_similarity('?', 'What is the refund policy') == 0.0
+
+def test_embedding_similarity(lambda_chat, monkeypatch):
+    monkeypatch.setattr(lambda_chat, 'FAQ_SIMILARITY', 'embedding')
+    monkeypatch.setattr(lambda_chat, 'get_vector_embeddings', lambda: local_index.HashingEmbeddings(64))
+    assert lambda_chat.get_faq_similarity('환불 규정', '환불 규정') == pytest.approx(1.0)
+    assert lambda_chat.get_faq_similarity('환불 규정', '배송 조회 방법') < 0.5
+
+def test_no_similarity_check(lambda_chat, monkeypatch):
+    monkeypatch.setattr(lambda_chat, 'FAQ_SIMILARITY', 'none')
+    assert lambda_chat.get_faq_similarity('배송', '환불') == 1.0
+
+@pytest.fixture
+def lexical(lambda_chat, monkeypatch):
+    monkeypatch.setattr(lambda_chat, 'FAQ_FAST_PATH', 'answer')
+    monkeypatch.setattr(lambda_chat, 'FAQ_MIN_CONFIDENCE', ['VERY_HIGH'])
+    monkeypatch.setattr(lambda_chat, 'FAQ_SIMILARITY', 'lexical')
+    monkeypatch.setattr(lambda_chat, 'FAQ_SIMILARITY_THRESHOLD', 0.5)
+
+def test_faq_doc_above_threshold(lambda_chat, lexical):
+    doc = faq_doc(question='What is the refund policy')
+    assert lambda_chat.get_faq_doc('refund policy', [doc]) is doc
+
+def test_faq_doc_below_threshold(lambda_chat, lexical):
+    assert lambda_chat.get_faq_doc('shipping time and cost', [faq_doc(question='What is the refund policy')]) is None
+
+def test_faq_doc_requires_confidence_and_answer(lambda_chat, lexical):
+    assert lambda_chat.get_faq_doc('refund policy', [faq_doc(question='refund policy', confidence='HIGH')]) is None
+    assert lambda_chat.get_faq_doc('refund policy', [faq_doc(question='refund policy', answer='')]) is None
+
+def test_faq_doc_uses_first_faq(lambda_chat, lexical):
+    document = {'api_type': 'retrieve', 'confidence': 'VERY_HIGH', 'metadata': {}}
+    doc = faq_doc(question='refund policy')
+    assert lambda_chat.get_faq_doc('refund policy', [document, doc, faq_doc(question='shipping')]) is doc
+    assert lambda_chat.get_faq_doc('refund policy', [document]) is None
+
+def test_faq_fast_path_disabled(lambda_chat, lexical, monkeypatch):
+    monkeypatch.setattr(lambda_chat, 'FAQ_FAST_PATH', 'false')
+    assert lambda_chat.get_faq_doc('refund policy', [faq_doc(question='refund policy')]) is None
+
+class Streamer:
+    def __init__(self):
+        self.written = []
+        self.streamed = False
+
+    def write(self, text):
+        self.written.append(text)
+
+@pytest.fixture
+def polish(lambda_chat, monkeypatch):
+    class ModelRouter:
+        def route(self, *args, **kwargs):
+            return None
+
+        def record(self, route, streamer):
+            pass
+
+    monkeypatch.setattr(lambda_chat, 'FAQ_FAST_PATH', 'polish')
+    monkeypatch.setattr(lambda_chat, 'model_router', ModelRouter())
+    monkeypatch.setattr(lambda_chat, 'isTyping', lambda connectionId, requestId: None)
+
+def answer(lambda_chat, streamer):
+    return lambda_chat.get_answer_from_faq('환불 기간은?', 'ko', faq_doc(), 'c1', 'r1', streamer)
+
+def test_answer_mode_sends_faq_answer(lambda_chat, monkeypatch):
+    monkeypatch.setattr(lambda_chat, 'FAQ_FAST_PATH', 'answer')
+    streamer = Streamer()
+    assert answer(lambda_chat, streamer) == '결제 후 7일 이내에 가능합니다.'
+    assert streamer.written == ['결제 후 7일 이내에 가능합니다.']
+
+def test_polish_mode_uses_llm(lambda_chat, polish, monkeypatch):
+    prompts = []
+    monkeypatch.setattr(lambda_chat, 'get_llm', lambda route: lambda prompt, callbacks: prompts.append(prompt) or '7일 이내입니다.')
+    streamer = Streamer()
+    assert answer(lambda_chat, streamer) == '7일 이내입니다.'
+    assert '결제 후 7일 이내에 가능합니다.' in prompts[0]
+    assert streamer.written == []  # LLM이 streamer로 전송
+
+def test_polish_failure_falls_back_to_faq_answer(lambda_chat, polish, monkeypatch):
+    def llm(prompt, callbacks):
+        raise Exception('throttled')
+    monkeypatch.setattr(lambda_chat, 'get_llm', lambda route: llm)
+    streamer = Streamer()
+    assert answer(lambda_chat, streamer) == '결제 후 7일 이내에 가능합니다.'
+    assert streamer.written == ['결제 후 7일 이내에 가능합니다.']
+
+def test_polish_failure_after_streaming_raises(lambda_chat, polish, monkeypatch):
+    def llm(prompt, callbacks):
+        callbacks[0].streamed = True
+        raise Exception('throttled')
+    monkeypatch.setattr(lambda_chat, 'get_llm', lambda route: llm)
+    with pytest.raises(Exception, match='Not able to request to LLM'):
+        answer(lambda_chat, Streamer())
@@ -0,0 +1,120 @@
+import zlib
+
+import pytest
+
+class Flight:
+    def __init__(self, followers):
+        self.followers = list(followers)
+
+    def poll(self, force=False):
+        followers, self.followers = self.followers, []
+        return followers
+
+def joined(frames):
+    return ''.join(frame['text'] for frame in frames)
+
+def check_stream(frames, requestId, text):
+    """seq/offset이 연속이고 final frame의 length/checksum이 전체 텍스트와 일치하는지 확인합니다."""
+    offset = 0
+    for seq, frame in enumerate(frames):
+        assert frame['request_id'] == requestId
+        assert (frame['seq'], frame['offset']) == (seq, offset)
+        offset += len(frame['text'].encode('utf-16-le')) // 2
+    assert frames[-1]['type'] == 'final'
+    assert frames[-1]['length'] == offset
+    assert frames[-1]['checksum'] == zlib.crc32(text.encode('utf-8'))
+    assert joined(frames) == text
+
+def test_close_sends_final_frame(lambda_chat, api):
+    batcher = lambda_chat.FrameBatcher('fb-1', 'r1', interval=60, chunk_size=100)
+    batcher.write('안녕')
+    batcher.write('하세요')
+    assert 'fb-1' not in api.frames
+    assert batcher.streamed
+
+    batcher.close()
+    assert [frame['type'] for frame in api.frames['fb-1']] == ['final']
+    check_stream(api.frames['fb-1'], 'r1', '안녕하세요')
+
+def test_deltas_by_chunk_size(lambda_chat, api):
+    batcher = lambda_chat.FrameBatcher('fb-2', 'r2', interval=60, chunk_size=4)
+    for token in ['ab', 'cd', '😀', 'ef', 'g']:
+        batcher.write(token)
+    batcher.close()
+
+    frames = api.frames['fb-2']
+    assert [frame['type'] for frame in frames] == ['delta', 'delta', 'final']
+    check_stream(frames, 'r2', 'abcd😀efg')  # offset은 UTF-16 code unit
+
+def test_follower_catch_up(lambda_chat, api):
+    batcher = lambda_chat.FrameBatcher('fb-3', 'leader', interval=60, chunk_size=2)
+    batcher.write('가나')
+    batcher.flight = Flight([('fb-4', 'follower')])
+    batcher.write('다라')
+    batcher.write('마')
+    batcher.close()
+
+    check_stream(api.frames['fb-3'], 'leader', '가나다라마')
+    follower = api.frames['fb-4']
+    assert (follower[0]['type'], follower[0]['text']) == ('delta', '가나')  # 그때까지 전송된 텍스트
+    check_stream(follower, 'follower', '가나다라마')
+    assert list(batcher.followers) == ['follower']
+
+def test_follower_joins_at_close(lambda_chat, api):
+    batcher = lambda_chat.FrameBatcher('fb-5', 'leader', interval=60, chunk_size=2)
+    batcher.write('가나')
+    batcher.flight = Flight([('fb-6', 'follower')])
+    batcher.close()
+
+    check_stream(api.frames['fb-6'], 'follower', '가나')
+
+def test_detached_leader_keeps_serving_followers(lambda_chat, api):
+    batcher = lambda_chat.FrameBatcher('fb-7', 'leader', interval=60, chunk_size=2)
+    batcher.flight = Flight([('fb-8', 'follower')])
+    batcher.write('가나')
+    api.gone.add('fb-7')
+    batcher.write('다라')
+    batcher.close()
+
+    assert batcher.detached
+    check_stream(api.frames['fb-8'], 'follower', '가나다라')
+
+def test_gone_without_followers(lambda_chat, api):
+    batcher = lambda_chat.FrameBatcher('fb-9', 'r9', interval=60, chunk_size=2)
+    api.gone.add('fb-9')
+    with pytest.raises(lambda_chat.ConnectionGone):
+        batcher.write('가나')
+
+def test_failed_follower_is_dropped(lambda_chat, api):
+    batcher = lambda_chat.FrameBatcher('fb-10', 'leader', interval=60, chunk_size=2)
+    batcher.flight = Flight([('fb-11', 'follower')])
+    api.gone.add('fb-11')
+    batcher.write('가나')
+    batcher.close()
+
+    assert batcher.followers == {}
+    check_stream(api.frames['fb-10'], 'leader', '가나')
+
+@pytest.fixture
+def store(lambda_chat, monkeypatch):
+    store = lambda_chat.SessionMemoryStore(10, 1024 * 1024, 3600, lambda_chat.HISTORY_TURNS)
+    monkeypatch.setattr(lambda_chat, 'session_store', store)
+    return store
+
+def test_disconnect_releases_sessions_only(lambda_chat, api, store):
+    store.create(('user', 'normal'))
+    lambda_chat.connection_registry.add_session('fb-12', ('user', 'normal'))
+    lambda_chat.close_connection('fb-12', '$disconnect')
+
+    assert store.get(('user', 'normal')) is None
+    assert not lambda_chat.connection_registry.is_dead('fb-12')
+
+def test_gone_exception_stops_and_releases_sessions(lambda_chat, api, store):
+    store.create(('user', 'qa'))
+    lambda_chat.connection_registry.add_session('fb-13', ('user', 'qa'))
+    api.gone.add('fb-13')
+    with pytest.raises(lambda_chat.ConnectionGone):
+        lambda_chat.sendMessage('fb-13', {'type': 'typing'})
+
+    assert store.get(('user', 'qa')) is None
+    assert lambda_chat.connection_registry.is_dead('fb-13')
@@ -0,0 +1,93 @@
+import json
+import math
+import os
+
+import pytest
+
+import local_index
+
+CHUNKS = [
+    {'document_id': 'd0', 'title': '요금 안내', 'source': 's0', 'excerpt': '서비스 요금은 매월 청구됩니다.'},
+    {'document_id': 'd1', 'title': '환불 정책', 'source': 's1', 'excerpt': '환불은 결제 후 7일 이내에 요청할 수 있습니다.'},
+    {'document_id': 'd2', 'title': 'Refund policy', 'source': 's2', 'excerpt': 'A refund can be requested within 7 days.'},
+    {'document_id': 'd3', 'title': '배송 안내', 'source': 's3', 'excerpt': '배송은 주문 후 2일 이내에 시작됩니다.'},
+]
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / 'index')
+    local_index.write_index(path, CHUNKS, None, {'embedding_model_id': 'none'}, {})
+    return path
+
+def bm25(index, texts, query, doc_id):
+    """index와 같은 parameter로 계산한 BM25 score."""
+    docs = [local_index.tokenize(text) for text in texts]
+    avgdl = sum(len(doc) for doc in docs) / len(docs)
+    score = 0.0
+    for term in set(local_index.tokenize(query)):
+        df = sum(1 for doc in docs if term in doc)
+        if df == 0:
+            continue
+        tf = docs[doc_id].count(term)
+        idf = math.log(1 + (len(docs) - df + 0.5) / (df + 0.5))
+        score += idf * tf * (index.k1 + 1) / (tf + index.k1 * (1 - index.b + index.b * len(docs[doc_id]) / avgdl))
+    return score
+
+def test_tokenize_uses_hangul_ngrams_and_words():
+    assert local_index.tokenize('환불정책 Refund') == ['환불', '불정', '정책', '환불정', '불정책', 'refund']
+    assert local_index.tokenize('한') == ['한']
+
+def test_lexical_index_loads_without_vector_index(index_path):
+    assert not os.path.exists(os.path.join(index_path, local_index.FAISS_FILE))
+
+    index = local_index.LexicalIndex(index_path)
+    assert index.count == len(CHUNKS)
+    assert index.meta['dim'] == 0
+    assert index.store.get(1) == CHUNKS[1]
+
+def test_lexical_index_rejects_mismatched_meta(index_path):
+    meta_file = os.path.join(index_path, local_index.META_FILE)
+    with open(meta_file, encoding='utf-8') as f:
+        meta = json.load(f)
+    with open(meta_file, 'w', encoding='utf-8') as f:
+        json.dump(dict(meta, count=len(CHUNKS) + 1), f)
+
+    with pytest.raises(Exception):
+        local_index.LexicalIndex(index_path)
+
+def test_bm25_scores_match_reference(index_path):
+    index = local_index.LexicalIndex(index_path)
+    texts = [chunk['title'] + ' ' + chunk['excerpt'] for chunk in CHUNKS]
+
+    results = index.search('환불 요청', 10)
+    assert results[0][1] == 1
+    for score, i, _ in results:
+        assert score == pytest.approx(bm25(index, texts, '환불 요청', i), rel=1e-5)
+    assert [score for score, _, _ in results] == sorted((score for score, _, _ in results), reverse=True)
+
+def test_bm25_coverage_ignores_unknown_terms(index_path):
+    index = local_index.LexicalIndex(index_path)
+
+    score, i, coverage = index.search('refund 어떻게', 1)[0]
+    assert i == 2
+    assert coverage == pytest.approx(1.0)
+
+    results = dict((i, coverage) for _, i, coverage in index.search('환불 배송', 10))
+    assert 0 < results[1] < 1 and 0 < results[3] < 1
+
+def test_bm25_top_k_and_no_match(index_path):
+    index = local_index.LexicalIndex(index_path)
+
+    assert len(index.search('안내', 1)) == 1
+    assert index.search('존재하지않는단어', 10) == []
+    assert index.search('', 10) == []
+
+def test_reciprocal_rank_fusion():
+    assert local_index.reciprocal_rank_fusion([[1, 2, 3], [3, 1]]) == [1, 3, 2]
+    assert local_index.reciprocal_rank_fusion([[5, 6]]) == [5, 6]
+    assert local_index.reciprocal_rank_fusion([]) == []
+
+def test_reciprocal_rank_fusion_prefers_agreement():
+    rankings = [[1, 2, 3], [3, 2, 4], [3, 2]]
+    assert local_index.reciprocal_rank_fusion(rankings) == [3, 2, 1, 4]
+    assert local_index.reciprocal_rank_fusion(rankings, k=0) == [3, 2, 1, 4]
@@ -0,0 +1,74 @@
+import pytest
+
+DEFAULT = 'anthropic.claude-v2:1'
+FAST = 'anthropic.claude-instant-v1'
+CLIENT = 'amazon.titan-text-express-v1'
+
+@pytest.fixture
+def router(lambda_chat):
+    return lambda_chat.ModelRouter(DEFAULT, FAST, [DEFAULT, FAST, CLIENT], [CLIENT], latency_slo=60)
+
+class Streamer:
+    def __init__(self, tokens, first_token_at):
+        self.tokens = tokens
+        self.first_token_at = first_token_at
+
+def test_route_by_category(lambda_chat, router):
+    route = router.route('안녕', 'normal')
+    assert (route.model_id, route.reason, route.category) == (FAST, 'simple', 'chat')
+
+    route = router.route('요금은 어떻게 청구되나요', 'qa')
+    assert (route.model_id, route.reason, route.category) == (DEFAULT, 'qa', 'qa')
+
+    route = router.route('두 요금제의 차이를 비교해 주세요', 'qa')
+    assert (route.model_id, route.category) == (DEFAULT, 'complex')
+
+    route = router.route('요금은 어떻게 청구되나요', 'qa', faq_hit=True)
+    assert (route.model_id, route.reason) == (FAST, 'faq')
+    assert router.current is route
+
+def test_max_tokens(lambda_chat, router):
+    route = router.route('요금은 어떻게 청구되나요', 'qa')
+    assert route.max_tokens == min(lambda_chat.ANSWER_TOKENS['qa'] * 2, lambda_chat.MODEL_MAX_TOKENS.get(DEFAULT, 4096))
+
+def test_client_model(router):
+    assert router.route('안녕', 'normal', requested_model_id=CLIENT).reason == 'client'
+    assert router.route('안녕', 'normal', requested_model_id=CLIENT).model_id == CLIENT
+
+    route = router.route('요금은 어떻게 청구되나요', 'qa', requested_model_id='amazon.titan-text-lite-v1')
+    assert route.model_id == DEFAULT
+
+def test_disabled_router_uses_default_model(lambda_chat):
+    router = lambda_chat.ModelRouter(DEFAULT, FAST, [DEFAULT, FAST], [], latency_slo=60, enabled=False)
+    route = router.route('안녕', 'normal')
+    assert (route.model_id, route.reason) == (DEFAULT, 'default')
+
+def test_fast_model_outside_pool(lambda_chat):
+    router = lambda_chat.ModelRouter(DEFAULT, FAST, [DEFAULT], [], latency_slo=60)
+    assert router.route('안녕', 'normal').model_id == DEFAULT
+
+def test_slo_falls_back_to_fast_model(lambda_chat):
+    router = lambda_chat.ModelRouter(DEFAULT, FAST, [DEFAULT, FAST], [], latency_slo=5)
+    route = router.route('요금은 어떻게 청구되나요', 'qa')
+    assert (route.model_id, route.reason) == (FAST, 'slo')
+
+def test_record_updates_latency_stats(lambda_chat, router):
+    route = router.route('요금은 어떻게 청구되나요', 'qa')
+    before = dict(router.stats[DEFAULT])
+    route.started_at -= 10
+    router.record(route, Streamer(tokens=100, first_token_at=route.started_at + 5))
+
+    stats = router.stats[DEFAULT]
+    assert stats['requests'] == 1
+    assert stats['ttft'] == pytest.approx(before['ttft'] + router.EWMA_ALPHA * (5 - before['ttft']), rel=1e-2)
+    assert stats['tps'] == pytest.approx(before['tps'] + router.EWMA_ALPHA * (20 - before['tps']), rel=1e-2)
+
+def test_record_skips_requests_without_tokens(router):
+    route = router.route('요금은 어떻게 청구되나요', 'qa')
+    router.record(route, Streamer(tokens=0, first_token_at=None))
+    assert router.stats[DEFAULT]['requests'] == 0
+
+def test_get_parameter(lambda_chat):
+    assert lambda_chat.get_parameter(DEFAULT, 100)['max_tokens_to_sample'] == 100
+    assert lambda_chat.get_parameter(CLIENT, 100)['maxTokenCount'] == 100
+    assert lambda_chat.get_parameter('meta.llama2-13b-chat-v1') is None
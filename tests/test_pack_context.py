@@ -0,0 +1,49 @@
+PROMPT = 'Human: 참고자료를 보고 답하세요.\n{context}\n질문: {question}\n\nAssistant:'
+
+def doc(excerpt):
+    return {'metadata': {'excerpt': excerpt}}
+
+def test_trim_at_sentence_boundary(lambda_chat):
+    text = '첫 번째 문장입니다. 두 번째 문장입니다. 세 번째 문장입니다.'
+    limit = lambda_chat.estimate_tokens('첫 번째 문장입니다.') + lambda_chat.estimate_tokens('두 번째 문장입니다.')
+
+    excerpt, tokens = lambda_chat.trim_to_tokens(text, limit)
+    assert excerpt == '첫 번째 문장입니다. 두 번째 문장입니다.'
+    assert tokens <= limit
+
+def test_trim_without_sentence_boundary_cuts_characters(lambda_chat):
+    text = 'a' * 4000  # 문장 경계가 없는 긴 텍스트
+
+    excerpt, tokens = lambda_chat.trim_to_tokens(text, 100)
+    assert excerpt and text.startswith(excerpt)
+    assert tokens == lambda_chat.estimate_tokens(excerpt) <= 100
+    assert lambda_chat.estimate_tokens(text[:len(excerpt) + 1]) > 100
+
+def test_pack_all_docs_within_budget(lambda_chat):
+    docs = [doc('요금은 매월 청구됩니다.'), doc('환불은 7일 이내에 가능합니다.')]
+
+    context, used_docs, stats = lambda_chat.pack_context(PROMPT, '요금은?', docs, budget=1000)
+    assert context == '요금은 매월 청구됩니다.\n\n환불은 7일 이내에 가능합니다.'
+    assert used_docs == docs
+    assert stats['packed'] == 2 and stats['trimmed'] == 0
+    assert stats['prompt_tokens'] <= 1000
+
+def test_pack_trims_long_doc_without_sentence_boundary(lambda_chat):
+    docs = [doc('b' * 8000), doc('사용되지 않는 참고자료입니다.')]
+
+    context, used_docs, stats = lambda_chat.pack_context(PROMPT, '질문', docs, budget=500)
+    assert context and docs[0]['metadata']['excerpt'].startswith(context)
+    assert used_docs == docs[:1]
+    assert stats['trimmed'] == 1
+    assert stats['prompt_tokens'] <= 500
+
+def test_pack_stops_when_trimmed_doc_is_too_short(lambda_chat):
+    first = '가' * 400
+    base = lambda_chat.estimate_tokens(PROMPT.format(context='', question='질문'))
+    budget = base + lambda_chat.estimate_tokens(first) + 1 + lambda_chat.MIN_TRIMMED_TOKENS - 10
+    docs = [doc(first), doc('나' * 400)]
+
+    context, used_docs, stats = lambda_chat.pack_context(PROMPT, '질문', docs, budget=budget)
+    assert context == first
+    assert used_docs == docs[:1]
+    assert stats['trimmed'] == 0
@@ -0,0 +1,70 @@
+import pytest
+
+DOCS = [{'rag_type': 'search', 'metadata': {'title': '요금 안내', 'excerpt': '매월 청구됩니다.'}}]
+
+class SharedCache:
+    def __init__(self):
+        self.items = {}
+
+    def get(self, key):
+        return self.items.get(key)
+
+    def put(self, key, value, ttl=None):
+        self.items[key] = value
+
+@pytest.fixture
+def clock(lambda_chat, monkeypatch):
+    now = [lambda_chat.time.time()]
+    monkeypatch.setattr(lambda_chat.time, 'time', lambda: now[0])
+    return now
+
+def create_cache(lambda_chat, shared=None):
+    return lambda_chat.RetrievalCache(local=lambda_chat.LRUCache(10, 600), shared=shared, negative_ttl=60)
+
+def test_hit_and_miss(lambda_chat, clock):
+    cache = create_cache(lambda_chat)
+    assert cache.get('k') is None
+    cache.put('k', DOCS)
+    assert cache.get('k') == DOCS
+    assert cache.metrics == {'hit': 1, 'negative_hit': 0, 'miss': 1}
+
+def test_negative_ttl(lambda_chat, clock):
+    cache = create_cache(lambda_chat)
+    cache.put('empty', [])
+    cache.put('docs', DOCS)
+    assert cache.get('empty') == []
+    assert cache.metrics['negative_hit'] == 1
+
+    clock[0] += 61  # 결과가 없는 검색은 negative_ttl이 지나면 다시 검색
+    assert cache.get('empty') is None
+    assert cache.get('docs') == DOCS
+
+    clock[0] += 600
+    assert cache.get('docs') is None
+
+def test_shared_cache_fills_local(lambda_chat, clock):
+    shared = SharedCache()
+    cache = create_cache(lambda_chat, shared)
+    cache.put('k', DOCS)
+    assert shared.items['k'] == DOCS
+
+    other = create_cache(lambda_chat, shared)  # 다른 container
+    assert other.get('k') == DOCS
+    shared.items.clear()
+    assert other.get('k') == DOCS
+
+def test_shared_negative_result_uses_negative_ttl(lambda_chat, clock):
+    shared = SharedCache()
+    shared.items['empty'] = []
+    cache = create_cache(lambda_chat, shared)
+    assert cache.get('empty') == []
+
+    shared.items.clear()
+    clock[0] += 61
+    assert cache.get('empty') is None
+
+def test_cache_key(lambda_chat):
+    key = lambda_chat.get_retrieval_cache_key('kendra', '요금은?', 4)
+    assert key == lambda_chat.get_retrieval_cache_key('kendra', '  요금은 ', 4)
+    assert key != lambda_chat.get_retrieval_cache_key('kendra', '요금은?', 8)
+    assert key != lambda_chat.get_retrieval_cache_key('naver', '요금은?')
@@ -0,0 +1,83 @@
+import pytest
+
+@pytest.fixture
+def clock(lambda_chat, monkeypatch):
+    now = [lambda_chat.time.time()]
+    monkeypatch.setattr(lambda_chat.time, 'time', lambda: now[0])
+    return now
+
+def create_store(lambda_chat, max_sessions=3, max_bytes=10000, idle_ttl=600, max_turns=4):
+    return lambda_chat.SessionMemoryStore(max_sessions, max_bytes, idle_ttl, max_turns)
+
+def test_get_and_create(lambda_chat):
+    store = create_store(lambda_chat)
+    assert store.get(('u1', 'qa')) is None
+    session = store.create(('u1', 'qa'))
+    assert store.get(('u1', 'qa')) is session
+    assert (store.metrics['hit'], store.metrics['miss'], store.metrics['sessions']) == (1, 1, 1)
+
+def test_lru_eviction(lambda_chat, clock):
+    store = create_store(lambda_chat, max_sessions=2)
+    store.create('a')
+    store.create('b')
+    store.get('a')  # b가 가장 오래 사용하지 않은 session
+    store.create('c')
+
+    assert store.get('b') is None
+    assert store.get('a') is not None and store.get('c') is not None
+    assert store.metrics['evicted_lru'] == 1
+
+def test_byte_eviction(lambda_chat):
+    store = create_store(lambda_chat, max_bytes=200)  # turn 하나가 120 bytes
+    a = store.create('a')
+    store.add_turn(a, '질문' * 10, '답변' * 10, '1')
+    b = store.create('b')
+    store.add_turn(b, '질문' * 10, '답변' * 10, '1')
+
+    assert store.get('a') is None
+    assert store.get('b') is b
+    assert store.bytes == b.bytes <= 200
+    assert store.metrics['evicted_bytes'] == 1
+
+def test_last_session_is_kept_over_byte_limit(lambda_chat):
+    store = create_store(lambda_chat, max_bytes=10)
+    a = store.create('a')
+    store.add_turn(a, '질문' * 10, '답변' * 10, '1')
+    assert store.get('a') is a
+
+def test_idle_expiry(lambda_chat, clock):
+    store = create_store(lambda_chat, idle_ttl=60)
+    store.create('a')
+    clock[0] += 30
+    store.create('b')
+    clock[0] += 31
+
+    assert store.get('a') is None
+    assert store.get('b') is not None
+    assert store.metrics['evicted_idle'] == 1
+
+def test_turns_are_bounded_and_bytes_tracked(lambda_chat):
+    store = create_store(lambda_chat, max_turns=2)
+    session = store.create('a')
+    for i in range(3):
+        store.add_turn(session, f'질문 {i}', f'답변 {i}', str(i))
+
+    assert [turn.human for turn in session.turns] == ['질문 1', '질문 2']
+    assert session.bytes == sum(turn.size for turn in session.turns) == store.bytes
+    assert session.last_request_time == '2'
+
+def test_remove_and_summary(lambda_chat):
+    store = create_store(lambda_chat)
+    session = store.create('a')
+    for i in range(3):
+        store.add_turn(session, f'질문 {i}', f'답변 {i}', str(i))
+
+    store.set_summary(session, '요약', '1')
+    assert [turn.request_time for turn in session.turns] == ['2']
+    assert session.bytes == session.turns[0].size + len('요약'.encode('utf-8')) == store.bytes
+
+    store.set_summary(session, '이전 요약', '0')  # 더 최근의 요약이 이미 반영됨
+    assert session.summary == '요약'
+
+    store.remove('a')
+    assert store.get('a') is None and store.bytes == 0
@@ -0,0 +1,110 @@
+import datetime
+import json
+
+import pytest
+
+USER = 'user@example.com'
+
+@pytest.fixture
+def single_flight(lambda_chat, dynamodb, monkeypatch):
+    single_flight = lambda_chat.SingleFlight('test-inflight', ttl=5, poll_interval=0.01, request_ttl=60)
+    monkeypatch.setattr(lambda_chat, 'single_flight', single_flight)
+    monkeypatch.setattr(lambda_chat, 'recent_requests', lambda_chat.collections.OrderedDict())
+    monkeypatch.setattr(lambda_chat, 'recent_answers', {})
+    return single_flight
+
+def message(requestId, request_time):
+    return {
+        'user_id': USER,
+        'request_id': requestId,
+        'request_time': request_time,
+        'type': 'text',
+        'body': '요금제는 어떻게 되나요',
+        'conv_type': 'qa',
+        'model_id': '',
+    }
+
+def handle(lambda_chat, connectionId, body):
+    event = {'requestContext': {'connectionId': connectionId, 'routeKey': '$default'}, 'body': json.dumps(body)}
+    return lambda_chat.lambda_handler(event, None)
+
+def now():
+    return str(datetime.datetime.now())[0:19]
+
+def test_duplicate_while_generating_gets_typing(lambda_chat, api, single_flight):
+    assert single_flight.claim_request(USER, 'r1')  # 다른 container에서 생성 중
+
+    handle(lambda_chat, 'c2', message('r1', now()))
+    assert [frame['type'] for frame in api.frames['c2']] == ['typing']
+
+def test_duplicate_after_answer_gets_resync(lambda_chat, api, dynamodb, single_flight):
+    request_time = now()
+    assert single_flight.claim_request(USER, 'r1')
+    dynamodb.put(user_id=USER, request_time=request_time, request_id='r1', type='text', body='요금제는 어떻게 되나요', msg='두 가지 요금제가 있습니다.')
+
+    handle(lambda_chat, 'c2', message('r1', request_time))
+    (frame,) = api.frames['c2']
+    assert frame['type'] == 'resync'
+    assert frame['text'] == '두 가지 요금제가 있습니다.'
+
+def test_duplicate_in_same_container_uses_recent_answer(lambda_chat, api, single_flight):
+    assert not lambda_chat.is_duplicate_request(USER, 'r1')
+    lambda_chat.remember_answer(USER, 'r1', '두 가지 요금제가 있습니다.')
+
+    handle(lambda_chat, 'c1', message('r1', now()))
+    assert [(frame['type'], frame['text']) for frame in api.frames['c1']] == [('resync', '두 가지 요금제가 있습니다.')]
+
+def test_released_request_is_processed_again(lambda_chat, single_flight):
+    assert not lambda_chat.is_duplicate_request(USER, 'r1')
+    assert lambda_chat.is_duplicate_request(USER, 'r1')
+
+    lambda_chat.release_request(USER, 'r1')  # 답변하지 못한 요청
+    assert not lambda_chat.is_duplicate_request(USER, 'r1')
+
+def test_leader_fans_out_to_followers(lambda_chat, api, single_flight):
+    flight, following = single_flight.join('key', 'c1', 'leader')
+    assert flight is not None and not following
+    assert single_flight.join('key', 'c2', 'follower') == (None, True)
+
+    streamer = lambda_chat.WebSocketStreamingCallbackHandler('c1', 'leader')
+    streamer.batcher.flight = flight
+    streamer.write('두 가지 ')
+    streamer.write('요금제가 있습니다.')
+    streamer.close()
+    flight.complete('두 가지 요금제가 있습니다.', '', list(streamer.batcher.followers))
+
+    assert ''.join(frame['text'] for frame in api.frames['c2']) == '두 가지 요금제가 있습니다.'
+    assert api.frames['c2'][-1]['type'] == 'final'
+    assert single_flight.wait('key', 'follower') == ('두 가지 요금제가 있습니다.', '', True)
+
+def test_follower_after_final_frame_is_not_served(lambda_chat, api, single_flight):
+    flight, _ = single_flight.join('key', 'c1', 'leader')
+    flight.complete('두 가지 요금제가 있습니다.', '', [])
+
+    assert single_flight.join('key', 'c2', 'late') == (None, True)  # 완료된 flight에는 등록되지 않음
+    assert single_flight.wait('key', 'late') == ('두 가지 요금제가 있습니다.', '', False)
+
+def test_follower_generates_when_leader_aborts(lambda_chat, single_flight):
+    flight, _ = single_flight.join('key', 'c1', 'leader')
+    single_flight.join('key', 'c2', 'follower')
+    flight.abort()
+
+    assert single_flight.wait('key', 'follower') is None
+    flight, following = single_flight.join('key', 'c2', 'follower')  # 다음 요청이 leader가 됨
+    assert flight is not None and not following
+
+def test_follower_joins_before_retrieval(lambda_chat, api, single_flight, monkeypatch):
+    def retrieve(*args):
+        raise AssertionError('follower should not retrieve documents')
+    monkeypatch.setattr(lambda_chat, 'rag_method', 'RetrievalPrompt')
+    monkeypatch.setattr(lambda_chat, 'retrieve_with_condensation', retrieve)
+
+    key = lambda_chat.get_flight_key('요금제는 어떻게 되나요', '', 'qa', '')
+    flight, _ = single_flight.join(key, 'c1', 'leader')
+    flight.complete('두 가지 요금제가 있습니다.', '\n참고자료', [])
+
+    session = lambda_chat.Session((USER, 'qa'), lambda_chat.HISTORY_TURNS)
+    streamer = lambda_chat.WebSocketStreamingCallbackHandler('c2', 'follower')
+    result = lambda_chat.get_answer_using_RAG('요금제는 어떻게 되나요', 'ko', 'qa', 'c2', 'follower', streamer, session)
+    assert result == ('두 가지 요금제가 있습니다.', '\n참고자료')
+    assert not streamer.served
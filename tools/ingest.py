@@ -0,0 +1,242 @@
+"""local retrieval index를 생성하는 ingestion 도구.
+
+문서(디렉토리의 .txt/.md 파일 또는 Kendra data source의 JSONL export)를 chunking하고
+embedding을 batch 단위로 동시에 요청하여 lambda-chat.py의 local vector index와
+BM25 lexical index를 만듭니다. 이전 index가 있으면 content hash가 바뀐 문서만 다시 embedding합니다.
+embedding만 재사용하며 index 파일(vectors, docstore, lexical index, manifest)은 매번 전체를 다시 씁니다.
+
+    python tools/ingest.py --input export.jsonl --output /tmp/vector-index
+    python tools/ingest.py --input docs/ --output /tmp/vector-index --embedder hash
+    python tools/ingest.py --input docs/ --output /tmp/vector-index --embedder none  # lexical index만 생성
+
+JSONL의 각 줄은 {"document_id", "title", "source", "text"} 형식이며
+"id", "_source_uri", "content"도 각각 document_id, source, text로 사용합니다.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+import traceback
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'aws-lambda'))
+import local_index
+
+TEXT_EXTENSIONS = ('.txt', '.md')
+
+pattern_sentence = re.compile(r'(?<=[.!?。])\s+|\n+')
+
+def read_documents(input_path):
+    """(document_id, title, source, text)를 하나씩 반환합니다."""
+    if os.path.isdir(input_path):
+        for root, _, files in os.walk(input_path):
+            for name in sorted(files):
+                if not name.endswith(TEXT_EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                with open(path, encoding='utf-8') as f:
+                    text = f.read()
+                yield os.path.relpath(path, input_path), os.path.splitext(name)[0], path, text
+    else:
+        with open(input_path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                doc = json.loads(line)
+                document_id = doc.get('document_id') or doc.get('id')
+                source = doc.get('source') or doc.get('_source_uri', '')
+                text = doc.get('text') or doc.get('content', '')
+                yield str(document_id), doc.get('title', ''), source, text
+
+def chunk_text(text, chunk_size, overlap):
+    """문장 경계에서 chunk_size 글자 이하로 나누며, 앞 chunk의 마지막 overlap 글자 이내의 문장을 반복합니다."""
+    sentences = [sentence.strip() for sentence in pattern_sentence.split(text) if sentence.strip()]
+
+    chunks = []
+    current = []
+    length = 0
+    for sentence in sentences:
+        while len(sentence) > chunk_size:  # 한 문장이 chunk_size보다 긴 경우
+            sentence_chunk, sentence = sentence[:chunk_size], sentence[chunk_size:]
+            if current:
+                chunks.append(' '.join(current))
+                current, length = [], 0
+            chunks.append(sentence_chunk)
+
+        if current and length + len(sentence) + 1 > chunk_size:
+            chunks.append(' '.join(current))
+
+            carry = []
+            carried = 0
+            for previous in reversed(current):
+                if carried + len(previous) > overlap:
+                    break
+                carry.insert(0, previous)
+                carried += len(previous) + 1
+            current, length = carry, carried
+
+        current.append(sentence)
+        length += len(sentence) + 1
+
+    if current:
+        chunks.append(' '.join(current))
+    return chunks
+
+def get_content_hash(title, text):
+    return hashlib.sha256(f'{title}\n{text}'.encode('utf-8')).hexdigest()
+
+def create_embedder(name, model_id, region, dim):
+    if name == 'none':
+        return None
+    elif name == 'hash':
+        return local_index.HashingEmbeddings(dim)
+
+    import boto3
+    from botocore.config import Config
+    from langchain.embeddings import BedrockEmbeddings
+
+    boto3_bedrock = boto3.client(
+        service_name='bedrock-runtime',
+        region_name=region,
+        config=Config(retries={'max_attempts': 10, 'mode': 'adaptive'})
+    )
+    return BedrockEmbeddings(client=boto3_bedrock, region_name=region, model_id=model_id)
+
+def embed_batch(embedder, texts, max_attempts):
+    for attempt in range(max_attempts):
+        try:
+            return embedder.embed_documents(texts)
+        except Exception:
+            if attempt == max_attempts - 1:
+                raise
+            print('error message: ', traceback.format_exc())
+            time.sleep(min(0.5 * 2**attempt, 10))  # exponential backoff
+
+def ingest(args):
+    start = time.time()
+    embedder = create_embedder(args.embedder, args.model_id, args.region, args.dim)
+    model_id = args.model_id if args.embedder == 'bedrock' else args.embedder
+    params = {'embedding_model_id': model_id, 'chunk_size': args.chunk_size, 'overlap': args.overlap, 'dtype': args.dtype}
+    if args.embedder != 'bedrock':  # bedrock embedding의 차원은 model이 결정
+        params['dim'] = args.dim if embedder is not None else 0
+
+    # 같은 설정으로 생성된 이전 index가 있으면 변경되지 않은 문서의 chunk와 벡터를 재사용
+    existing = local_index.read_existing(args.output)
+    if existing is not None:
+        old_meta, old_manifest, old_vectors, old_store = existing
+        if any(old_meta.get(key) != value for key, value in params.items()):
+            print('index parameters are changed. rebuild all documents')
+            existing = None
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency)
+    documents = []  # (document_id, hash, chunks, vectors or [futures])
+    pending = []    # embedding 요청 전의 (document index, chunk index, text)
+    in_flight = []
+    stats = {'documents': 0, 'reused_documents': 0, 'chunks': 0, 'embedded': 0}
+    embed_start = None  # 첫 batch를 요청한 시점 (읽기와 chunking 시간은 제외)
+
+    def submit_pending():
+        nonlocal embed_start
+        if embed_start is None:
+            embed_start = time.time()
+        batch = pending[:]
+        pending.clear()
+        future = executor.submit(embed_batch, embedder, [text for _, _, text in batch], args.max_attempts)
+        in_flight.append((future, batch))
+        while len(in_flight) > args.concurrency * 2:  # 동시에 요청 중인 batch 수를 제한
+            collect(*in_flight.pop(0))
+
+    def collect(future, batch):
+        for (doc_index, chunk_index, _), vector in zip(batch, future.result()):
+            documents[doc_index][3][chunk_index] = vector
+        stats['embedded'] += len(batch)
+
+    seen = set()
+    for document_id, title, source, text in read_documents(args.input):
+        if document_id in seen:
+            print(f'duplicated document_id: {document_id}')
+            continue
+        seen.add(document_id)
+        stats['documents'] += 1
+        content_hash = get_content_hash(title, text)
+
+        if existing is not None and old_manifest.get(document_id, {}).get('hash') == content_hash:
+            first, last = old_manifest[document_id]['chunks']
+            chunks = [old_store.get(i) for i in range(first, last)]
+            vectors = [np.asarray(old_vectors[i], dtype=np.float32) for i in range(first, last)] if embedder is not None else []
+            documents.append((document_id, content_hash, chunks, vectors))
+            stats['reused_documents'] += 1
+            stats['chunks'] += len(chunks)
+            continue
+
+        chunks = []
+        for i, excerpt in enumerate(chunk_text(text, args.chunk_size, args.overlap)):
+            chunks.append({
+                'document_id': document_id,
+                'title': title,
+                'source': source,
+                'excerpt': excerpt,
+                'chunk': i,
+            })
+        documents.append((document_id, content_hash, chunks, [None] * len(chunks) if embedder is not None else []))
+        stats['chunks'] += len(chunks)
+        if embedder is None:
+            continue
+
+        for i, chunk in enumerate(chunks):
+            pending.append((len(documents) - 1, i, chunk['excerpt']))
+            if len(pending) >= args.batch_size:
+                submit_pending()
+
+    if pending:
+        submit_pending()
+    while in_flight:
+        collect(*in_flight.pop(0))
+    executor.shutdown()
+    embed_time = time.time() - embed_start if embed_start is not None else 0
+
+    all_chunks = []
+    all_vectors = []
+    manifest = {}
+    for document_id, content_hash, chunks, vectors in documents:
+        manifest[document_id] = {'hash': content_hash, 'chunks': [len(all_chunks), len(all_chunks) + len(chunks)]}
+        all_chunks.extend(chunks)
+        all_vectors.extend(vectors)
+
+    if not all_chunks:
+        print('No chunk to index!')
+        return
+
+    vectors = np.vstack(all_vectors) if embedder is not None else None
+    local_index.write_index(args.output, all_chunks, vectors, params, manifest, args.dtype, lexical=args.lexical)
+
+    elapsed = time.time() - start
+    stats['removed_documents'] = len(set(old_manifest) - seen) if existing is not None else 0
+    stats['elapsed_sec'] = round(elapsed, 3)
+    stats['chunks_per_sec'] = round(stats['chunks'] / elapsed, 1)
+    stats['embeddings_per_sec'] = round(stats['embedded'] / embed_time, 1) if stats['embedded'] and embed_time else 0
+    print(json.dumps(stats))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', required=True, help='text 파일 디렉토리 또는 JSONL 파일')
+    parser.add_argument('--output', required=True, help='index 디렉토리 (vector_index_path)')
+    parser.add_argument('--embedder', default='bedrock', choices=['bedrock', 'hash', 'none'])
+    parser.add_argument('--model-id', default='amazon.titan-embed-text-v1')
+    parser.add_argument('--region', default=os.environ.get('bedrock_region', 'us-east-1'))
+    parser.add_argument('--dim', type=int, default=256, help='hash embedder의 차원')
+    parser.add_argument('--chunk-size', type=int, default=800)
+    parser.add_argument('--overlap', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--max-attempts', type=int, default=5)
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--no-lexical', dest='lexical', action='store_false', help='lexical index를 생성하지 않음')
+    args = parser.parse_args()
+
+    ingest(args)